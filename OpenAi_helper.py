@@ -1,10 +1,44 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
 import os
 import logging  # Updated
+import random
 import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional, Literal, List, Sequence, Tuple, Dict, Any
+from functools import lru_cache
+from typing import (
+    Optional,
+    Literal,
+    List,
+    Sequence,
+    Tuple,
+    Dict,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+)
+
+import httpx
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    AsyncOpenAI,
+)
 
-from openai import AsyncOpenAI
+try:
+    # Необязательная зависимость: без tiktoken токены оцениваются по длине текста
+    import tiktoken  # type: ignore
+except ImportError:
+    tiktoken = None
 
 try:
     # Попробуем взять общий логгер из основного файла
@@ -27,17 +61,104 @@ OpenAIModel = Literal[
 DEFAULT_SYSTEM_PROMPT = ""
 DEFAULT_USER_PROMPT = ""
 
-_openai_client: Optional[AsyncOpenAI] = None
-_cached_api_key: Optional[str] = None
+# Клиенты по API-ключу поверх одного общего keep-alive пула соединений.
+_openai_clients: Dict[str, AsyncOpenAI] = {}
+_http_client: Optional[httpx.AsyncClient] = None
+
+OPENAI_POOL_MAX_CONNECTIONS = 32
+OPENAI_POOL_MAX_KEEPALIVE = 16
+OPENAI_POOL_KEEPALIVE_EXPIRY_SECONDS = 60.0
+OPENAI_CONNECT_TIMEOUT_SECONDS = 10.0
+# Таймаут одной попытки и общий дедлайн вызова вместе с очередью и повторами.
+OPENAI_REQUEST_TIMEOUT_SECONDS = 60.0
+OPENAI_CALL_DEADLINE_SECONDS = 120.0
+# Hedged-запрос: если интерактивная попытка не ответила за столько секунд,
+# параллельно уходит вторая, берётся первый успешный ответ. None — выключено.
+OPENAI_HEDGE_AFTER_SECONDS: Optional[float] = None
+
+# Сколько пост-обработок вариантов (переформулировка/грамматика) идёт одновременно
+# во всех вызовах generate_dating_ai_variants.
+VARIANT_POSTPROCESS_CONCURRENCY = 6
+# Грамматический проход для всех вариантов одним запросом (JSON-массив туда и обратно).
+# Варианты, не прошедшие проверку формы ответа, обрабатываются поштучно.
+BATCH_GRAMMAR_PASS = True
+# Запас токенов на элемент JSON-массива сверх max_tokens одного варианта.
+BATCH_GRAMMAR_ITEM_OVERHEAD_TOKENS = 8
+_postprocess_limiter: Optional[asyncio.Semaphore] = None
+
+# Кэш ответов gpt()/gpt_multi() по (model, messages, temperature, n, max_tokens).
+# Вызовы с temperature выше порога по умолчанию идут мимо кэша — там важна
+# вариативность; явный cache=True/False в вызове перекрывает это правило.
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_LIMIT = 512
+RESPONSE_CACHE_TTL_SECONDS = 6 * 3600
+RESPONSE_CACHE_MAX_TEMPERATURE = 0.5
+RESPONSE_CACHE_DB: Optional[str] = "openai_response_cache.sqlite3"
+
+# Общий для процесса планировщик запросов к OpenAI: предел одновременных
+# запросов, бюджет запросов и токенов в минуту, приоритеты и повторы с учётом
+# Retry-After. Повторы SDK отключены — их делает планировщик.
+OPENAI_MAX_CONCURRENCY = 8
+OPENAI_REQUESTS_PER_MINUTE = 300
+OPENAI_TOKENS_PER_MINUTE = 150_000
+OPENAI_MAX_RETRIES = 4
+OPENAI_BACKOFF_BASE_SECONDS = 1.0
+OPENAI_BACKOFF_MAX_SECONDS = 30.0
+# Бюджет ответа для оценки токенов, если max_tokens не задан.
+OPENAI_DEFAULT_COMPLETION_TOKENS = 400
+
+# Меньше — важнее. Генерация вариантов для оператора идёт первой,
+# фоновое ранжирование медиа — последним.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_RECOMMENDATION = 1
+PRIORITY_BACKGROUND = 2
+
+# Бюджет токенов на историю переписки в промпте, по моделям. История режется
+# с самых старых сообщений; счётчики токенов кэшируются по тексту.
+PROMPT_HISTORY_TOKEN_BUDGETS: Dict[str, int] = {
+    "gpt-5": 2000,
+    "gpt-4.1": 2000,
+    "gpt-4.1-mini": 1500,
+    "gpt-4o": 1500,
+    "gpt-4o-mini": 1200,
+    "gpt-3.5-turbo": 800,
+}
+DEFAULT_HISTORY_TOKEN_BUDGET = 1000
+TOKEN_COUNT_CACHE_SIZE = 8192
+
+# Как часто (не чаще) generate_dating_ai_reply отдаёт черновики из стрима в on_progress.
+AI_STREAM_UPDATE_INTERVAL_SECONDS = 1.5
+
+
+def _get_postprocess_limiter() -> asyncio.Semaphore:
+    global _postprocess_limiter
+    if _postprocess_limiter is None:
+        _postprocess_limiter = asyncio.Semaphore(VARIANT_POSTPROCESS_CONCURRENCY)
+    return _postprocess_limiter
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=OPENAI_POOL_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            timeout=httpx.Timeout(
+                OPENAI_REQUEST_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS
+            ),
+            follow_redirects=True,
+        )
+    return _http_client
 
 
 def get_openai_client(api_key: Optional[str] = None) -> AsyncOpenAI:
     """
-    Возвращает singleton AsyncOpenAI-клиент.
+    Возвращает AsyncOpenAI-клиент для ключа (по одному на ключ, общий пул соединений).
     Ключ берётся либо из параметра, либо из переменной окружения OPENAI_API_KEY.
     """
-    global _openai_client, _cached_api_key
-
     api_key = api_key or os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise ValueError(
@@ -46,12 +167,602 @@ def get_openai_client(api_key: Optional[str] = None) -> AsyncOpenAI:
             "или передайте api_key в get_openai_client()."
         )
 
-    if _openai_client is None or _cached_api_key != api_key:
-        _openai_client = AsyncOpenAI(api_key=api_key)
-        _cached_api_key = api_key
-        logger.info("Создан новый AsyncOpenAI клиент.")
+    client = _openai_clients.get(api_key)
+    if client is None:
+        client = AsyncOpenAI(
+            api_key=api_key,
+            max_retries=0,
+            timeout=OPENAI_REQUEST_TIMEOUT_SECONDS,
+            http_client=_get_http_client(),
+        )
+        _openai_clients[api_key] = client
+        logger.info("Создан AsyncOpenAI клиент (ключей: %s).", len(_openai_clients))
+
+    return client
+
+
+async def close_openai_clients() -> None:
+    """Закрывает общий пул соединений; клиенты пересоздадутся при следующем вызове."""
+
+    global _http_client
+    _openai_clients.clear()
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+class _ResponseCache:
+    """LRU-кэш ответов в памяти с TTL и вторым уровнем в SQLite.
+
+    Промах в памяти проверяет диск и поднимает найденную запись обратно в LRU.
+    Обращения к SQLite выполняются в отдельном потоке (asyncio.to_thread),
+    чтобы не блокировать event loop. Ошибки диска логируются и считаются промахом.
+    """
+
+    def __init__(self, limit: int, ttl_seconds: float, path: Optional[str]) -> None:
+        self.limit = limit
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self._memory: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "stores": 0,
+            "evictions": 0,
+        }
+
+    @staticmethod
+    def make_key(kwargs: Dict[str, Any]) -> str:
+        material = {
+            "model": kwargs.get("model"),
+            "messages": kwargs.get("messages"),
+            "temperature": kwargs.get("temperature"),
+            "n": kwargs.get("n", 1),
+            "max_tokens": kwargs.get("max_tokens"),
+        }
+        raw = json.dumps(material, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        if self.path is None:
+            return None
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, payload TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+            self._conn = conn
+        return self._conn
+
+    def _remember(self, key: str, expires_at: float, value: List[str]) -> None:
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.limit:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _read_disk(self, key: str, now: float) -> Optional[Tuple[str, float]]:
+        try:
+            with self._db_lock:
+                conn = self._db()
+                if conn is None:
+                    return None
+                return conn.execute(
+                    "SELECT payload, expires_at FROM responses WHERE key = ? AND expires_at > ?",
+                    (key, now),
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Кэш ответов OpenAI: ошибка чтения: %s", e)
+            return None
+
+    def _write_disk(self, key: str, payload: str, expires_at: float) -> None:
+        try:
+            with self._db_lock:
+                conn = self._db()
+                if conn is not None:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                        (key, payload, expires_at),
+                    )
+        except sqlite3.Error as e:
+            logger.warning("Кэш ответов OpenAI: ошибка записи: %s", e)
+
+    async def get(self, key: str) -> Optional[List[str]]:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return list(entry[1])
+            del self._memory[key]
+
+        row = await asyncio.to_thread(self._read_disk, key, now) if self.path else None
+        if row is not None:
+            try:
+                value = [str(item) for item in json.loads(row[0])]
+            except (ValueError, TypeError):
+                value = None
+            if value:
+                self._remember(key, row[1], value)
+                self.stats["disk_hits"] += 1
+                return list(value)
+
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, value: List[str]) -> None:
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(key, expires_at, list(value))
+        self.stats["stores"] += 1
+        if self.path:
+            payload = json.dumps(value, ensure_ascii=False)
+            await asyncio.to_thread(self._write_disk, key, payload, expires_at)
+
+    def clear(self) -> None:
+        self._memory.clear()
+        try:
+            with self._db_lock:
+                conn = self._db()
+                if conn is not None:
+                    conn.execute("DELETE FROM responses")
+        except sqlite3.Error as e:
+            logger.warning("Кэш ответов OpenAI: ошибка очистки: %s", e)
+
+
+_response_cache = _ResponseCache(
+    RESPONSE_CACHE_LIMIT, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_DB
+)
+
+
+def response_cache_stats() -> Dict[str, int]:
+    """Счётчики попаданий/промахов кэша ответов OpenAI."""
+
+    stats = dict(_response_cache.stats)
+    stats["size"] = len(_response_cache._memory)
+    return stats
+
+
+def _cache_key_for(kwargs: Dict[str, Any], cache: Optional[bool]) -> Optional[str]:
+    """Ключ кэша для запроса или None, если запрос идёт мимо кэша."""
+
+    if not RESPONSE_CACHE_ENABLED or cache is False:
+        return None
+    # Модели без temperature работают с дефолтной 1.0 — это «горячий» вызов.
+    temperature = kwargs.get("temperature", 1.0)
+    if cache is None and temperature > RESPONSE_CACHE_MAX_TEMPERATURE:
+        _response_cache.stats["bypassed"] += 1
+        return None
+    return _ResponseCache.make_key(kwargs)
+
+
+class _OpenAIScheduler:
+    """Приоритетная очередь к OpenAI с лимитом параллельности и token bucket.
+
+    Ожидающие запросы выстраиваются по (priority, порядок поступления); запрос
+    получает слот, когда есть свободная параллельность и хватает бюджета
+    запросов/токенов на текущую минуту. После 429 с Retry-After выдача слотов
+    приостанавливается для всех до истечения паузы.
+    """
+
+    def __init__(
+        self,
+        concurrency: int,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+    ) -> None:
+        self.concurrency = max(1, concurrency)
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute)
+        self._request_level = self.request_capacity
+        self._token_level = self.token_capacity
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._active = 0
+        self._waiters: List[List[Any]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._wait_stats: Dict[int, List[float]] = {}
+        self.retries = 0
+        self.rate_limited = 0
+        self.hedged = 0
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        self._request_level = min(
+            self.request_capacity,
+            self._request_level + elapsed * self.request_capacity / 60.0,
+        )
+        self._token_level = min(
+            self.token_capacity,
+            self._token_level + elapsed * self.token_capacity / 60.0,
+        )
+
+    def _delay_for(self, tokens: float, now: float) -> float:
+        delay = self._paused_until - now
+        if self._request_level < 1:
+            delay = max(delay, (1 - self._request_level) * 60.0 / self.request_capacity)
+        need = min(tokens, self.token_capacity)
+        if self._token_level < need:
+            delay = max(delay, (need - self._token_level) * 60.0 / self.token_capacity)
+        return delay
+
+    def _pump(self) -> None:
+        self._wakeup = None
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters and self._active < self.concurrency:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._delay_for(tokens, now)
+            if delay > 0:
+                self._wakeup = asyncio.get_running_loop().call_later(delay, self._pump)
+                return
+            heapq.heappop(self._waiters)
+            self._request_level -= 1
+            self._token_level -= tokens
+            self._active += 1
+            future.set_result(None)
+
+    def _schedule_pump(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._pump()
+
+    async def acquire(self, priority: int, tokens: int) -> float:
+        """Ждёт слот; возвращает время ожидания в очереди (сек)."""
+
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future = loop.create_future()
+        started = time.monotonic()
+        heapq.heappush(self._waiters, [priority, next(self._seq), tokens, future])
+        self._schedule_pump()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(tokens, tokens)
+            raise
+        waited = time.monotonic() - started
+        stats = self._wait_stats.setdefault(priority, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        return waited
+
+    def release(self, estimated_tokens: int, used_tokens: Optional[int]) -> None:
+        self._active -= 1
+        if used_tokens is not None:
+            # Корректируем бюджет по фактическому расходу (может уйти в минус).
+            self._token_level += estimated_tokens - used_tokens
+        self._schedule_pump()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = {
+            priority: {
+                "count": int(count),
+                "avg_wait": round(total / count, 3) if count else 0.0,
+                "max_wait": round(peak, 3),
+            }
+            for priority, (count, total, peak) in sorted(self._wait_stats.items())
+        }
+        return {
+            "active": self._active,
+            "queued": sum(1 for entry in self._waiters if not entry[3].done()),
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "hedged": self.hedged,
+            "waits": waits,
+        }
+
+
+_openai_scheduler = _OpenAIScheduler(
+    OPENAI_MAX_CONCURRENCY, OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE
+)
+
+
+def openai_scheduler_stats() -> Dict[str, Any]:
+    """Очередь, активные запросы и время ожидания по приоритетам."""
+
+    return _openai_scheduler.stats()
+
+
+@lru_cache(maxsize=None)
+def _encoding_for(model: str) -> Any:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def _raw_token_count(text: str, model: str) -> int:
+    if not text:
+        return 0
+    if tiktoken is None:
+        return len(text) // 2 + 1
+    return len(_encoding_for(model).encode(text))
+
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """Число токенов в тексте (с кэшем по тексту); без tiktoken — оценка ~2 символа на токен."""
+
+    return _raw_token_count(text, model)
+
+
+def _truncate_to_tokens(text: str, model: str, limit: int) -> str:
+    if tiktoken is None:
+        return text[: limit * 2].rstrip() + "…"
+    encoding = _encoding_for(model)
+    return encoding.decode(encoding.encode(text)[:limit]).rstrip() + "…"
+
+
+def history_token_budget(model: str) -> int:
+    return PROMPT_HISTORY_TOKEN_BUDGETS.get(model, DEFAULT_HISTORY_TOKEN_BUDGET)
+
+
+def fit_history(
+    lines: Sequence[str],
+    model: str,
+    budget: Optional[int] = None,
+) -> List[str]:
+    """Самые свежие строки истории, укладывающиеся в бюджет токенов (в исходном порядке).
+
+    Последняя строка остаётся всегда: если она одна больше бюджета,
+    в промпт идёт её начало, обрезанное по бюджету.
+    """
+
+    budget = history_token_budget(model) if budget is None else budget
+    kept: List[str] = []
+    used = 0
+    for line in reversed(lines):
+        cost = count_tokens(line, model) + 1  # +1 за перевод строки
+        if used + cost > budget:
+            if not kept:
+                kept.append(_truncate_to_tokens(line, model, max(1, budget - 2)))
+            break
+        kept.append(line)
+        used += cost
+    if len(kept) < len(lines):
+        logger.debug(
+            "История обрезана под бюджет %s токенов: %s из %s строк",
+            budget,
+            len(kept),
+            len(lines),
+        )
+    kept.reverse()
+    return kept
+
+
+def _estimate_tokens(kwargs: Dict[str, Any]) -> int:
+    # Оценка для планировщика: токены промпта плюс бюджет ответа. Промпты
+    # почти всегда уникальны, поэтому считаются без кэша.
+    model = str(kwargs.get("model") or "gpt-4o")
+    prompt_tokens = sum(
+        _raw_token_count(str(m.get("content") or ""), model) for m in kwargs.get("messages", [])
+    )
+    completion = kwargs.get("max_tokens") or OPENAI_DEFAULT_COMPLETION_TOKENS
+    return prompt_tokens + completion * int(kwargs.get("n", 1))
+
+
+def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Пауза перед повтором или None, если ошибка не временная."""
+
+    if isinstance(error, APIStatusError):
+        status = error.status_code
+        if status not in {408, 409, 429} and status < 500:
+            return None
+        headers = getattr(error.response, "headers", None) or {}
+        retry_after_ms = headers.get("retry-after-ms")
+        retry_after = headers.get("retry-after")
+        try:
+            if retry_after_ms is not None:
+                return float(retry_after_ms) / 1000.0
+            if retry_after is not None:
+                return float(retry_after)
+        except ValueError:
+            pass
+    elif not isinstance(error, APIConnectionError):
+        return None
+    backoff = OPENAI_BACKOFF_BASE_SECONDS * (2 ** attempt)
+    return min(OPENAI_BACKOFF_MAX_SECONDS, backoff) * (0.5 + random.random() / 2)
+
+
+def _retry_or_raise(error: Exception, attempt: int) -> float:
+    """Учитывает повтор в планировщике и возвращает паузу; невременные ошибки пробрасывает."""
+
+    delay = _retry_delay(error, attempt)
+    if delay is None or attempt >= OPENAI_MAX_RETRIES:
+        raise error
+    if isinstance(error, APIStatusError) and error.status_code == 429:
+        _openai_scheduler.rate_limited += 1
+        _openai_scheduler.pause(delay)
+    _openai_scheduler.retries += 1
+    logger.warning(
+        "OpenAI: %s, повтор %s/%s через %.1fs",
+        error.__class__.__name__,
+        attempt + 1,
+        OPENAI_MAX_RETRIES,
+        delay,
+    )
+    return delay
+
+
+async def _attempt_completion(
+    client: AsyncOpenAI,
+    kwargs: Dict[str, Any],
+    *,
+    priority: int,
+    estimated: int,
+    deadline: float,
+) -> Any:
+    """Одна попытка: слот планировщика + запрос с таймаутом до дедлайна."""
+
+    waited = await _openai_scheduler.acquire(priority, estimated)
+    if waited > 1.0:
+        logger.debug(
+            "Запрос к OpenAI ждал в очереди %.2fs (priority=%s)", waited, priority
+        )
+    used: Optional[int] = None
+    try:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Истёк дедлайн запроса к OpenAI")
+        response = await client.chat.completions.create(
+            **kwargs, timeout=min(OPENAI_REQUEST_TIMEOUT_SECONDS, remaining)
+        )
+        usage = getattr(response, "usage", None)
+        used = getattr(usage, "total_tokens", None)
+        return response
+    finally:
+        _openai_scheduler.release(estimated, used)
+
+
+async def _first_successful(tasks: List[asyncio.Task]) -> Any:
+    """Результат первой успешной задачи; остальные отменяются."""
+
+    pending = set(tasks)
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error if error is not None else RuntimeError("Нет задач для hedged-запроса")
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _hedged_completion(
+    client: AsyncOpenAI,
+    kwargs: Dict[str, Any],
+    *,
+    priority: int,
+    estimated: int,
+    deadline: float,
+) -> Any:
+    def attempt() -> Awaitable[Any]:
+        return _attempt_completion(
+            client, kwargs, priority=priority, estimated=estimated, deadline=deadline
+        )
+
+    if OPENAI_HEDGE_AFTER_SECONDS is None or priority != PRIORITY_INTERACTIVE:
+        return await attempt()
+
+    primary = asyncio.create_task(attempt())
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=OPENAI_HEDGE_AFTER_SECONDS)
+    except asyncio.CancelledError:
+        primary.cancel()
+        raise
+    if done:
+        return primary.result()
+    _openai_scheduler.hedged += 1
+    logger.debug("OpenAI: нет ответа за %.1fs, отправляю hedged-запрос", OPENAI_HEDGE_AFTER_SECONDS)
+    return await _first_successful([primary, asyncio.create_task(attempt())])
+
+
+async def _create_completion(
+    client: AsyncOpenAI,
+    kwargs: Dict[str, Any],
+    *,
+    priority: int,
+) -> Any:
+    """chat.completions.create через общий планировщик: дедлайн, повторы, hedging."""
+
+    estimated = _estimate_tokens(kwargs)
+    deadline = time.monotonic() + OPENAI_CALL_DEADLINE_SECONDS
+    attempt = 0
+    while True:
+        try:
+            return await _hedged_completion(
+                client, kwargs, priority=priority, estimated=estimated, deadline=deadline
+            )
+        except (APIStatusError, APIConnectionError) as e:
+            delay = _retry_or_raise(e, attempt)
+            if time.monotonic() + delay >= deadline:
+                raise
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+async def _stream_completion(
+    client: AsyncOpenAI,
+    kwargs: Dict[str, Any],
+    *,
+    priority: int,
+) -> AsyncIterator[Any]:
+    """Стрим чанков через планировщик; слот держится, пока стрим читается.
+
+    Повторяется только открытие стрима — оборванный посреди ответа стрим
+    пробрасывает ошибку, чтобы не отдать вызывающему текст дважды.
+    Весь вызов, включая очередь, повторы и чтение, ограничен
+    OPENAI_CALL_DEADLINE_SECONDS.
+    """
+
+    estimated = _estimate_tokens(kwargs)
+    deadline = time.monotonic() + OPENAI_CALL_DEADLINE_SECONDS
 
-    return _openai_client
+    def remaining() -> float:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise TimeoutError("Истёк дедлайн запроса к OpenAI")
+        return left
+
+    attempt = 0
+    while True:
+        await _openai_scheduler.acquire(priority, estimated)
+        used: Optional[int] = None
+        stream: Any = None
+        try:
+            try:
+                stream = await client.chat.completions.create(
+                    **kwargs,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    timeout=min(OPENAI_REQUEST_TIMEOUT_SECONDS, remaining()),
+                )
+            except (APIStatusError, APIConnectionError) as e:
+                delay = _retry_or_raise(e, attempt)
+                if time.monotonic() + delay >= deadline:
+                    raise
+            else:
+                chunks = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), remaining())
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        raise TimeoutError("Истёк дедлайн запроса к OpenAI") from None
+                    usage = getattr(chunk, "usage", None)
+                    if usage is not None:
+                        used = getattr(usage, "total_tokens", None)
+                    yield chunk
+                return
+        finally:
+            if stream is not None:
+                await stream.close()
+            _openai_scheduler.release(estimated, used)
+        attempt += 1
+        await asyncio.sleep(delay)
 
 
 async def gpt(
@@ -61,10 +772,16 @@ async def gpt(
     api_key: Optional[str] = None,
     temperature: float = 1.0,
     max_tokens: Optional[int] = None,
+    usage_label: Optional[str] = None,
+    cache: Optional[bool] = None,
+    priority: int = PRIORITY_INTERACTIVE,
 ) -> str:
     """
     Базовая обёртка над Chat Completions API.
     Возвращает текст одного ответа.
+    Если задан usage_label, расход токенов запроса пишется в лог под этой меткой.
+    cache=None кэширует только «холодные» вызовы (см. RESPONSE_CACHE_MAX_TEMPERATURE).
+    priority — место в общей очереди к OpenAI (PRIORITY_*).
     """
     client = get_openai_client(api_key)
 
@@ -97,13 +814,22 @@ async def gpt(
     if max_tokens is not None:
         kwargs["max_tokens"] = max_tokens
 
+    cache_key = _cache_key_for(kwargs, cache)
+    if cache_key is not None:
+        cached = await _response_cache.get(cache_key)
+        if cached:
+            logger.debug("Ответ OpenAI взят из кэша: model=%s", model)
+            return cached[0]
+
     logger.debug(
         "Отправка запроса к OpenAI: model=%s, len(messages)=%s",
         model,
         len(messages),
     )
 
-    response = await client.chat.completions.create(**kwargs)
+    response = await _create_completion(client, kwargs, priority=priority)
+    if usage_label:
+        _log_usage(usage_label, response)
 
     if not response.choices:
         raise RuntimeError("Пустой ответ от OpenAI (choices=[])")
@@ -114,9 +840,26 @@ async def gpt(
 
     text = msg.content
     logger.debug("Ответ OpenAI (обрезано до 200 символов): %r", text[:200])
+    if cache_key is not None and text.strip():
+        await _response_cache.put(cache_key, [text])
     return text
 
 
+def _log_usage(label: str, response: Any) -> None:
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    logger.info(
+        "OpenAI usage [%s]: prompt=%s cached=%s completion=%s total=%s",
+        label,
+        getattr(usage, "prompt_tokens", None),
+        getattr(details, "cached_tokens", None),
+        getattr(usage, "completion_tokens", None),
+        getattr(usage, "total_tokens", None),
+    )
+
+
 async def gpt_multi(
     model: OpenAIModel,
     system_prompt: str,
@@ -125,10 +868,14 @@ async def gpt_multi(
     temperature: float = 1.0,
     max_tokens: Optional[int] = None,
     n: int = 3,
+    cache: Optional[bool] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    usage_label: Optional[str] = None,
 ) -> List[str]:
     """
     Обёртка над Chat Completions API.
     Возвращает список из n вариантов ответа.
+    cache, priority и usage_label — как в gpt().
     """
     client = get_openai_client(api_key)
 
@@ -163,6 +910,13 @@ async def gpt_multi(
     if max_tokens is not None:
         kwargs["max_tokens"] = max_tokens
 
+    cache_key = _cache_key_for(kwargs, cache)
+    if cache_key is not None:
+        cached = await _response_cache.get(cache_key)
+        if cached:
+            logger.debug("Multi-ответ OpenAI взят из кэша: model=%s, n=%s", model, n)
+            return cached
+
     logger.debug(
         "Отправка multi-запроса к OpenAI: model=%s, len(messages)=%s, n=%s",
         model,
@@ -170,7 +924,9 @@ async def gpt_multi(
         n,
     )
 
-    response = await client.chat.completions.create(**kwargs)
+    response = await _create_completion(client, kwargs, priority=priority)
+    if usage_label:
+        _log_usage(usage_label, response)
 
     if not response.choices:
         raise RuntimeError("Пустой ответ от OpenAI (choices=[])")
@@ -193,9 +949,71 @@ async def gpt_multi(
         "Multi-ответ OpenAI (первый обрезан до 200 символов): %r",
         texts[0][:200],
     )
+    if cache_key is not None:
+        await _response_cache.put(cache_key, texts)
     return texts
 
 
+async def gpt_stream(
+    model: OpenAIModel,
+    system_prompt: str,
+    user_prompt: str,
+    api_key: Optional[str] = None,
+    temperature: float = 1.0,
+    max_tokens: Optional[int] = None,
+    n: int = 1,
+    priority: int = PRIORITY_INTERACTIVE,
+    usage_label: Optional[str] = None,
+) -> AsyncIterator[Tuple[int, str, bool]]:
+    """
+    Стриминговый вариант gpt_multi().
+    Отдаёт (номер варианта, накопленный текст, вариант завершён) по мере прихода
+    чанков. Кэш не используется; usage_label — как в gpt().
+    """
+    client = get_openai_client(api_key)
+
+    messages = []
+    if model not in {"o1", "o1-mini"}:
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+    elif system_prompt:
+        logger.warning(
+            "Для модели %s system_prompt будет проигнорирован "
+            "из-за ограничений модели.",
+            model,
+        )
+    messages.append({"role": "user", "content": user_prompt})
+
+    kwargs: Dict[str, Any] = {
+        "model": model,
+        "messages": messages,
+        "n": max(1, int(n or 1)),
+    }
+    if model not in {"o1", "o1-mini", "gpt-5"} and temperature is not None:
+        kwargs["temperature"] = temperature
+    if max_tokens is not None:
+        kwargs["max_tokens"] = max_tokens
+
+    logger.debug(
+        "Отправка stream-запроса к OpenAI: model=%s, len(messages)=%s, n=%s",
+        model,
+        len(messages),
+        kwargs["n"],
+    )
+
+    texts: Dict[int, str] = {}
+    async for chunk in _stream_completion(client, kwargs, priority=priority):
+        if usage_label and getattr(chunk, "usage", None) is not None:
+            _log_usage(usage_label, chunk)
+        for choice in getattr(chunk, "choices", None) or []:
+            delta = getattr(getattr(choice, "delta", None), "content", None) or ""
+            if delta:
+                texts[choice.index] = texts.get(choice.index, "") + delta
+            finished = getattr(choice, "finish_reason", None) is not None
+            if delta or finished:
+                yield choice.index, texts.get(choice.index, ""), finished
+
+
 async def gpt_answer(
     prompt: str,
     system_prompt: str = DEFAULT_SYSTEM_PROMPT,
@@ -203,6 +1021,9 @@ async def gpt_answer(
     model: OpenAIModel = "gpt-5",
     temperature: float = 1.0,
     max_tokens: Optional[int] = None,
+    cache: Optional[bool] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    usage_label: Optional[str] = None,
 ) -> str:
     """
     Упрощённый вызов gpt(): только текст промпта и опциональный system_prompt.
@@ -214,6 +1035,9 @@ async def gpt_answer(
         api_key=api_key,
         temperature=temperature,
         max_tokens=max_tokens,
+        cache=cache,
+        priority=priority,
+        usage_label=usage_label,
     )
 
 
@@ -225,6 +1049,8 @@ async def gpt_answer_variants(
     temperature: float = 1.0,
     max_tokens: Optional[int] = None,
     n: int = 3,
+    cache: Optional[bool] = None,
+    priority: int = PRIORITY_INTERACTIVE,
 ) -> List[str]:
     """
     То же, что gpt_answer, но возвращает сразу несколько вариантов ответа.
@@ -237,9 +1063,70 @@ async def gpt_answer_variants(
         temperature=temperature,
         max_tokens=max_tokens,
         n=n,
+        cache=cache,
+        priority=priority,
     )
 
 
+_GRAMMAR_INSTRUCTIONS = (
+    "Добавь грамматические ошибки, но они должны быть неявными и разными по типу.\n "
+    "Используй скобочку только, если это требуется, не нужно создавать скобочку,')'. \n"
+    "Скобки ставятся только если действительно нужно пояснить или уточнить что-то в тексте, а не просто чтобы сделать предложение «живее» или «эмоциональнее». Если контекст не требует, скобки не нужны\n"
+    "Если скобочка не нужна и это вопрос, поставь знак вопроса. \n"
+    "Если в сообщении несколько предложений, все, кроме последнего, должны заканчиваться точкой. \n"
+    "Если в сообщении одно предложение, точку не ставить.\n\n"
+    "Когда ставить запятые:\n"
+    "— перед союзами а, но, однако, зато\n"
+    "— при однородных членах, если нет повторяющихся союзов \n"
+    "— при вводных словах \n"
+    "— при деепричастных оборотах \n"
+    "— при причастных оборотах после определяемого слова \n"
+    "— между частями сложносочинённого предложения\n"
+    "— между главным и придаточным в сложноподчинённом предложении \n"
+    "Когда не ставить запятые:\n"
+    "— между подлежащим и сказуемым \n"
+    "— между двумя сказуемыми без союза\n"
+    "— при одиночном деепричастии, ставшем наречием \n"
+    "— если причастный оборот стоит перед определяемым словом \n"
+    "— при устойчивых выражениях — зависит от контекста\n"
+    "Не используй заглавную букву как ошибку\n"
+)
+
+
+def _grammar_prompt(candidate: str) -> str:
+    return _GRAMMAR_INSTRUCTIONS + f"ТЕКСТ:\n\"{candidate}\""
+
+
+def _batched_grammar_prompt(candidates: Sequence[str]) -> str:
+    return (
+        _GRAMMAR_INSTRUCTIONS
+        + "\nПрименяй эти правила к каждому тексту из JSON-массива ниже отдельно.\n"
+        "Верни ТОЛЬКО JSON-массив строк той же длины и в том же порядке, без пояснений.\n"
+        f"ТЕКСТЫ:\n{json.dumps(list(candidates), ensure_ascii=False)}"
+    )
+
+
+def _parse_batched_grammar(raw: str, expected: int) -> List[Optional[str]]:
+    """Разбирает JSON-массив ответа; невалидные элементы возвращаются как None."""
+
+    body = (raw or "").strip()
+    if body.startswith("```"):
+        body = re.sub(r"^```[a-zA-Z]*\s*|\s*```$", "", body)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return [None] * expected
+    if not isinstance(data, list) or len(data) != expected:
+        return [None] * expected
+    parsed: List[Optional[str]] = []
+    for item in data:
+        if isinstance(item, str) and _strip_quotes(item.strip()):
+            parsed.append(_strip_quotes(item.strip()))
+        else:
+            parsed.append(None)
+    return parsed
+
+
 def _strip_quotes(text: str) -> str:
     """Удаляет кавычки из текста."""
     if not text:
@@ -255,12 +1142,254 @@ def _is_negative_reply(text: str) -> bool:
     return normalized == "нет"
 
 
-async def generate_dating_ai_variants(
+async def _rephrase_if_negative(
+    variant: Optional[str],
+    *,
+    text: str,
+    history_values_repr: str,
+    model: OpenAIModel,
+    api_key: Optional[str],
+    temperature: float,
+    max_tokens: Optional[int],
+) -> Optional[str]:
+    """Переформулирует голое «нет»; остальные варианты возвращает как есть."""
+
+    candidate = (variant or "").strip()
+    if not candidate or not _is_negative_reply(candidate):
+        return candidate or None
+
+    logger.debug("Обнаружен отрицательный ответ, выполняю переформулировку")
+    rephrase_prompt = (
+        "Отвечай только на русском языке.\n"
+        "Придумай текст, который предполагает не знание темы, вот текст, тема которого должна быть определена "
+        f"'{text}'"
+        "Пример ответа:\"Я не поняла про что ты говоришь\"\n"
+    )
+    if history_values_repr and history_values_repr != "[]":
+        rephrase_prompt += (
+            "Ответ не должен совпадать из каких либо сообщений из данных:\n"
+            f"{history_values_repr}"
+        )
+
+    async with _get_postprocess_limiter():
+        candidate = await gpt(
+            model=model,
+            system_prompt="Переформулируй текст",
+            user_prompt=rephrase_prompt,
+            api_key=api_key,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            usage_label="rephrase",
+        )
+    return (candidate or "").strip() or None
+
+
+async def _grammar_pass_single(
+    candidate: str,
+    *,
+    model: OpenAIModel,
+    api_key: Optional[str],
+    temperature: float,
+    max_tokens: Optional[int],
+) -> Optional[str]:
+    async with _get_postprocess_limiter():
+        result = await gpt(
+            model=model,
+            system_prompt="добавь ошибки в текст не меняя его структуру",
+            user_prompt=_grammar_prompt(candidate),
+            api_key=api_key,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            usage_label="grammar:single",
+        )
+    return _strip_quotes((result or "").strip()) or None
+
+
+async def _grammar_pass(
+    candidates: List[str],
+    *,
+    model: OpenAIModel,
+    api_key: Optional[str],
+    temperature: float,
+    max_tokens: Optional[int],
+    batched: bool,
+) -> List[Optional[str]]:
+    """Грамматический проход: один batched-запрос, с поштучным fallback для невалидных элементов."""
+
+    results: List[Optional[str]] = [None] * len(candidates)
+    pending = list(range(len(candidates)))
+    if batched and len(candidates) > 1:
+        # Ответ — JSON-массив из всех вариантов: бюджет одного варианта на
+        # каждый элемент плюс запас на кавычки, запятые и скобки.
+        batch_max_tokens = (
+            (max_tokens + BATCH_GRAMMAR_ITEM_OVERHEAD_TOKENS) * len(candidates)
+            if max_tokens is not None
+            else None
+        )
+        try:
+            async with _get_postprocess_limiter():
+                raw = await gpt(
+                    model=model,
+                    system_prompt="добавь ошибки в каждый текст не меняя его структуру",
+                    user_prompt=_batched_grammar_prompt(candidates),
+                    api_key=api_key,
+                    temperature=temperature,
+                    max_tokens=batch_max_tokens,
+                    usage_label=f"grammar:batch x{len(candidates)}",
+                )
+        except Exception as e:
+            logger.warning("Batched грамматический проход не удался: %s", e)
+        else:
+            results = _parse_batched_grammar(raw, len(candidates))
+            pending = [i for i, value in enumerate(results) if value is None]
+            if pending:
+                logger.info(
+                    "Batched грамматический проход: %s из %s элементов не прошли проверку, повторяю поштучно",
+                    len(pending),
+                    len(candidates),
+                )
+
+    singles = await asyncio.gather(
+        *(
+            _grammar_pass_single(
+                candidates[i],
+                model=model,
+                api_key=api_key,
+                temperature=temperature,
+                max_tokens=max_tokens,
+            )
+            for i in pending
+        ),
+        return_exceptions=True,
+    )
+    for i, single in zip(pending, singles):
+        if isinstance(single, BaseException):
+            logger.warning("Пост-обработка варианта #%s не удалась: %s", i + 1, single)
+            continue
+        results[i] = single
+    return results
+
+
+class _StageGraph:
+    """Мини-граф стадий: каждая стадия — asyncio-задача, ждущая своих зависимостей.
+
+    Независимые ветки идут параллельно. Результат run() — словарь
+    {стадия: результат или исключение}; упавшая зависимость передаёт своё
+    исключение зависящим стадиям.
+    """
+
+    def __init__(self) -> None:
+        self._stages: Dict[
+            str, Tuple[Tuple[str, ...], Callable[[Dict[str, Any]], Awaitable[Any]]]
+        ] = {}
+        self.timings: Dict[str, Tuple[float, float]] = {}
+
+    def add(
+        self,
+        name: str,
+        func: Callable[[Dict[str, Any]], Awaitable[Any]],
+        *,
+        after: Sequence[str] = (),
+    ) -> None:
+        missing = [dep for dep in after if dep not in self._stages]
+        if missing:
+            raise ValueError(f"Стадия {name}: неизвестные зависимости {missing}")
+        self._stages[name] = (tuple(after), func)
+
+    async def run(self) -> Dict[str, Any]:
+        origin = time.monotonic()
+        tasks: Dict[str, asyncio.Task] = {}
+
+        async def run_stage(name: str, deps: Tuple[str, ...], func: Callable) -> Any:
+            inputs = {dep: await tasks[dep] for dep in deps}
+            started = time.monotonic()
+            try:
+                return await func(inputs)
+            finally:
+                self.timings[name] = (started - origin, time.monotonic() - origin)
+
+        for name, (deps, func) in self._stages.items():
+            tasks[name] = asyncio.create_task(run_stage(name, deps, func))
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        return dict(zip(tasks, results))
+
+    def critical_path(self) -> List[Tuple[str, float]]:
+        """Цепочка зависимостей, закончившаяся последней, с длительностями стадий."""
+
+        finished = self.timings
+        if not finished:
+            return []
+        current: Optional[str] = max(finished, key=lambda name: finished[name][1])
+        path: List[Tuple[str, float]] = []
+        while current is not None:
+            start, end = finished[current]
+            path.append((current, end - start))
+            deps = [dep for dep in self._stages[current][0] if dep in finished]
+            current = max(deps, key=lambda dep: finished[dep][1]) if deps else None
+        path.reverse()
+        return path
+
+
+@dataclass
+class DatingAIReply:
+    variants: List[str]
+    media_suggestions: Optional[List[Dict[str, Any]]] = None
+    recommended_index: Optional[int] = None
+    recommendation_text: Optional[str] = None
+    timings: Dict[str, float] = field(default_factory=dict)
+    critical_path: List[str] = field(default_factory=list)
+
+
+def _finalize_variants(variants: Sequence[str], pad_to: int) -> List[str]:
+    """Чистит пустые и дубликаты; добивает до pad_to повтором последнего."""
+
+    cleaned: List[str] = []
+    for v in variants:
+        v = (v or "").strip()
+        if v and v not in cleaned:
+            cleaned.append(v)
+    while cleaned and len(cleaned) < pad_to:
+        cleaned.append(cleaned[-1])
+    return cleaned
+
+
+async def _suggest_media(
+    text: str,
+    history_lines: Sequence[str],
+    *,
+    api_key: Optional[str],
+    user_id: int,
+) -> Optional[List[Dict[str, Any]]]:
+    from media_recommender import get_media_recommender
+    recommender = get_media_recommender(user_id)
+    media_recs = await recommender.recommend_media(
+        text,
+        history_context=list(history_lines),
+        max_recommendations=2,
+        api_key=api_key
+    )
+    if not media_recs:
+        return None
+    return [
+        {
+            'file_path': rec.file_path,
+            'file_type': rec.file_type,
+            'relevance_score': rec.relevance_score,
+            'reason': rec.reason,
+            'filename': rec.metadata.get('filename', 'Неизвестный файл')
+        }
+        for rec in media_recs
+    ]
+
+
+async def generate_dating_ai_reply(
     text: str,
     *,
     history_lines: Sequence[str],
     history_texts: Sequence[str],
+    incoming_texts: Sequence[str] = (),
     profile: Optional[str] = None,
+    contact_name: Optional[str] = None,
     api_key: Optional[str] = None,
     model: OpenAIModel = "gpt-4o",
     temperature: float = 0.7,
@@ -268,8 +1397,26 @@ async def generate_dating_ai_variants(
     n: int = 3,
     include_media_suggestions: bool = False,
     user_id: Optional[int] = None,
-) -> Tuple[List[str], Optional[List[Dict[str, Any]]]]:
-    """Генерирует варианты ответов в стиле анкеты знакомств."""
+    recommend: bool = False,
+    recommendation_temperature: float = 0.4,
+    pad_variants: bool = False,
+    on_progress: Optional[Callable[[List[str], bool], Any]] = None,
+) -> DatingAIReply:
+    """Вся AI-стадия для входящего сообщения как граф зависимостей.
+
+    generate → rephrase → grammar [→ recommend] идут цепочкой, подбор медиа —
+    параллельно им. Ошибка генерации пробрасывается; ошибки медиа и
+    рекомендации логируются и дают пустой результат.
+
+    history_texts — тексты тех же сообщений, что и history_lines (без меток),
+    incoming_texts — входящие, на которые отвечаем; они не режутся бюджетом
+    истории. contact_name — имя собеседника из кэша профилей контактов.
+
+    Если задан on_progress, генерация идёт стримом: on_progress(черновики, False)
+    вызывается не чаще AI_STREAM_UPDATE_INTERVAL_SECONDS, а
+    on_progress(варианты, True) — сразу после пост-обработки, не дожидаясь
+    рекомендации и медиа.
+    """
 
     now = datetime.now()
     logger.info("Генерация AI-ответов для входящего сообщения: %s", text)
@@ -285,129 +1432,208 @@ async def generate_dating_ai_variants(
         "Во всех остальных случаях веди себя как обычный, простой собеседник девушка. "
     )
 
-    history_block = "\n".join(history_lines).strip()
+    # history_lines и history_texts параллельны (строка с меткой и её текст):
+    # режем один раз и берём те же индексы для обоих. Тексты входящих, на
+    # которые отвечаем, в бюджет истории не входят и идут всегда.
+    kept_lines = fit_history(history_lines, model)
+    first_kept = len(history_lines) - len(kept_lines)
+    kept_texts = [*history_texts[first_kept:len(history_lines)], *incoming_texts]
+    history_block = "\n".join(kept_lines).strip()
     if history_block:
         history_block = f"{history_block}\n"
 
+    contact_block = ""
+    if contact_name and contact_name.strip():
+        contact_block = f"Собеседника зовут: {contact_name.strip()}\n\n"
+
+    # Статичное (system, описание, растущая история) — в начале, изменчивое
+    # (дата, последнее сообщение) — в конце: префикс совпадает между вызовами
+    # по одному чату и попадает в кэш промптов на стороне провайдера.
     prompt = (
-        f"сейчас {now.day:02d} число, {now.month:02d} месяца, {now.year} года\n"
-        f"\nТвое описание: \n{(profile or 'Описание профиля не указано.').strip()}\n\n"
+        f"Твое описание: \n{(profile or 'Описание профиля не указано.').strip()}\n\n"
+        f"{contact_block}"
         "История сообщений ниже\n'Я:'- Твои сообщения, 'Он:' -  сообщения собеседника \n"
         f"{history_block}"
+        f"\nсейчас {now.day:02d} число, {now.month:02d} месяца, {now.year} года\n"
         f"Последнее сообщение пользователя: {text}"
     )
 
-    raw_variants = await gpt_multi(
-        model=model,
-        system_prompt=sys_prompt,
-        user_prompt=prompt,
-        api_key=api_key,
-        temperature=temperature,
-        max_tokens=max_tokens,
-        n=n,
-    )
-
-    history_values_repr = repr(list(history_texts))
-    processed: List[str] = []
+    history_values_repr = repr(kept_texts)
+    graph = _StageGraph()
 
-    for variant in raw_variants:
-        candidate = (variant or "").strip()
-        if not candidate:
-            continue
-
-        if _is_negative_reply(candidate):
-            logger.debug("Обнаружен отрицательный ответ, выполняю переформулировку")
-            rephrase_prompt = (
-                "Отвечай только на русском языке.\n"
-                "Придумай текст, который предполагает не знание темы, вот текст, тема которого должна быть определена "
-                f"'{text}'"
-                "Пример ответа:\"Я не поняла про что ты говоришь\"\n"
-            )
-            if history_values_repr and history_values_repr != "[]":
-                rephrase_prompt += (
-                    "Ответ не должен совпадать из каких либо сообщений из данных:\n"
-                    f"{history_values_repr}"
-                )
+    def report(variants: List[str], final: bool) -> None:
+        try:
+            on_progress(variants, final)
+        except Exception as e:
+            logger.warning("Ошибка в on_progress AI-стадии: %s", e)
 
-            candidate = await gpt(
+    async def generate_stage(_: Dict[str, Any]) -> List[str]:
+        if on_progress is None:
+            return await gpt_multi(
                 model=model,
-                system_prompt="Переформулируй текст",
-                user_prompt=rephrase_prompt,
+                system_prompt=sys_prompt,
+                user_prompt=prompt,
                 api_key=api_key,
                 temperature=temperature,
                 max_tokens=max_tokens,
+                n=n,
+                usage_label="generate",
             )
-            candidate = (candidate or "").strip()
-
-        if not candidate:
-            continue
 
-        grammar_prompt = (
-            "Добавь грамматические ошибки, но они должны быть неявными и разными по типу.\n "
-            "Используй скобочку только, если это требуется, не нужно создавать скобочку,')'. \n"
-            "Скобки ставятся только если действительно нужно пояснить или уточнить что-то в тексте, а не просто чтобы сделать предложение «живее» или «эмоциональнее». Если контекст не требует, скобки не нужны\n"
-            "Если скобочка не нужна и это вопрос, поставь знак вопроса. \n"
-            "Если в сообщении несколько предложений, все, кроме последнего, должны заканчиваться точкой. \n"
-            "Если в сообщении одно предложение, точку не ставить.\n\n"
-            "Когда ставить запятые:\n"
-            "— перед союзами а, но, однако, зато\n"
-            "— при однородных членах, если нет повторяющихся союзов \n"
-            "— при вводных словах \n"
-            "— при деепричастных оборотах \n"
-            "— при причастных оборотах после определяемого слова \n"
-            "— между частями сложносочинённого предложения\n"
-            "— между главным и придаточным в сложноподчинённом предложении \n"
-            "Когда не ставить запятые:\n"
-            "— между подлежащим и сказуемым \n"
-            "— между двумя сказуемыми без союза\n"
-            "— при одиночном деепричастии, ставшем наречием \n"
-            "— если причастный оборот стоит перед определяемым словом \n"
-            "— при устойчивых выражениях — зависит от контекста\n"
-            "Не используй заглавную букву как ошибку\n"
-            f"ТЕКСТ:\n\"{candidate}\""
+        drafts: Dict[int, str] = {}
+        reported_at = 0.0
+        async for index, partial, finished in gpt_stream(
+            model=model,
+            system_prompt=sys_prompt,
+            user_prompt=prompt,
+            api_key=api_key,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            n=n,
+            usage_label="generate:stream",
+        ):
+            drafts[index] = partial
+            now_ts = time.monotonic()
+            if finished or now_ts - reported_at >= AI_STREAM_UPDATE_INTERVAL_SECONDS:
+                reported_at = now_ts
+                report([drafts[i] for i in sorted(drafts)], False)
+        texts = [drafts[i].strip() for i in sorted(drafts) if drafts[i].strip()]
+        if not texts:
+            raise RuntimeError("Все варианты от OpenAI пустые.")
+        return texts
+
+    async def rephrase_stage(inputs: Dict[str, Any]) -> List[str]:
+        rephrased = await asyncio.gather(
+            *(
+                _rephrase_if_negative(
+                    variant,
+                    text=text,
+                    history_values_repr=history_values_repr,
+                    model=model,
+                    api_key=api_key,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                )
+                for variant in inputs["generate"]
+            ),
+            return_exceptions=True,
         )
-
-        candidate = await gpt(
+        candidates: List[str] = []
+        for index, result in enumerate(rephrased):
+            if isinstance(result, BaseException):
+                logger.warning("Переформулировка варианта #%s не удалась: %s", index + 1, result)
+                continue
+            if result:
+                candidates.append(result)
+        return candidates
+
+    async def grammar_stage(inputs: Dict[str, Any]) -> List[str]:
+        graded = await _grammar_pass(
+            inputs["rephrase"],
             model=model,
-            system_prompt="добавь ошибки в текст не меняя его структуру",
-            user_prompt=grammar_prompt,
             api_key=api_key,
             temperature=temperature,
             max_tokens=max_tokens,
+            batched=BATCH_GRAMMAR_PASS,
+        )
+        processed = [value for value in graded if value]
+        if pad_variants:
+            processed = _finalize_variants(processed, n)
+        if on_progress is not None and processed:
+            report(processed, True)
+        return processed
+
+    async def recommend_stage(inputs: Dict[str, Any]) -> Tuple[Optional[int], Optional[str]]:
+        if not inputs["grammar"]:
+            return None, None
+        return await recommend_dating_ai_variant(
+            incoming_text=text,
+            variants=inputs["grammar"],
+            history_lines=history_lines,
+            profile=profile,
+            api_key=api_key,
+            model=model,
+            temperature=recommendation_temperature,
         )
-        candidate = _strip_quotes((candidate or "").strip())
 
-        if candidate:
-            processed.append(candidate)
+    async def media_stage(_: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        return await _suggest_media(text, history_lines, api_key=api_key, user_id=user_id)
 
-    # Рекомендации медиафайлов
-    media_suggestions = None
+    graph.add("generate", generate_stage)
+    graph.add("rephrase", rephrase_stage, after=("generate",))
+    graph.add("grammar", grammar_stage, after=("rephrase",))
+    if recommend:
+        graph.add("recommend", recommend_stage, after=("grammar",))
     if include_media_suggestions and user_id is not None:
-        try:
-            from media_recommender import get_media_recommender
-            recommender = get_media_recommender(user_id)
-            media_recs = await recommender.recommend_media(
-                text,
-                history_context=list(history_lines),
-                max_recommendations=2,
-                api_key=api_key
-            )
+        graph.add("media", media_stage)
 
-            if media_recs:
-                media_suggestions = []
-                for rec in media_recs:
-                    media_suggestions.append({
-                        'file_path': rec.file_path,
-                        'file_type': rec.file_type,
-                        'relevance_score': rec.relevance_score,
-                        'reason': rec.reason,
-                        'filename': rec.metadata.get('filename', 'Неизвестный файл')
-                    })
+    results = await graph.run()
 
-        except Exception as e:
-            logger.warning(f"Ошибка при получении рекомендаций медиа: {e}")
+    variants = results["grammar"]
+    if isinstance(variants, BaseException):
+        raise variants
+    reply = DatingAIReply(variants=variants)
 
-    return processed, media_suggestions
+    media = results.get("media")
+    if isinstance(media, BaseException):
+        logger.warning(f"Ошибка при получении рекомендаций медиа: {media}")
+    else:
+        reply.media_suggestions = media
+
+    recommendation = results.get("recommend")
+    if isinstance(recommendation, BaseException):
+        logger.debug("Не удалось получить рекомендацию варианта: %s", recommendation)
+    elif recommendation is not None:
+        reply.recommended_index, reply.recommendation_text = recommendation
+
+    reply.timings = {
+        name: round(end - start, 3) for name, (start, end) in graph.timings.items()
+    }
+    path = graph.critical_path()
+    reply.critical_path = [name for name, _ in path]
+    logger.info(
+        "AI-стадия: %.2fs, критический путь: %s, стадии: %s",
+        max((end for _, end in graph.timings.values()), default=0.0),
+        " → ".join(f"{name} {duration:.2f}s" for name, duration in path),
+        reply.timings,
+    )
+    return reply
+
+
+async def generate_dating_ai_variants(
+    text: str,
+    *,
+    history_lines: Sequence[str],
+    history_texts: Sequence[str],
+    incoming_texts: Sequence[str] = (),
+    profile: Optional[str] = None,
+    contact_name: Optional[str] = None,
+    api_key: Optional[str] = None,
+    model: OpenAIModel = "gpt-4o",
+    temperature: float = 0.7,
+    max_tokens: Optional[int] = None,
+    n: int = 3,
+    include_media_suggestions: bool = False,
+    user_id: Optional[int] = None,
+) -> Tuple[List[str], Optional[List[Dict[str, Any]]]]:
+    """Генерирует варианты ответов в стиле анкеты знакомств."""
+
+    reply = await generate_dating_ai_reply(
+        text,
+        history_lines=history_lines,
+        history_texts=history_texts,
+        incoming_texts=incoming_texts,
+        profile=profile,
+        contact_name=contact_name,
+        api_key=api_key,
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        n=n,
+        include_media_suggestions=include_media_suggestions,
+        user_id=user_id,
+    )
+    return reply.variants, reply.media_suggestions
 
 
 async def recommend_dating_ai_variant(
@@ -427,7 +1653,7 @@ async def recommend_dating_ai_variant(
     if len(clean_variants) < 1:
         return None, None
 
-    history_block = "\n".join(history_lines).strip()
+    history_block = "\n".join(fit_history(history_lines, model)).strip()
     if history_block:
         history_block = (
             "История переписки (от старых сообщений к новым):\n"
@@ -439,15 +1665,16 @@ async def recommend_dating_ai_variant(
 
     profile_text = (profile or "Описание профиля не указано.").strip()
 
+    # Неизменные инструкции идут первыми, чтобы префикс промпта кэшировался
     user_prompt = (
         "Ты помогаешь оператору переписки девушки выбрать лучший ответ на сообщение потенциального парня.\n"
+        "Рекомендации должны быть такие, чтобы максимально близиться с человеком, для того, чтобы получить его доверие максимально быстро, максимально скорее, более того, рассуждения нужны либо после одного большого предложения со смыслом, либо после пары предложений, ну тоже как бы со смыслом.\n"
+        "Ответь на русском языке. Сформулируй рекомендацию в одном или двух предложениях. В первом предложении однозначно укажи номер рекомендуемого варианта в формате «Рекомендую вариант 2 …».\n\n"
         f"Описание девушки: {profile_text}\n"
-        f"Входящее сообщение от собеседника: {incoming_text}\n\n"
         f"{history_block}"
+        f"Входящее сообщение от собеседника: {incoming_text}\n\n"
         "Варианты ответов девушки:\n"
-        f"{variants_block}\n\n"
-        "Рекомендации должны быть такие, чтобы максимально близиться с человеком, для того, чтобы получить его доверие максимально быстро, максимально скорее, более того, рассуждения нужны либо после одного большого предложения со смыслом, либо после пары предложений, ну тоже как бы со смыслом.\n"
-        "Ответь на русском языке. Сформулируй рекомендацию в одном или двух предложениях. В первом предложении однозначно укажи номер рекомендуемого варианта в формате «Рекомендую вариант 2 …»."
+        f"{variants_block}"
     )
 
     recommendation_text = await gpt(
@@ -459,6 +1686,8 @@ async def recommend_dating_ai_variant(
         api_key=api_key,
         temperature=temperature,
         max_tokens=max_tokens,
+        priority=PRIORITY_RECOMMENDATION,
+        usage_label="recommend",
     )
 
     recommendation_text = (recommendation_text or "").strip()
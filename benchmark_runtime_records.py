@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк памяти runtime-записей на одно входящее сообщение.
+
+Сравнивает прежнее представление (dict в reply_contexts, обычные dataclass
+без __slots__, отдельные строки телефона) с текущими slotted-записями из
+tg_manager_bot_dynamic. Запуск: python benchmark_runtime_records.py [N]
+"""
+
+import gc
+import sys
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import tg_manager_bot_dynamic as bot
+
+PHONE = "+79990001122"
+OWNER_ID = 8412294171
+
+
+@dataclass
+class LegacyPendingAIReply:
+    owner_id: int
+    phone: str
+    peer_id: int
+    msg_id: int
+    incoming_text: str
+    suggested_variants: List[str]
+    chosen_index: int = -1
+    recommended_index: Optional[int] = None
+    recommendation_text: Optional[str] = None
+    reply_to_source: bool = True
+    media_suggestions: Optional[List[Dict[str, Any]]] = None
+
+
+@dataclass
+class LegacyThreadState:
+    message_id: int
+    thread_id: str
+    ctx_id: str
+    bullets: List[str]
+    header_lines: List[str]
+    history_html: str
+    history_collapsed: bool = True
+    peer: Optional[Any] = None
+    ai_block: Optional[str] = None
+    ai_buttons: Optional[List[Any]] = None
+
+
+def _phone_copy() -> str:
+    # телефон, прочитанный из JSON/события, — отдельный объект на каждую запись
+    return "".join(PHONE)
+
+
+def build_legacy(count: int) -> List[Any]:
+    records: List[Any] = []
+    for i in range(count):
+        header = [f"👤 Аккаунт: <b>{PHONE}</b>", f"ID Собеседника: {i}"]
+        records.append(
+            {
+                "owner_id": OWNER_ID,
+                "phone": _phone_copy(),
+                "chat_id": 1000 + i,
+                "sender_id": 1000 + i,
+                "peer": None,
+                "msg_id": i,
+            }
+        )
+        records.append(
+            LegacyPendingAIReply(
+                OWNER_ID, _phone_copy(), 1000 + i, i, "привет", ["a", "b", "c"]
+            )
+        )
+        records.append(
+            LegacyThreadState(i, f"{PHONE}:{1000 + i}", "ctx", ["• привет"], list(header), "")
+        )
+    return records
+
+
+def build_current(count: int) -> List[Any]:
+    records: List[Any] = []
+    for i in range(count):
+        header = [f"👤 Аккаунт: <b>{PHONE}</b>", f"ID Собеседника: {i}"]
+        records.append(
+            bot.ReplyContext(OWNER_ID, _phone_copy(), 1000 + i, 1000 + i, None, i)
+        )
+        records.append(
+            bot.PendingAIReply(
+                OWNER_ID, sys.intern(_phone_copy()), 1000 + i, i, "привет", ["a", "b", "c"]
+            )
+        )
+        records.append(
+            bot._NotificationThreadState(i, f"{PHONE}:{1000 + i}", "ctx", ["• привет"], header, "")
+        )
+    return records
+
+
+def measure(builder, count: int) -> float:
+    gc.collect()
+    tracemalloc.start()
+    records = builder(count)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return current / count
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    legacy = measure(build_legacy, count)
+    current = measure(build_current, count)
+    print(f"Сообщений: {count}")
+    print(f"  до:    {legacy:8.0f} байт на сообщение")
+    print(f"  после: {current:8.0f} байт на сообщение")
+    print(f"  экономия: {100 * (1 - current / legacy):.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,37 @@ from typing import List, Dict, Optional, Tuple, Any
 from pathlib import Path
 from dataclasses import dataclass
 
-from OpenAi_helper import gpt_answer, OpenAIModel
+from OpenAi_helper import PRIORITY_BACKGROUND, fit_history, gpt_answer, OpenAIModel
 
 logger = logging.getLogger(__name__)
 
+RANKING_MODEL = "gpt-4o-mini"
+# Бюджет токенов на историю переписки в промпте ранжирования
+RANKING_HISTORY_TOKEN_BUDGET = 300
+
+# Неизменная часть промпта ранжирования — идёт первой, чтобы префикс
+# кэшировался на стороне провайдера.
+RANKING_INSTRUCTIONS = """
+Ты помогаешь выбрать подходящие медиафайлы для ответа в переписке девушки с парнем.
+
+ПРАВИЛА ВЫБОРА:
+1. На ВОПРОС пользователя предлагай ОТВЕТЫ, а не новые вопросы
+2. На УТВЕРЖДЕНИЕ можно предложить благодарность или вопрос для продолжения
+3. Избегай предлагать вопросы в ответ на вопросы
+4. Выбирай файлы, релевантные по темам и контенту
+
+Для КАЖДОГО выбранного файла укажи:
+1. Номер файла
+2. Оценку релевантности (0.0-1.0, где 1.0 - идеально подходит)
+3. КРАТКУЮ причину выбора (почему именно этот файл подходит для этого сообщения)
+
+Формат ответа:
+Файл X: оценка - причина
+Файл Y: оценка - причина
+
+Если ни один файл не подходит, укажи "Нет подходящих файлов"
+"""
+
 @dataclass
 class MediaRecommendation:
     """Рекомендация медиафайла для ответа"""
@@ -363,36 +390,20 @@ class MediaRecommender:
         # Определяем что нужно для ответа
         response_type_needed = "ответы/утверждения" if context['is_question'] else "вопросы или благодарности"
 
-        prompt = f"""
-Ты помогаешь выбрать подходящие медиафайлы для ответа в переписке девушки с парнем.
-
+        history_lines = fit_history(history, RANKING_MODEL, RANKING_HISTORY_TOKEN_BUDGET)
+        prompt = RANKING_INSTRUCTIONS + f"""
 КОНТЕКСТ СООБЩЕНИЯ:
 - Сообщение пользователя: "{message}"
 - Это {'ВОПРОС' if context['is_question'] else 'УТВЕРЖДЕНИЕ'}
 - Нам нужны: {response_type_needed}
 
-ПРАВИЛА ВЫБОРА:
-1. На ВОПРОС пользователя предлагай ОТВЕТЫ, а не новые вопросы
-2. На УТВЕРЖДЕНИЕ можно предложить благодарность или вопрос для продолжения
-3. Избегай предлагать вопросы в ответ на вопросы
-4. Выбирай файлы, релевантные по темам и контенту
-
 История переписки (последние сообщения):
-{chr(10).join(history[-3:]) if history else "Нет истории"}
+{chr(10).join(history_lines) if history_lines else "Нет истории"}
 
 ДОСТУПНЫЕ ФАЙЛЫ:
 {chr(10).join(file_descriptions)}
 
-ВЫБЕРИ до {max_recommendations} наиболее подходящих файлов. Для КАЖДОГО укажи:
-1. Номер файла
-2. Оценку релевантности (0.0-1.0, где 1.0 - идеально подходит)
-3. КРАТКУЮ причину выбора (почему именно этот файл подходит для этого сообщения)
-
-Формат ответа:
-Файл X: оценка - причина
-Файл Y: оценка - причина
-
-Если ни один файл не подходит, укажи "Нет подходящих файлов"
+ВЫБЕРИ до {max_recommendations} наиболее подходящих файлов.
 """
 
         try:
@@ -400,8 +411,10 @@ class MediaRecommender:
                 prompt,
                 system_prompt="Ты эксперт по выбору медиафайлов для романтической переписки. Всегда учитывай контекст и избегай логических ошибок.",
                 api_key=api_key,
-                model="gpt-4o-mini",
-                temperature=0.2  # Более детерминированные ответы
+                model=RANKING_MODEL,
+                temperature=0.2,  # Более детерминированные ответы
+                priority=PRIORITY_BACKGROUND,
+                usage_label="media_rank",
             )
 
             if "Нет подходящих файлов" in ai_response:
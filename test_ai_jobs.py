@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Тесты замены AI-генерации: новое сообщение отменяет незавершённую генерацию
+и склеивается с её сообщениями, показанные варианты не трогаются.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import tg_manager_bot_dynamic as bot
+from OpenAi_helper import DatingAIReply
+
+OWNER_ID = 1001
+PHONE = "+70000000000"
+CHAT_ID = 42
+
+
+class FakeGenerator:
+    """Подменяет generate_dating_ai_reply: каждый вызов ждёт release().
+
+    С deliver_early варианты показываются сразу, а генерация продолжается
+    (как рекомендация и медиа после показа вариантов).
+    """
+
+    def __init__(self, deliver_early: bool = False):
+        self.deliver_early = deliver_early
+        self.calls = []
+        self.cancelled = 0
+        self._gates = []
+
+    async def __call__(self, user_text, **kwargs):
+        gate = asyncio.Event()
+        self.calls.append((user_text, kwargs))
+        self._gates.append(gate)
+        on_progress = kwargs.get("on_progress")
+        variants = [f"ответ {len(self.calls)}"]
+        if self.deliver_early and on_progress is not None:
+            on_progress(variants, True)
+        try:
+            await gate.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if not self.deliver_early and on_progress is not None:
+            on_progress(variants, True)
+        return DatingAIReply(variants=variants)
+
+    def release(self, index: int) -> None:
+        self._gates[index].set()
+
+
+def _worker():
+    return SimpleNamespace(
+        owner_id=OWNER_ID,
+        phone=PHONE,
+        client=None,
+        contact_profiles=bot._ContactProfileCache(),
+    )
+
+
+def _event(msg_id: int, text: str):
+    return SimpleNamespace(
+        id=msg_id,
+        chat_id=CHAT_ID,
+        sender_id=CHAT_ID,
+        raw_text=text,
+        out=False,
+        is_private=True,
+    )
+
+
+async def _run(fake: FakeGenerator, scenario) -> None:
+    saved = (bot.generate_dating_ai_reply, bot.get_account_meta)
+    bot.generate_dating_ai_reply = fake
+    bot.get_account_meta = lambda owner_id, phone: {}
+    try:
+        await scenario()
+    finally:
+        bot.generate_dating_ai_reply, bot.get_account_meta = saved
+        bot._ai_jobs.pop((OWNER_ID, PHONE, CHAT_ID), None)
+        for task_id in [k for k in bot.pending_ai_replies if k.startswith(f"{OWNER_ID}:")]:
+            del bot.pending_ai_replies[task_id]
+
+
+async def _until(predicate) -> None:
+    for _ in range(100):
+        if predicate():
+            return
+        await asyncio.sleep(0)
+    raise AssertionError("условие не выполнилось")
+
+
+def test_new_message_supersedes_running_job():
+    """Второе сообщение отменяет первую генерацию и попадает в промпт вместе с ней"""
+
+    fake = FakeGenerator()
+
+    async def scenario():
+        worker = _worker()
+        first = asyncio.create_task(bot.handle_ai_autoreply(worker, _event(1, "привет"), None))
+        await _until(lambda: len(fake.calls) == 1)
+
+        second = asyncio.create_task(bot.handle_ai_autoreply(worker, _event(2, "ты тут?"), None))
+        await _until(lambda: len(fake.calls) == 2)
+        assert await first is None
+        assert fake.cancelled == 1
+
+        user_text, kwargs = fake.calls[1]
+        assert user_text == "привет\nты тут?"
+        assert kwargs["incoming_texts"] == ["привет", "ты тут?"]
+        assert bot._ai_jobs[(OWNER_ID, PHONE, CHAT_ID)].msg_ids == [1, 2]
+
+        fake.release(1)
+        task_id = await second
+        assert task_id == f"{OWNER_ID}:{PHONE}:{CHAT_ID}:2"
+        assert bot.pending_ai_replies[task_id].incoming_text == "привет\nты тут?"
+        assert (OWNER_ID, PHONE, CHAT_ID) not in bot._ai_jobs
+
+    asyncio.run(_run(fake, scenario))
+    print("замена генерации: ok")
+
+
+def test_delivered_job_is_not_superseded():
+    """После показа вариантов новое сообщение не отменяет генерацию"""
+
+    fake = FakeGenerator(deliver_early=True)
+
+    async def scenario():
+        worker = _worker()
+        shown = []
+        first = asyncio.create_task(
+            bot.handle_ai_autoreply(
+                worker,
+                _event(1, "привет"),
+                None,
+                on_progress=lambda task_id, variants: shown.append(task_id),
+            )
+        )
+        await _until(lambda: shown)
+        assert not first.done()
+
+        second = asyncio.create_task(bot.handle_ai_autoreply(worker, _event(2, "ты тут?"), None))
+        await _until(lambda: len(fake.calls) == 2)
+        assert fake.calls[1][0] == "ты тут?"
+        assert fake.cancelled == 0
+
+        fake.release(0)
+        fake.release(1)
+        assert await first == f"{OWNER_ID}:{PHONE}:{CHAT_ID}:1"
+        assert await second == f"{OWNER_ID}:{PHONE}:{CHAT_ID}:2"
+
+    asyncio.run(_run(fake, scenario))
+    print("показанные варианты: ok")
+
+
+if __name__ == "__main__":
+    test_new_message_supersedes_running_job()
+    test_delivered_job_is_not_superseded()
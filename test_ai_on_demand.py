@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Тесты генерации по кнопке: выбор режима, кнопка «Сгенерировать» запускает
+одну генерацию, повторное нажатие берёт готовые варианты без запроса.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import tg_manager_bot_dynamic as bot
+
+ADMIN_ID = 1001
+PHONE = "+70000000000"
+CHAT_ID = 42
+MSG_ID = 7
+THREAD_ID = f"{PHONE}:{CHAT_ID}"
+TASK_ID = f"{ADMIN_ID}:{PHONE}:{CHAT_ID}:{MSG_ID}"
+
+
+class FakeWorker:
+    """Воркер аккаунта: отдаёт сообщение и ждёт release() в run_ai_stage."""
+
+    def __init__(self):
+        self.fetched = 0
+        self.stages = []
+        self.gate = asyncio.Event()
+        self.client = SimpleNamespace(get_messages=self.get_messages)
+
+    async def get_messages(self, peer, ids):
+        self.fetched += 1
+        return SimpleNamespace(id=ids, chat_id=CHAT_ID, raw_text="привет", out=False, is_private=True)
+
+    async def run_ai_stage(self, ev, peer, *, thread_id, ctx_id):
+        self.stages.append((ev.id, thread_id, ctx_id))
+        await self.gate.wait()
+
+
+class FakeCallback:
+    def __init__(self, data: str):
+        self.sender_id = ADMIN_ID
+        self.data = data.encode()
+        self.answers = []
+
+    async def answer(self, *args, **kwargs):
+        self.answers.append(args[0] if args else None)
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+async def _run(worker: FakeWorker, scenario) -> None:
+    names = (
+        "is_admin",
+        "cancel_operations",
+        "ensure_menu_button_hidden",
+        "ensure_worker_running",
+        "schedule_notification_refresh",
+    )
+    saved = {name: getattr(bot, name) for name in names}
+
+    async def ensure_worker_running(owner_id, phone):
+        return worker
+
+    bot.is_admin = lambda user_id: True
+    bot.cancel_operations = _noop
+    bot.ensure_menu_button_hidden = _noop
+    bot.ensure_worker_running = ensure_worker_running
+    bot.schedule_notification_refresh = lambda admin_id, thread_id: None
+    bot.notification_threads[ADMIN_ID][THREAD_ID] = bot._NotificationThreadState(
+        message_id=100,
+        thread_id=THREAD_ID,
+        ctx_id="ctx",
+        bullets=[],
+        header_lines=["заголовок"],
+        history_html="",
+    )
+    try:
+        await scenario()
+    finally:
+        for name, value in saved.items():
+            setattr(bot, name, value)
+        bot.notification_threads.pop(ADMIN_ID, None)
+        bot.pending_ai_replies.pop(TASK_ID, None)
+        bot._ai_on_demand_inflight.discard(TASK_ID)
+        bot._ai_usage.pop(ADMIN_ID, None)
+
+
+def test_ai_mode_account_override():
+    """Режим аккаунта важнее режима тенанта, сброс возвращает режим тенанта"""
+
+    tenant = {"ai_mode": bot.AI_MODE_ON_DEMAND}
+    accounts = {PHONE: {"phone": PHONE}}
+    saved = (bot.get_tenant, bot.get_account_meta, bot.ensure_account_meta, bot.persist_tenants)
+    bot.get_tenant = lambda owner_id: tenant
+    bot.get_account_meta = lambda owner_id, phone: accounts.get(phone)
+    bot.ensure_account_meta = lambda owner_id, phone: accounts.setdefault(phone, {"phone": phone})
+    bot.persist_tenants = lambda: None
+    try:
+        assert bot.get_ai_mode(ADMIN_ID) == bot.AI_MODE_ON_DEMAND
+        assert bot.get_ai_mode(ADMIN_ID, PHONE) == bot.AI_MODE_ON_DEMAND
+        bot.set_ai_mode(ADMIN_ID, bot.AI_MODE_AUTO, PHONE)
+        assert bot.get_ai_mode(ADMIN_ID, PHONE) == bot.AI_MODE_AUTO
+        assert bot.get_ai_mode(ADMIN_ID, "+79999999999") == bot.AI_MODE_ON_DEMAND
+        bot.set_ai_mode(ADMIN_ID, None, PHONE)
+        assert bot.get_ai_mode(ADMIN_ID, PHONE) == bot.AI_MODE_ON_DEMAND
+        tenant["ai_mode"] = "bogus"
+        assert bot.get_ai_mode(ADMIN_ID) == bot.DEFAULT_AI_MODE
+    finally:
+        bot.get_tenant, bot.get_account_meta, bot.ensure_account_meta, bot.persist_tenants = saved
+    print("режим AI: ok")
+
+
+def test_click_starts_one_generation():
+    """Нажатие запускает генерацию, повторное во время генерации игнорируется"""
+
+    worker = FakeWorker()
+
+    async def scenario():
+        first = FakeCallback(f"ai_gen:{THREAD_ID}:{MSG_ID}")
+        await bot.on_cb(first)
+        await asyncio.sleep(0)
+        assert worker.stages == [(MSG_ID, THREAD_ID, "ctx")]
+        assert TASK_ID in bot._ai_on_demand_inflight
+        assert bot._ai_usage[ADMIN_ID]["requested"] == 1
+
+        second = FakeCallback(f"ai_gen:{THREAD_ID}:{MSG_ID}")
+        await bot.on_cb(second)
+        assert second.answers == ["⏳ Варианты уже генерируются"]
+        assert worker.fetched == 1 and len(worker.stages) == 1
+
+        worker.gate.set()
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert TASK_ID not in bot._ai_on_demand_inflight
+
+    asyncio.run(_run(worker, scenario))
+    print("одна генерация на нажатие: ok")
+
+
+def test_click_reuses_cached_variants():
+    """Готовые варианты показываются без нового запроса"""
+
+    worker = FakeWorker()
+
+    async def scenario():
+        bot.pending_ai_replies[TASK_ID] = bot.PendingAIReply(
+            owner_id=ADMIN_ID,
+            phone=PHONE,
+            peer_id=CHAT_ID,
+            msg_id=MSG_ID,
+            incoming_text="привет",
+            suggested_variants=["a", "b", "c"],
+        )
+        await bot.on_cb(FakeCallback(f"ai_gen:{THREAD_ID}:{MSG_ID}"))
+        assert worker.fetched == 0 and not worker.stages
+        assert bot._ai_usage[ADMIN_ID]["cached"] == 1
+        assert bot.notification_threads[ADMIN_ID][THREAD_ID].ai_buttons
+
+    asyncio.run(_run(worker, scenario))
+    print("кэш вариантов: ok")
+
+
+if __name__ == "__main__":
+    test_ai_mode_account_override()
+    test_click_starts_one_generation()
+    test_click_reuses_cached_variants()
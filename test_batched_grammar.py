@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Тесты batched-грамматики: разбор ответа и бюджет токенов запроса.
+"""
+
+import asyncio
+import json
+
+import OpenAi_helper
+from OpenAi_helper import _parse_batched_grammar
+
+
+def test_parse_batched_grammar():
+    """Разбор JSON-массива из batched-запроса"""
+
+    raw = json.dumps(["привет как дела", "'ну норм'", "   "], ensure_ascii=False)
+    assert _parse_batched_grammar(raw, 3) == ["привет как дела", "ну норм", None]
+
+    # Модель иногда заворачивает ответ в markdown-блок
+    fenced = "```json\n" + json.dumps(["а", "б"], ensure_ascii=False) + "\n```"
+    assert _parse_batched_grammar(fenced, 2) == ["а", "б"]
+
+    # Не JSON, не массив или не та длина — все элементы на поштучный повтор
+    assert _parse_batched_grammar("не json", 2) == [None, None]
+    assert _parse_batched_grammar('{"a": 1}', 1) == [None]
+    assert _parse_batched_grammar('["a"]', 2) == [None, None]
+    assert _parse_batched_grammar("", 1) == [None]
+
+    # Не-строковые элементы отбраковываются по одному
+    assert _parse_batched_grammar('["ок", 5, null]', 3) == ["ок", None, None]
+    print("_parse_batched_grammar: ok")
+
+
+def test_batched_grammar_scales_max_tokens():
+    """Бюджет batched-запроса растёт с числом вариантов"""
+
+    calls = []
+
+    async def fake_gpt(**kwargs):
+        calls.append(kwargs)
+        return json.dumps(["а", "б", "в"], ensure_ascii=False)
+
+    saved = OpenAi_helper.gpt
+    OpenAi_helper.gpt = fake_gpt
+    try:
+        result = asyncio.run(
+            OpenAi_helper._grammar_pass(
+                ["a", "b", "c"],
+                model="gpt-4o",
+                api_key=None,
+                temperature=0.5,
+                max_tokens=50,
+                batched=True,
+            )
+        )
+    finally:
+        OpenAi_helper.gpt = saved
+    assert result == ["а", "б", "в"]
+    assert len(calls) == 1
+    expected = (50 + OpenAi_helper.BATCH_GRAMMAR_ITEM_OVERHEAD_TOKENS) * 3
+    assert calls[0]["max_tokens"] == expected
+    print("batched max_tokens: ok")
+
+
+if __name__ == "__main__":
+    test_parse_batched_grammar()
+    test_batched_grammar_scales_max_tokens()
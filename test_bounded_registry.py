@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Тесты BoundedRegistry: вытеснение по размеру (LRU по записи) и по TTL.
+"""
+
+import time
+
+from tg_manager_bot_dynamic import BoundedRegistry
+
+
+def test_registry_lru_eviction():
+    """Переполнение вытесняет самые давно записанные ключи"""
+
+    registry = BoundedRegistry("test_lru", max_size=3)
+    for i in range(5):
+        registry[i] = f"v{i}"
+    assert list(registry) == [2, 3, 4]
+    assert registry.evicted_size == 2
+
+    # Перезапись двигает ключ в конец очереди на вытеснение
+    registry[2] = "v2+"
+    registry[5] = "v5"
+    assert list(registry) == [4, 2, 5]
+    print("BoundedRegistry LRU: ok")
+
+
+def test_registry_ttl_eviction():
+    """Просроченные записи не видны ни одному пути чтения"""
+
+    registry = BoundedRegistry("test_ttl", max_size=10, ttl_seconds=0.05)
+    registry["a"] = 1
+    registry["b"] = 2
+    assert "a" in registry and registry.get("b") == 2
+    time.sleep(0.1)
+
+    assert "a" not in registry
+    assert registry.get("b") is None
+    assert list(registry) == []
+    assert list(registry.items()) == []
+    assert registry.pop("a", "нет") == "нет"
+    assert registry.setdefault("a", 3) == 3
+    assert registry.evicted_ttl == 2
+    print("BoundedRegistry TTL: ok")
+
+
+if __name__ == "__main__":
+    test_registry_lru_eviction()
+    test_registry_ttl_eviction()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Тесты очередей по чатам _ChatLaneScheduler (отправки и входящие апдейты).
+"""
+
+import asyncio
+
+from tg_manager_bot_dynamic import _ChatLaneScheduler
+
+
+async def _lane_ordering() -> None:
+    scheduler = _ChatLaneScheduler("test", concurrency=2)
+    order = []
+
+    async def job(chat_id: int, n: int) -> int:
+        await asyncio.sleep(0.01 * (3 - n))
+        order.append((chat_id, n))
+        return n
+
+    futures = [
+        await scheduler.enqueue(chat_id, "test", lambda c=chat_id, n=n: job(c, n))
+        for n in range(3)
+        for chat_id in (1, 2)
+    ]
+    results = await asyncio.gather(*futures)
+    assert results == [0, 0, 1, 1, 2, 2]
+    # Внутри чата — строго в порядке постановки, несмотря на разную длительность
+    for chat_id in (1, 2):
+        assert [n for c, n in order if c == chat_id] == [0, 1, 2]
+    assert scheduler.stats()["completed"] == 6
+    await scheduler.close()
+
+
+async def _lane_backlog_fifo() -> None:
+    scheduler = _ChatLaneScheduler("test", concurrency=1, max_backlog=1)
+    gate = asyncio.Event()
+    admitted = []
+
+    async def blocked() -> None:
+        await gate.wait()
+
+    async def producer(n: int) -> None:
+        await scheduler.enqueue(n, "test", blocked)
+        admitted.append(n)
+
+    producers = [asyncio.create_task(producer(n)) for n in range(4)]
+    await asyncio.sleep(0.01)
+    # Первый уже выполняется и место в очереди не занимает, второй ждёт слот
+    assert admitted == [0, 1]
+    assert scheduler.depth() == 1
+    gate.set()
+    await asyncio.gather(*producers)
+    # Ожидающие продюсеры пропускаются в порядке прихода
+    assert admitted == [0, 1, 2, 3]
+    assert scheduler.throttled == 3
+    await scheduler.close()
+
+
+async def _lane_close() -> None:
+    scheduler = _ChatLaneScheduler("test", concurrency=1, closed_message="закрыто")
+    gate = asyncio.Event()
+
+    async def blocked() -> str:
+        await gate.wait()
+        return "готово"
+
+    running = await scheduler.enqueue(1, "test", blocked)
+    # Ждёт слот, пока занят первый чат
+    parked = await scheduler.enqueue(2, "test", blocked)
+    queued = await scheduler.enqueue(1, "test", blocked)
+    await asyncio.sleep(0.01)
+
+    closing = asyncio.create_task(scheduler.close())
+    await asyncio.sleep(0.01)
+    gate.set()
+    await closing
+
+    assert running.result() == "готово"
+    for future in (parked, queued):
+        assert isinstance(future.exception(), RuntimeError)
+    assert scheduler.depth() == 0
+    try:
+        await scheduler.enqueue(3, "test", blocked)
+    except RuntimeError as e:
+        assert str(e) == "закрыто"
+    else:
+        raise AssertionError("enqueue после close() должен падать")
+
+
+async def _lane_cancel() -> None:
+    scheduler = _ChatLaneScheduler("test", concurrency=1)
+
+    running = await scheduler.enqueue(1, "test", lambda: asyncio.sleep(10))
+    queued = await scheduler.enqueue(1, "test", lambda: asyncio.sleep(0))
+    await asyncio.sleep(0.01)
+    for task in list(scheduler._lane_tasks.values()):
+        task.cancel()
+    await asyncio.sleep(0.01)
+
+    # Отмена задачи очереди не оставляет вызывающих ждать вечно
+    assert running.cancelled() and queued.cancelled()
+    assert scheduler.depth() == 0
+    await scheduler.close()
+
+
+def test_lane_scheduler_ordering():
+    asyncio.run(_lane_ordering())
+    print("_ChatLaneScheduler порядок: ok")
+
+
+def test_lane_scheduler_backlog_fifo():
+    asyncio.run(_lane_backlog_fifo())
+    print("_ChatLaneScheduler back-pressure: ok")
+
+
+def test_lane_scheduler_close():
+    asyncio.run(_lane_close())
+    print("_ChatLaneScheduler close: ok")
+
+
+def test_lane_scheduler_cancel():
+    asyncio.run(_lane_cancel())
+    print("_ChatLaneScheduler отмена: ok")
+
+
+if __name__ == "__main__":
+    test_lane_scheduler_ordering()
+    test_lane_scheduler_backlog_fifo()
+    test_lane_scheduler_close()
+    test_lane_scheduler_cancel()
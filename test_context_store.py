@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Тесты отложенной записи _ContextStore: чтение до сброса на диск, фоновый
+сброс и записи, пришедшие во время сброса.
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+
+from tg_manager_bot_dynamic import _ContextStore
+
+KIND = "reply_contexts"
+
+
+def _on_disk(path: str, key: str):
+    # Свежий экземпляр без очереди читает только то, что уже на диске
+    return asyncio.run(_ContextStore(path).get(KIND, key))
+
+
+def test_reads_see_queued_writes():
+    """Незаписанные put/delete видны get() без сброса на диск"""
+
+    async def scenario(path: str) -> None:
+        store = _ContextStore(path, flush_delay=60)
+        store.put(KIND, 1, "a", "+7000", {"chat_id": 5})
+        assert await store.get(KIND, "a") == (1, "+7000", {"chat_id": 5})
+        assert await store.get(KIND, "a", owner_id=2) is None
+        assert store._pending, "get() не должен сбрасывать очередь"
+
+        store.delete(KIND, "a")
+        assert await store.get(KIND, "a") is None
+        store._flush_task.cancel()
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        asyncio.run(scenario(os.path.join(tmp, "contexts.sqlite3")))
+    print("чтение из очереди: ok")
+
+
+def test_background_flush_and_late_writes():
+    """Фоновый сброс пишет всё, включая записи во время сброса"""
+
+    async def scenario(path: str) -> _ContextStore:
+        store = _ContextStore(path, flush_delay=0.01)
+        apply = store._apply
+
+        def slow_apply(batch):
+            time.sleep(0.05)
+            apply(batch)
+
+        store._apply = slow_apply
+        store.put(KIND, 1, "first", None, {"n": 1})
+        await asyncio.sleep(0.03)  # первая пачка уже пишется
+        assert store._inflight
+        store.put(KIND, 1, "late", None, {"n": 2})
+        # Пока пачка не закоммичена, ответ берётся из неё
+        assert await store.get(KIND, "first") == (1, None, {"n": 1})
+        await store._flush_task
+        assert not store._pending and not store._inflight
+        return store
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        path = os.path.join(tmp, "contexts.sqlite3")
+        asyncio.run(scenario(path))
+        assert _on_disk(path, "first") == (1, None, {"n": 1})
+        assert _on_disk(path, "late") == (1, None, {"n": 2})
+    print("фоновый сброс: ok")
+
+
+def test_flush_on_shutdown():
+    """flush() при остановке пишет то, что ещё в очереди"""
+
+    async def scenario(path: str) -> _ContextStore:
+        store = _ContextStore(path, flush_delay=60)
+        store.put(KIND, 1, "a", None, {"n": 1})
+        store._flush_task.cancel()
+        return store
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        path = os.path.join(tmp, "contexts.sqlite3")
+        store = asyncio.run(scenario(path))
+        assert _on_disk(path, "a") is None
+        store.flush()
+        assert _on_disk(path, "a") == (1, None, {"n": 1})
+    print("сброс при остановке: ok")
+
+
+if __name__ == "__main__":
+    test_reads_see_queued_writes()
+    test_background_flush_and_late_writes()
+    test_flush_on_shutdown()
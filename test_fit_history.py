@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Тесты обрезки истории под бюджет токенов.
+"""
+
+import asyncio
+
+import OpenAi_helper as helper
+from OpenAi_helper import count_tokens, fit_history
+
+MODEL = "gpt-4o"
+
+
+def test_fit_history_keeps_newest_lines():
+    """Свежие строки в исходном порядке, старые отбрасываются"""
+
+    lines = ["Он: привет", "Я: привет", "Он: как дела?", "Я: норм"]
+    assert fit_history(lines, MODEL, budget=10_000) == lines
+
+    tail = lines[-2:]
+    budget = sum(count_tokens(line, MODEL) + 1 for line in tail)
+    assert fit_history(lines, MODEL, budget=budget) == tail
+    assert fit_history([], MODEL, budget=budget) == []
+    print("fit_history (бюджет): ok")
+
+
+def test_fit_history_truncates_oversized_newest_line():
+    """Слишком длинная последняя строка не обнуляет историю, а обрезается"""
+
+    long_line = "Он: " + "очень длинное сообщение " * 200
+    kept = fit_history(["Он: привет", long_line], MODEL, budget=20)
+    assert len(kept) == 1
+    assert kept[0].startswith("Он: очень")
+    assert kept[0].endswith("…")
+    assert len(kept[0]) < len(long_line)
+    print("fit_history (обрезка последней строки): ok")
+
+
+def _history_values(history_texts, incoming_texts, kept: int):
+    """history_values_repr, который доходит до переформулировки вариантов."""
+
+    captured = []
+
+    async def gpt_multi(**kwargs):
+        return ["ответ"]
+
+    async def rephrase(variant, **kwargs):
+        captured.append(kwargs["history_values_repr"])
+        return variant
+
+    async def grammar(variants, **kwargs):
+        return list(variants)
+
+    saved = (helper.gpt_multi, helper._rephrase_if_negative, helper._grammar_pass, helper.fit_history)
+    helper.gpt_multi = gpt_multi
+    helper._rephrase_if_negative = rephrase
+    helper._grammar_pass = grammar
+    helper.fit_history = lambda lines, model: list(lines)[len(lines) - kept:]
+    try:
+        asyncio.run(
+            helper.generate_dating_ai_reply(
+                "\n".join(incoming_texts),
+                history_lines=[f"Он: {t}" for t in history_texts],
+                history_texts=history_texts,
+                incoming_texts=incoming_texts,
+                n=1,
+            )
+        )
+    finally:
+        helper.gpt_multi, helper._rephrase_if_negative, helper._grammar_pass, helper.fit_history = saved
+    return captured[0]
+
+
+def test_history_texts_follow_trimmed_lines():
+    """Тексты истории режутся по тем же индексам, что и строки; входящие идут всегда"""
+
+    history = ["раз", "два", "три", "четыре"]
+    incoming = ["привет", "ты тут?"]
+    assert _history_values(history, incoming, kept=2) == repr(["три", "четыре", *incoming])
+    assert _history_values([], incoming, kept=0) == repr(incoming)
+    print("тексты истории и входящие: ok")
+
+
+if __name__ == "__main__":
+    test_fit_history_keeps_newest_lines()
+    test_fit_history_truncates_oversized_newest_line()
+    test_history_texts_follow_trimmed_lines()
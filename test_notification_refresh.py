@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Тесты склейки правок уведомлений: debounce, повтор после FloodWait и
+повторная отправка удалённого уведомления.
+"""
+
+import asyncio
+import os
+import tempfile
+from types import SimpleNamespace
+
+from telethon.errors import FloodWaitError, MessageIdInvalidError
+
+import tg_manager_bot_dynamic as bot
+
+ADMIN_ID = 1001
+THREAD_ID = "+70000000000:42"
+
+
+class FakeBot:
+    """Подменяет edit_message/send_message клиента бота и пишет вызовы."""
+
+    def __init__(self, edit_errors=()):
+        self.edit_errors = list(edit_errors)
+        self.edits = []
+        self.sent = []
+
+    async def edit_message(self, admin_id, message_id, text, **kwargs):
+        if self.edit_errors:
+            raise self.edit_errors.pop(0)
+        self.edits.append((message_id, text))
+
+    async def send_message(self, admin_id, text, **kwargs):
+        self.sent.append(text)
+        return SimpleNamespace(id=500 + len(self.sent))
+
+
+def _new_state(message_id: int = 100) -> "bot._NotificationThreadState":
+    state = bot._NotificationThreadState(
+        message_id=message_id,
+        thread_id=THREAD_ID,
+        ctx_id="ctx",
+        bullets=[],
+        header_lines=["заголовок"],
+        history_html="",
+    )
+    bot.notification_threads[ADMIN_ID][THREAD_ID] = state
+    return state
+
+
+async def _run(fake: FakeBot, scenario) -> None:
+    saved = (
+        bot.bot_client.edit_message,
+        bot.bot_client.send_message,
+        bot._context_store,
+        bot.NOTIFICATION_EDIT_DEBOUNCE_SECONDS,
+    )
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        bot.bot_client.edit_message = fake.edit_message
+        bot.bot_client.send_message = fake.send_message
+        bot._context_store = bot._ContextStore(os.path.join(tmp, "contexts.sqlite3"))
+        bot.NOTIFICATION_EDIT_DEBOUNCE_SECONDS = 0.01
+        try:
+            await scenario()
+        finally:
+            (
+                bot.bot_client.edit_message,
+                bot.bot_client.send_message,
+                bot._context_store,
+                bot.NOTIFICATION_EDIT_DEBOUNCE_SECONDS,
+            ) = saved
+            bot.notification_threads.pop(ADMIN_ID, None)
+            bot._admin_reply_threads.pop(ADMIN_ID, None)
+
+
+def test_burst_is_one_edit_with_final_state():
+    """Пачка изменений даёт одно редактирование с последним состоянием"""
+
+    fake = FakeBot()
+
+    async def scenario():
+        state = _new_state()
+        for n in range(5):
+            state.bullets.append(f"сообщение {n}")
+            bot.schedule_notification_refresh(ADMIN_ID, THREAD_ID)
+        await state.refresh_task
+        assert len(fake.edits) == 1
+        assert "сообщение 4" in fake.edits[0][1]
+
+    asyncio.run(_run(fake, scenario))
+    print("debounce: ok")
+
+
+def test_flood_wait_is_retried():
+    """FloodWait на правке не теряет финальное состояние"""
+
+    fake = FakeBot(edit_errors=[FloodWaitError(request=None, capture=0)])
+
+    async def scenario():
+        state = _new_state()
+        state.bullets.append("последнее")
+        bot.schedule_notification_refresh(ADMIN_ID, THREAD_ID)
+        await state.refresh_task
+        assert len(fake.edits) == 1
+        assert "последнее" in fake.edits[0][1]
+        assert not state.dirty
+
+    asyncio.run(_run(fake, scenario))
+    print("повтор после FloodWait: ok")
+
+
+def test_deleted_notification_is_reposted():
+    """Удалённое уведомление отправляется заново и тред остаётся зарегистрирован"""
+
+    fake = FakeBot(edit_errors=[MessageIdInvalidError(request=None)])
+
+    async def scenario():
+        state = _new_state(message_id=100)
+        bot.schedule_notification_refresh(ADMIN_ID, THREAD_ID)
+        await state.refresh_task
+        assert len(fake.sent) == 1
+        assert state.message_id == 501
+        assert bot.notification_threads[ADMIN_ID].get(THREAD_ID) is state
+
+    asyncio.run(_run(fake, scenario))
+    print("повторная отправка: ok")
+
+
+if __name__ == "__main__":
+    test_burst_is_one_edit_with_final_state()
+    test_flood_wait_is_retried()
+    test_deleted_notification_is_reposted()
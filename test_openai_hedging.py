@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Тесты hedged-запросов и общего дедлайна вызова OpenAI.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import OpenAi_helper as helper
+
+KWARGS = {"model": "gpt-4o", "messages": [{"role": "user", "content": "привет"}], "max_tokens": 10}
+
+
+class FakeClient:
+    """Клиент OpenAI: задержка и результат каждого вызова create задаются списком."""
+
+    def __init__(self, delays, stream_chunks=None):
+        self.delays = list(delays)
+        self.stream_chunks = stream_chunks
+        self.calls = []
+        self.cancelled = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        index = len(self.calls)
+        self.calls.append(kwargs)
+        try:
+            await asyncio.sleep(self.delays[index])
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if kwargs.get("stream"):
+            return FakeStream(self.stream_chunks)
+        return SimpleNamespace(answer=index, usage=None)
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    async def __aiter__(self):
+        for delay, chunk in self.chunks:
+            await asyncio.sleep(delay)
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+def _patched(**values):
+    """Подменяет настройки модуля и даёт свежий планировщик на время теста."""
+
+    values.setdefault("_openai_scheduler", helper._OpenAIScheduler(4, 600, 1_000_000))
+    saved = {name: getattr(helper, name) for name in values}
+
+    class Patch:
+        def __enter__(self):
+            for name, value in values.items():
+                setattr(helper, name, value)
+            return values["_openai_scheduler"]
+
+        def __exit__(self, *exc):
+            for name, value in saved.items():
+                setattr(helper, name, value)
+
+    return Patch()
+
+
+def test_first_successful_skips_failures():
+    """Берётся первый успешный результат; если упали все — последняя ошибка"""
+
+    async def fail(delay, message):
+        await asyncio.sleep(delay)
+        raise ValueError(message)
+
+    async def ok(delay, value):
+        await asyncio.sleep(delay)
+        return value
+
+    async def scenario():
+        tasks = [asyncio.create_task(fail(0, "a")), asyncio.create_task(ok(0.01, "b"))]
+        assert await helper._first_successful(tasks) == "b"
+
+        tasks = [asyncio.create_task(fail(0, "a")), asyncio.create_task(fail(0.01, "b"))]
+        try:
+            await helper._first_successful(tasks)
+        except ValueError as e:
+            assert str(e) == "b"
+        else:
+            raise AssertionError("ожидалась ошибка")
+
+        slow = asyncio.create_task(ok(10, "slow"))
+        assert await helper._first_successful([asyncio.create_task(ok(0, "fast")), slow]) == "fast"
+        await asyncio.sleep(0)
+        assert slow.cancelled()
+
+    asyncio.run(scenario())
+    print("_first_successful: ok")
+
+
+def test_slow_interactive_request_is_hedged():
+    """Медленная интерактивная попытка дублируется, берётся первый ответ"""
+
+    client = FakeClient(delays=[10, 0])
+
+    async def scenario(scheduler):
+        response = await helper._create_completion(
+            client, KWARGS, priority=helper.PRIORITY_INTERACTIVE
+        )
+        assert response.answer == 1
+        await asyncio.sleep(0)  # отмена проигравшей попытки
+        assert len(client.calls) == 2 and client.cancelled == 1
+        assert scheduler.hedged == 1
+        assert scheduler.stats()["active"] == 0
+
+    with _patched(OPENAI_HEDGE_AFTER_SECONDS=0.02) as scheduler:
+        asyncio.run(scenario(scheduler))
+    print("hedged-запрос: ok")
+
+
+def test_background_request_is_not_hedged():
+    """Фоновые запросы не дублируются"""
+
+    client = FakeClient(delays=[0.05, 0])
+
+    async def scenario(scheduler):
+        response = await helper._create_completion(
+            client, KWARGS, priority=helper.PRIORITY_BACKGROUND
+        )
+        assert response.answer == 0
+        assert len(client.calls) == 1 and scheduler.hedged == 0
+
+    with _patched(OPENAI_HEDGE_AFTER_SECONDS=0.01) as scheduler:
+        asyncio.run(scenario(scheduler))
+    print("фоновый запрос без hedging: ok")
+
+
+def test_request_timeout_is_capped_by_deadline():
+    """Таймаут попытки не выходит за дедлайн вызова; истёкший дедлайн — TimeoutError"""
+
+    client = FakeClient(delays=[0])
+
+    async def scenario():
+        await helper._create_completion(client, KWARGS, priority=helper.PRIORITY_INTERACTIVE)
+        assert client.calls[0]["timeout"] <= 0.5
+
+        try:
+            await helper._attempt_completion(
+                client,
+                KWARGS,
+                priority=helper.PRIORITY_INTERACTIVE,
+                estimated=10,
+                deadline=helper.time.monotonic() - 1,
+            )
+        except TimeoutError:
+            pass
+        else:
+            raise AssertionError("ожидался TimeoutError")
+        assert len(client.calls) == 1
+
+    with _patched(OPENAI_CALL_DEADLINE_SECONDS=0.5):
+        asyncio.run(scenario())
+    print("дедлайн попытки: ok")
+
+
+def test_stalled_stream_hits_deadline():
+    """Зависший стрим обрывается по дедлайну, слот планировщика освобождается"""
+
+    chunks = [(0, SimpleNamespace(usage=None)), (10, SimpleNamespace(usage=None))]
+    client = FakeClient(delays=[0], stream_chunks=chunks)
+
+    async def scenario(scheduler):
+        received = []
+        try:
+            async for chunk in helper._stream_completion(
+                client, KWARGS, priority=helper.PRIORITY_INTERACTIVE
+            ):
+                received.append(chunk)
+        except TimeoutError:
+            pass
+        else:
+            raise AssertionError("ожидался TimeoutError")
+        assert len(received) == 1
+        assert scheduler.stats()["active"] == 0
+
+    with _patched(OPENAI_CALL_DEADLINE_SECONDS=0.05) as scheduler:
+        asyncio.run(scenario(scheduler))
+    print("дедлайн стрима: ok")
+
+
+if __name__ == "__main__":
+    test_first_successful_skips_failures()
+    test_slow_interactive_request_is_hedged()
+    test_background_request_is_not_hedged()
+    test_request_timeout_is_capped_by_deadline()
+    test_stalled_stream_hits_deadline()
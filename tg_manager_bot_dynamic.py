@@ -36,22 +36,35 @@ import secrets
 import html
 import re
 import shutil
+import tempfile
+import threading
 import socket
+import sqlite3
 import mimetypes
-from dataclasses import dataclass
+import time
+import weakref
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from collections import OrderedDict, defaultdict, deque
 from logging.handlers import RotatingFileHandler
-from typing import Dict, Optional, Any, List, Tuple, Set, TYPE_CHECKING, Callable, cast
+from typing import Dict, Optional, Any, List, Sequence, Tuple, Set, TYPE_CHECKING, Callable, cast
 from io import BytesIO
 from telethon import TelegramClient, events, Button, functions, helpers, types
-from OpenAi_helper import generate_dating_ai_variants, recommend_dating_ai_variant
-from telethon.utils import get_display_name
+from OpenAi_helper import (
+    close_openai_clients,
+    generate_dating_ai_reply,
+    openai_scheduler_stats,
+    response_cache_stats,
+)
+from telethon.utils import get_attributes, get_display_name
 from telethon.sessions import StringSession
 from telethon.errors import (
     SessionPasswordNeededError,
     FloodWaitError,
+    MessageIdInvalidError,
+    MessageNotModifiedError,
     PeerIdInvalidError,
+    UnauthorizedError,
 )
 
 try:  # Telethon <= 1.33.1
@@ -160,6 +173,25 @@ LOGIN_DELAY_SECONDS = (5, 15)
 KEEPALIVE_INTERVAL_SECONDS = 90
 KEEPALIVE_JITTER = (20, 60)
 
+# Сколько секунд доверять закэшированному состоянию авторизации аккаунта.
+# Keepalive обновляет его при каждом успешном get_me, поэтому отправки
+# обычно не тратят отдельный запрос is_user_authorized.
+AUTH_STATE_TTL_SECONDS = 600
+
+# Сколько разных чатов одного аккаунта могут отправлять одновременно.
+# Внутри одного чата отправки всегда идут строго по очереди.
+SEND_CHAT_CONCURRENCY = 4
+
+# Входящие апдейты аккаунта: порядок внутри чата строгий, разные чаты
+# обрабатываются параллельно до лимита. При переполнении очереди приём
+# новых апдейтов ждёт (back-pressure): клиент аккаунта создаётся с
+# sequential_updates=True, поэтому ждёт сам цикл апдейтов Telethon.
+UPDATE_CHAT_CONCURRENCY = 8
+UPDATE_BACKLOG_LIMIT = 200
+
+# Запас сверх FloodWait, который Telegram вернул, прежде чем повторять метод.
+FLOOD_WAIT_PADDING_SECONDS = 5
+
 # Расширенные профили устройств/версий
 DEVICE_PROFILES: List[Dict[str, str]] = [
     {"device_model":"iPhone 12", "system_version":"16.4", "app_version":"10.9.0",  "lang_code":"en"},
@@ -205,7 +237,41 @@ ITEMS_PER_PAGE = 10
 ACCOUNTS_META = "accounts.json"
 ROTATION_STATE = ".rotation_state.json"
 TENANTS_DB = "tenants.json"
+# Контексты кнопок уведомлений (ответ/реплай/прочитать, правка/удаление исходящих),
+# чтобы они переживали перезапуск. Читаются лениво, по одному ключу.
+CONTEXT_STORE_DB = "runtime_contexts.sqlite3"
+# Записи в хранилище копятся и уходят одной транзакцией в фоновом потоке
+# не чаще, чем раз в столько секунд, чтобы не блокировать event loop.
+CONTEXT_STORE_FLUSH_DELAY_SECONDS = 0.5
+# Режим AI-подсказок: "auto" — генерация на каждое входящее, "on_demand" —
+# в уведомлении только кнопка «Сгенерировать». Задаётся на пользователя
+# (tenant["ai_mode"]) и может быть переопределён для аккаунта (meta["ai_mode"]).
+AI_MODE_AUTO = "auto"
+AI_MODE_ON_DEMAND = "on_demand"
+DEFAULT_AI_MODE = AI_MODE_AUTO
 MAX_MEDIA_FORWARD_SIZE = 20 * 1024 * 1024  # 20 MB
+# Вложения крупнее этого порога скачиваются во временный файл, а не в память
+MEDIA_SPOOL_THRESHOLD = 1 * 1024 * 1024  # 1 MB
+# Сколько админов одновременно получают рассылку от бота
+ADMIN_FANOUT_CONCURRENCY = 8
+# Бюджеты runtime-реестров: имя -> (максимум записей, TTL в секундах или None).
+# Для реестров, разбитых по админам, лимит действует на каждого админа.
+REGISTRY_LIMITS: Dict[str, Tuple[int, Optional[float]]] = {
+    "reply_contexts": (5000, 3 * 24 * 3600),
+    "outgoing_actions": (5000, 3 * 24 * 3600),
+    "pending_ai_replies": (1000, 24 * 3600),
+    "notification_threads": (500, 3 * 24 * 3600),
+    "admin_reply_threads": (2000, 3 * 24 * 3600),
+    "interactive_views": (200, 24 * 3600),
+}
+# Сколько пар user_id -> access_hash хранить на аккаунт (файл рядом с сессией)
+ENTITY_CACHE_LIMIT = 5000
+# Новые пары копятся в памяти и пишутся на диск не чаще, чем раз в столько
+# секунд (и при остановке воркера).
+ENTITY_CACHE_FLUSH_DELAY_SECONDS = 30.0
+# Профили собеседников (имя, username, бот ли) в памяти воркера
+CONTACT_PROFILE_LIMIT = 2000
+CONTACT_PROFILE_TTL_SECONDS = 30 * 60
 
 REACTION_CHOICES: List[Tuple[str, str]] = [
     ("😂 Смех", "😂"),
@@ -295,6 +361,10 @@ def user_session_path(user_id: int, phone: str) -> str:
     return os.path.join(user_sessions_dir(user_id), f"{phone}.session")
 
 
+def user_entity_cache_path(user_id: int, phone: str) -> str:
+    return os.path.join(user_sessions_dir(user_id), f"{phone}.entities.json")
+
+
 def user_proxy_dir(user_id: int) -> str:
     ensure_user_dirs(user_id)
     return os.path.join(PROXIES_DIR, str(user_id))
@@ -400,6 +470,29 @@ def ensure_account_meta(owner_id: int, phone: str) -> Dict[str, Any]:
     return meta
 
 
+def get_ai_mode(owner_id: int, phone: Optional[str] = None) -> str:
+    if phone:
+        meta = get_account_meta(owner_id, phone) or {}
+        if meta.get("ai_mode") in {AI_MODE_AUTO, AI_MODE_ON_DEMAND}:
+            return meta["ai_mode"]
+    mode = get_tenant(owner_id).get("ai_mode")
+    return mode if mode in {AI_MODE_AUTO, AI_MODE_ON_DEMAND} else DEFAULT_AI_MODE
+
+
+def set_ai_mode(owner_id: int, mode: Optional[str], phone: Optional[str] = None) -> None:
+    """Set the tenant mode, or an account override; mode=None drops the override."""
+
+    if phone:
+        meta = ensure_account_meta(owner_id, phone)
+        if mode is None:
+            meta.pop("ai_mode", None)
+        else:
+            meta["ai_mode"] = mode
+    else:
+        get_tenant(owner_id)["ai_mode"] = mode or DEFAULT_AI_MODE
+    persist_tenants()
+
+
 def get_tenant_proxy_config(owner_id: int) -> Dict[str, Any]:
     tenant = get_tenant(owner_id)
     proxy_cfg = tenant.get("proxy")
@@ -494,6 +587,7 @@ async def clear_owner_runtime(owner_id: int) -> None:
     pending.pop(owner_id, None)
     reply_waiting.pop(owner_id, None)
     menu_button_reset.discard(owner_id)
+    _context_store.delete_account(owner_id)
     for ctx_id, ctx in list(reply_contexts.items()):
         if ctx.get("owner_id") == owner_id:
             reply_contexts.pop(ctx_id, None)
@@ -919,6 +1013,12 @@ def _register_payload(value: str) -> str:
     return token
 
 
+def _dump_payload(payload: Dict[str, Any]) -> str:
+    """Compact JSON for payloads stored in the inline payload cache."""
+
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+
 def _resolve_payload(token: str) -> Optional[str]:
     value = _payload_cache.get(token)
     if value is not None:
@@ -926,6 +1026,140 @@ def _resolve_payload(token: str) -> Optional[str]:
     return value
 
 
+class BoundedRegistry(OrderedDict):
+    """Dict with max-size (LRU by write) and optional TTL eviction.
+
+    Drop-in replacement for the plain runtime dicts: writes move the key to
+    the end and prune expired or surplus entries from the front. Lookups,
+    ``in``, iteration (including ``keys``/``items``/``values``), ``pop`` and
+    ``setdefault`` prune expired entries first so stale values are never
+    returned; ``len()`` may still count them until the next such access.
+    """
+
+    def __init__(self, name: str, max_size: int, ttl_seconds: Optional[float] = None) -> None:
+        super().__init__()
+        self.name = name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._stamps: Dict[Any, float] = {}
+        self.evicted_size = 0
+        self.evicted_ttl = 0
+        _REGISTRIES[id(self)] = self
+
+    @classmethod
+    def from_budget(cls, name: str) -> "BoundedRegistry":
+        max_size, ttl_seconds = REGISTRY_LIMITS[name]
+        return cls(name, max_size, ttl_seconds)
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        self._stamps[key] = time.monotonic()
+        self._prune()
+
+    def __getitem__(self, key: Any) -> Any:
+        self._prune_expired()
+        return super().__getitem__(key)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        self._prune_expired()
+        return super().get(key, default)
+
+    def __contains__(self, key: Any) -> bool:
+        self._prune_expired()
+        return super().__contains__(key)
+
+    def __iter__(self) -> Any:
+        self._prune_expired()
+        return super().__iter__()
+
+    def keys(self) -> Any:
+        self._prune_expired()
+        return super().keys()
+
+    def items(self) -> Any:
+        self._prune_expired()
+        return super().items()
+
+    def values(self) -> Any:
+        self._prune_expired()
+        return super().values()
+
+    _MISSING = object()
+
+    def pop(self, key: Any, default: Any = _MISSING) -> Any:
+        self._prune_expired()
+        self._stamps.pop(key, None)
+        if default is self._MISSING:
+            return super().pop(key)
+        return super().pop(key, default)
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        self._prune_expired()
+        if super().__contains__(key):
+            return super().__getitem__(key)
+        self[key] = default
+        return default
+
+    def _prune_expired(self) -> None:
+        if not self.ttl_seconds or not self:
+            return
+        deadline = time.monotonic() - self.ttl_seconds
+        expired: List[Any] = []
+        for key in super().__iter__():
+            stamp = self._stamps.get(key)
+            if stamp is not None and stamp > deadline:
+                break
+            expired.append(key)
+        for key in expired:
+            OrderedDict.pop(self, key, None)
+            self._stamps.pop(key, None)
+        if expired:
+            self.evicted_ttl += len(expired)
+            _REGISTRY_EVICTIONS[self.name]["evicted_ttl"] += len(expired)
+
+    def _prune(self) -> None:
+        self._prune_expired()
+        while len(self) > self.max_size:
+            key, _ = self.popitem(last=False)
+            self._stamps.pop(key, None)
+            self.evicted_size += 1
+            _REGISTRY_EVICTIONS[self.name]["evicted_size"] += 1
+        # pop()/del не проходят через __setitem__, поэтому метки чистим лениво
+        if len(self._stamps) > 2 * len(self) + 64:
+            self._stamps = {
+                key: self._stamps[key] for key in super().__iter__() if key in self._stamps
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self),
+            "max_size": self.max_size,
+            "evicted_size": self.evicted_size,
+            "evicted_ttl": self.evicted_ttl,
+        }
+
+
+_REGISTRIES: "weakref.WeakValueDictionary[int, BoundedRegistry]" = weakref.WeakValueDictionary()
+# Счётчики вытеснений по имени реестра переживают сами (per-admin) реестры
+_REGISTRY_EVICTIONS: Dict[str, Dict[str, int]] = defaultdict(
+    lambda: {"evicted_size": 0, "evicted_ttl": 0}
+)
+
+
+def registry_stats() -> Dict[str, Dict[str, Any]]:
+    """Aggregate live size and eviction counters per registry name."""
+
+    summary: Dict[str, Dict[str, Any]] = {}
+    for registry in list(_REGISTRIES.values()):
+        entry = summary.setdefault(registry.name, {"instances": 0, "size": 0})
+        entry["instances"] += 1
+        entry["size"] += len(registry)
+    for name, counters in _REGISTRY_EVICTIONS.items():
+        summary.setdefault(name, {"instances": 0, "size": 0}).update(counters)
+    return summary
+
+
 def _encode_payload(text: str) -> str:
     raw = base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
     return raw.rstrip("=")
@@ -1135,10 +1369,10 @@ def _reply_inline_help_article(mode: str, reason: str) -> InlineArticle:
     )
 
 
-def _build_reply_inline_results(
+async def _build_reply_inline_results(
     admin_id: int, ctx_id: str, mode: str, file_type: Optional[str] = None, search_query: Optional[str] = None
 ) -> List[InlineArticle]:
-    ctx_info = get_reply_context_for_admin(ctx_id, admin_id)
+    ctx_info = await get_reply_context_for_admin(ctx_id, admin_id)
     if not ctx_info:
         return [
             _reply_inline_help_article(
@@ -1168,7 +1402,7 @@ def _build_reply_inline_results(
 
         # Добавляем кнопку "Назад" для возврата к категориям
         back_payload = {"ctx": ctx_id, "mode": mode, "variant": "back_to_categories"}
-        back_token = _register_payload(json.dumps(back_payload, ensure_ascii=False))
+        back_token = _register_payload(_dump_payload(back_payload))
         articles.append(
             InlineArticle(
                 id=f"{INLINE_REPLY_RESULT_PREFIX}{back_token}",
@@ -1187,7 +1421,7 @@ def _build_reply_inline_results(
                 "file_type": file_type,
                 "file_path": path,
             }
-            file_token = _register_payload(json.dumps(file_payload, ensure_ascii=False))
+            file_token = _register_payload(_dump_payload(file_payload))
             articles.append(
                 InlineArticle(
                     id=f"{INLINE_REPLY_RESULT_PREFIX}{file_token}",
@@ -1211,7 +1445,7 @@ def _build_reply_inline_results(
         return articles
 
     # Стандартное меню - показываем категории файлов
-    token = _register_payload(json.dumps({**base_payload, "variant": "text"}, ensure_ascii=False))
+    token = _register_payload(_dump_payload({**base_payload, "variant": "text"}))
     articles.append(
         InlineArticle(
             id=f"{INLINE_REPLY_RESULT_PREFIX}{token}",
@@ -1230,7 +1464,7 @@ def _build_reply_inline_results(
             "variant": "picker",
             "file_type": ft,
         }
-        picker_token = _register_payload(json.dumps(picker_payload, ensure_ascii=False))
+        picker_token = _register_payload(_dump_payload(picker_payload))
         articles.append(
             InlineArticle(
                 id=f"{INLINE_REPLY_RESULT_PREFIX}{picker_token}",
@@ -1294,7 +1528,7 @@ async def _execute_inline_reply_payload(admin_id: int, payload: Dict[str, Any])
         if picker_error:
             await send_temporary_message(admin_id, f"❌ {picker_error}")
     elif variant == "back_to_categories":
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await send_temporary_message(admin_id, "❌ Контекст устарел.")
             return
@@ -1312,7 +1546,7 @@ async def _execute_inline_reply_payload(admin_id: int, payload: Dict[str, Any])
             return
 
         # Отправляем файл собеседнику
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await send_temporary_message(admin_id, "❌ Контекст устарел.")
             return
@@ -1435,7 +1669,7 @@ def _prepare_reply_asset_menu(owner_id: int, file_type: str) -> Optional[Tuple[L
 async def _open_reply_asset_menu(
     admin_id: int, ctx: str, mode: Optional[str], file_type: str, page: int = 0
 ) -> Optional[str]:
-    ctx_info = get_reply_context_for_admin(ctx, admin_id)
+    ctx_info = await get_reply_context_for_admin(ctx, admin_id)
     if not ctx_info:
         return "Контекст истёк"
     await mark_dialog_read_for_context(ctx_info)
@@ -2261,7 +2495,7 @@ async def _activate_reply_session(
 ) -> Optional[str]:
     """Prepare reply workflow for the given admin/context."""
 
-    ctx_info = get_reply_context_for_admin(ctx, admin_id)
+    ctx_info = await get_reply_context_for_admin(ctx, admin_id)
     if not ctx_info:
         return "Контекст истёк"
 
@@ -2602,10 +2836,12 @@ def _extract_reply_to_msg_id(ev: Any) -> Optional[int]:
     return None
 
 
-_admin_reply_threads: Dict[int, Dict[Any, int]] = defaultdict(dict)
+_admin_reply_threads: Dict[int, Dict[Any, int]] = defaultdict(
+    lambda: BoundedRegistry.from_budget("admin_reply_threads")
+)
 
 
-@dataclass
+@dataclass(slots=True)
 class _NotificationThreadState:
     message_id: int
     thread_id: str
@@ -2614,15 +2850,33 @@ class _NotificationThreadState:
     header_lines: List[str]
     history_html: str
     history_collapsed: bool = True
+    # history_html рендерится лениво при раскрытии и сбрасывается новыми сообщениями
+    history_stale: bool = True
     peer: Optional[Any] = None
     ai_block: Optional[str] = None
     ai_buttons: Optional[List[List[Button]]] = None
+    edit_lock: Optional[asyncio.Lock] = field(default=None, repr=False)
+    dirty: bool = False
+    refresh_task: Optional[asyncio.Task] = field(default=None, repr=False)
+    retry_after: float = 0.0
+    edit_failures: int = 0
 
 
-notification_threads: Dict[int, Dict[str, _NotificationThreadState]] = defaultdict(dict)
+notification_threads: Dict[int, Dict[str, _NotificationThreadState]] = defaultdict(
+    lambda: BoundedRegistry.from_budget("notification_threads")
+)
 
 MAX_NOTIFICATION_BULLETS = 20
+# Окно, за которое правки одного уведомления склеиваются в одно редактирование.
+NOTIFICATION_EDIT_DEBOUNCE_SECONDS = 1.0
+# Неудачная правка (сеть, ошибки API) повторяется с удвоением паузы до
+# NOTIFICATION_EDIT_RETRY_MAX_SECONDS, не более NOTIFICATION_EDIT_MAX_RETRIES раз
+# подряд; FloodWait ждёт указанное Telegram время и в лимит не входит.
+NOTIFICATION_EDIT_RETRY_MAX_SECONDS = 30.0
+NOTIFICATION_EDIT_MAX_RETRIES = 5
 MAX_HISTORY_MESSAGES = 10
+# Для AI-промпта берём больше сообщений — в бюджет токенов их режет OpenAi_helper.fit_history
+AI_HISTORY_FETCH_LIMIT = 30
 HISTORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history")
 
 
@@ -2803,14 +3057,23 @@ def _format_history_entry(message: Message) -> str:
     return entry
 
 
-async def _build_history_html(client: TelegramClient, peer: Any, limit: int = MAX_HISTORY_MESSAGES) -> str:
+async def _build_history_html(
+    client: TelegramClient,
+    peer: Any,
+    limit: int = MAX_HISTORY_MESSAGES,
+    *,
+    entity_cache: Optional[_InputPeerCache] = None,
+) -> str:
     if peer is None:
         return "<i>История недоступна</i>"
     resolved_peer = peer
-    try:
-        resolved_peer = await client.get_input_entity(peer)
-    except Exception as exc:
-        log.debug("History peer resolve failed for %s: %s", peer, exc)
+    if entity_cache is not None:
+        resolved_peer = await entity_cache.resolve(client, peer)
+    else:
+        try:
+            resolved_peer = await client.get_input_entity(peer)
+        except Exception as exc:
+            log.debug("History peer resolve failed for %s: %s", peer, exc)
     try:
         messages = await client.get_messages(resolved_peer, limit=limit)
     except Exception as exc:
@@ -2900,6 +3163,17 @@ def _format_ai_recommendations_block(pr: "PendingAIReply") -> Optional[str]:
     return "\n".join(lines)
 
 
+def _format_ai_drafts_block(drafts: Sequence[str]) -> Optional[str]:
+    """Preview of variants still being generated; no buttons until they're final."""
+
+    if not any((draft or "").strip() for draft in drafts):
+        return None
+    lines = ["🤖 Рекомендации ИИ (генерируются…):"]
+    for i, draft in enumerate(drafts, start=1):
+        lines.append(f"{i}) {html.escape((draft or '').strip())}▍")
+    return "\n".join(lines)
+
+
 def _build_notification_buttons(
     ctx_id: str,
     thread_id: str,
@@ -2926,7 +3200,153 @@ def _build_notification_buttons(
     return rows
 
 
+def _render_notification_thread(
+    thread_id: str,
+    state: _NotificationThreadState,
+    collapsed: Optional[bool] = None,
+) -> Tuple[str, List[List[Button]]]:
+    """Render text and buttons; ``collapsed`` overrides the stored history state.
+
+    AI buttons are appended only when present — a streaming draft has a block
+    but no buttons yet.
+    """
+
+    if collapsed is None:
+        collapsed = state.history_collapsed
+    buttons = _build_notification_buttons(state.ctx_id, thread_id, collapsed)
+    if state.ai_buttons:
+        buttons = [*buttons, *state.ai_buttons]
+    text = _build_notification_text(
+        state.header_lines,
+        state.bullets,
+        state.history_html,
+        collapsed,
+        state.ai_block,
+    )
+    return text, buttons
+
+
+async def refresh_notification_thread(admin_id: int, thread_id: str) -> bool:
+    """Re-render a notification from its current state and edit it in place.
+
+    Returns False only when the notification message is gone and has to be
+    reposted. On FloodWait or a transient error the state is marked dirty
+    again with ``retry_after`` set, so the flush loop renders it later.
+    """
+
+    state = notification_threads.get(admin_id, {}).get(thread_id)
+    if state is None or not state.message_id:
+        return False
+    if state.edit_lock is None:
+        state.edit_lock = asyncio.Lock()
+    async with state.edit_lock:
+        text, buttons = _render_notification_thread(thread_id, state)
+        try:
+            await bot_client.edit_message(
+                admin_id,
+                state.message_id,
+                text,
+                buttons=buttons,
+                parse_mode="html",
+                link_preview=False,
+            )
+        except MessageNotModifiedError:
+            pass
+        except MessageIdInvalidError:
+            log.debug("Уведомление %s удалено, будет отправлено заново", thread_id)
+            return False
+        except FloodWaitError as exc:
+            log.debug("Правка уведомления %s упёрлась в FloodWait %ss", thread_id, exc.seconds)
+            state.dirty = True
+            state.retry_after = float(exc.seconds)
+            return True
+        except Exception as exc:
+            state.edit_failures += 1
+            if state.edit_failures > NOTIFICATION_EDIT_MAX_RETRIES:
+                log.warning("Не удалось обновить уведомление %s: %s", thread_id, exc)
+                state.edit_failures = 0
+                return True
+            log.debug("Не удалось обновить уведомление %s, повторю: %s", thread_id, exc)
+            state.dirty = True
+            state.retry_after = min(
+                NOTIFICATION_EDIT_RETRY_MAX_SECONDS,
+                NOTIFICATION_EDIT_DEBOUNCE_SECONDS * 2 ** state.edit_failures,
+            )
+            return True
+    state.edit_failures = 0
+    persist_notification_thread(admin_id, thread_id, state)
+    return True
+
+
+def schedule_notification_refresh(admin_id: int, thread_id: str) -> None:
+    """Coalesce notification edits of one thread into a single debounced edit.
+
+    Changes made while a flush is pending or in flight mark the state dirty
+    again, so the flush loop always renders the final state.
+    """
+
+    state = notification_threads.get(admin_id, {}).get(thread_id)
+    if state is None:
+        return
+    state.dirty = True
+    if state.refresh_task is None or state.refresh_task.done():
+        state.refresh_task = asyncio.create_task(
+            _flush_notification_thread(admin_id, thread_id, state)
+        )
+
+
+async def _flush_notification_thread(
+    admin_id: int, thread_id: str, state: _NotificationThreadState
+) -> None:
+    while state.dirty:
+        delay = max(NOTIFICATION_EDIT_DEBOUNCE_SECONDS, state.retry_after)
+        state.retry_after = 0.0
+        await asyncio.sleep(delay)
+        if notification_threads.get(admin_id, {}).get(thread_id) is not state:
+            return
+        state.dirty = False
+        if not await refresh_notification_thread(admin_id, thread_id):
+            if not await _repost_notification_thread(admin_id, thread_id, state):
+                return
+
+
+async def _repost_notification_thread(
+    admin_id: int, thread_id: str, state: _NotificationThreadState
+) -> bool:
+    """Send the thread as a new message when its notification is gone.
+
+    The state stays registered while the message is being sent, so refreshes
+    scheduled meanwhile only mark it dirty and the flush loop applies them to
+    the new message. Returns False if the repost failed and the thread was
+    dropped.
+    """
+
+    phone, chat_id = _parse_history_thread_id(thread_id)
+    reply_context_key = (phone, chat_id)
+    # Старый id больше не годится — не даём повторно использовать его как тред ответа
+    if _admin_reply_threads[admin_id].get(reply_context_key) == state.message_id:
+        _admin_reply_threads[admin_id].pop(reply_context_key, None)
+    text, buttons = _render_notification_thread(thread_id, state)
+    await safe_send_admin(
+        text,
+        buttons=buttons,
+        parse_mode="html",
+        link_preview=False,
+        owner_id=admin_id,
+        reply_context=reply_context_key,
+    )
+    msg_id = _admin_reply_threads[admin_id].get(reply_context_key)
+    if msg_id is None or notification_threads.get(admin_id, {}).get(thread_id) is not state:
+        if notification_threads.get(admin_id, {}).get(thread_id) is state:
+            clear_notification_thread(admin_id, thread_id)
+        return False
+    state.message_id = msg_id
+    persist_notification_thread(admin_id, thread_id, state)
+    return True
+
+
 def clear_notification_thread(admin_id: int, thread_id: str) -> None:
+    _context_store.delete("notification_threads", thread_id, owner_id=admin_id)
     threads = notification_threads.get(admin_id)
     if not threads:
         return
@@ -2935,72 +3355,101 @@ def clear_notification_thread(admin_id: int, thread_id: str) -> None:
         notification_threads.pop(admin_id, None)
 
 
+def _admin_send_kwargs(admin_id: int, reply_context: Optional[Any], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    send_kwargs = dict(kwargs)
+    if (
+        reply_context is not None
+        and "reply_to" not in send_kwargs
+        and "reply_to_msg_id" not in send_kwargs
+    ):
+        thread_map = _admin_reply_threads[admin_id]
+        reply_msg_id = thread_map.get(reply_context)
+        if reply_msg_id is not None:
+            send_kwargs["reply_to"] = reply_msg_id
+    return send_kwargs
+
+
+async def _fan_out_to_admins(
+    targets: Any,
+    send_one: Callable[[int], Any],
+    *,
+    failure_message: str,
+) -> Dict[int, Exception]:
+    """Run ``send_one(admin_id)`` for every target with bounded concurrency.
+
+    A failing target is logged and collected in the returned mapping without
+    delaying the others.
+    """
+
+    semaphore = asyncio.Semaphore(ADMIN_FANOUT_CONCURRENCY)
+    failures: Dict[int, Exception] = {}
+
+    async def run(admin_id: int) -> None:
+        async with semaphore:
+            try:
+                await send_one(admin_id)
+            except Exception as e:
+                failures[admin_id] = e
+                logging.getLogger("mgrbot").warning(failure_message, admin_id, e)
+
+    await asyncio.gather(*(run(admin_id) for admin_id in targets))
+    return failures
+
+
 async def safe_send_admin(
     text: str,
     *,
     owner_id: Optional[int] = None,
     reply_context: Optional[Any] = None,
     **kwargs,
-):
+) -> Dict[int, Exception]:
     targets = {owner_id} if owner_id is not None else all_admin_ids()
-    for admin_id in targets:
-        send_kwargs = dict(kwargs)
-        if (
-            reply_context is not None
-            and "reply_to" not in send_kwargs
-            and "reply_to_msg_id" not in send_kwargs
-        ):
-            thread_map = _admin_reply_threads[admin_id]
-            reply_msg_id = thread_map.get(reply_context)
-            if reply_msg_id is not None:
-                send_kwargs["reply_to"] = reply_msg_id
-        try:
-            msg = await bot_client.send_message(admin_id, text, **send_kwargs)
-        except Exception as e:
-            logging.getLogger("mgrbot").warning(
-                "Cannot DM admin %s yet (probably admin hasn't started the bot): %s",
-                admin_id,
-                e,
-            )
-            continue
+
+    async def send_one(admin_id: int) -> None:
+        send_kwargs = _admin_send_kwargs(admin_id, reply_context, kwargs)
+        msg = await bot_client.send_message(admin_id, text, **send_kwargs)
         if reply_context is not None:
             _admin_reply_threads[admin_id][reply_context] = msg.id
 
+    return await _fan_out_to_admins(
+        targets,
+        send_one,
+        failure_message="Cannot DM admin %s yet (probably admin hasn't started the bot): %s",
+    )
+
 
 async def safe_send_admin_file(
-    file_data: bytes,
+    file_data: Any,
     filename: str,
     *,
     owner_id: Optional[int] = None,
     reply_context: Optional[Any] = None,
     **kwargs,
-) -> None:
+) -> Dict[int, Exception]:
+    """Send ``file_data`` (bytes or a local path) to the admin targets.
+
+    The file is uploaded to the bot once and the uploaded handle is reused
+    for every target, so large attachments are neither copied per admin nor
+    re-uploaded.
+    """
+
     if not file_data:
-        return
+        return {}
     targets = {owner_id} if owner_id is not None else all_admin_ids()
-    for admin_id in targets:
-        try:
-            bio = BytesIO(file_data)
-            bio.name = filename
-            send_kwargs = dict(kwargs)
-            if (
-                reply_context is not None
-                and "reply_to" not in send_kwargs
-                and "reply_to_msg_id" not in send_kwargs
-            ):
-                thread_map = _admin_reply_threads[admin_id]
-                reply_msg_id = thread_map.get(reply_context)
-                if reply_msg_id is not None:
-                    send_kwargs["reply_to"] = reply_msg_id
-
-            result = await bot_client.send_file(admin_id, bio, **send_kwargs)
-        except Exception as e:
-            logging.getLogger("mgrbot").warning(
-                "Cannot send file to admin %s yet (probably admin hasn't started the bot): %s",
-                admin_id,
-                e,
-            )
-            continue
+    if not targets:
+        return {}
+    try:
+        uploaded = await bot_client.upload_file(file_data, file_name=filename)
+    except Exception as e:
+        log.warning("Cannot upload file %s for admins: %s", filename, e)
+        return {admin_id: e for admin_id in targets}
+    if isinstance(file_data, str) and "attributes" not in kwargs:
+        with contextlib.suppress(Exception):
+            kwargs["attributes"], kwargs["mime_type"] = get_attributes(file_data)
+
+    async def send_one(admin_id: int) -> None:
+        send_kwargs = _admin_send_kwargs(admin_id, reply_context, kwargs)
+        result = await bot_client.send_file(admin_id, uploaded, **send_kwargs)
         if reply_context is not None:
             if isinstance(result, (list, tuple)):
                 last_msg = result[-1] if result else None
@@ -3009,6 +3458,12 @@ async def safe_send_admin_file(
             if last_msg is not None and hasattr(last_msg, "id"):
                 _admin_reply_threads[admin_id][reply_context] = last_msg.id
 
+    return await _fan_out_to_admins(
+        targets,
+        send_one,
+        failure_message="Cannot send file to admin %s yet (probably admin hasn't started the bot): %s",
+    )
+
 
 async def answer_callback(event: events.CallbackQuery.Event, *args, **kwargs):
     try:
@@ -3103,20 +3558,517 @@ def recompute_account_proxy_meta(owner_id: int, phone: str, meta: Dict[str, Any]
 # ---- worker ----
 
 
+class _InputPeerCache:
+    """Persistent per-account cache of ``user_id -> access_hash`` pairs.
+
+    ``StringSession`` does not keep Telethon's entity cache between restarts,
+    so the first send to every chat used to cost a ``get_input_entity`` round
+    trip.  The pairs are stored next to the session file and warmed from
+    incoming updates, which lets the send paths build ``InputPeerUser``
+    locally.  Changes mark the cache dirty and are written from a worker
+    thread at most every ``ENTITY_CACHE_FLUSH_DELAY_SECONDS``; :meth:`flush`
+    writes the rest when the account stops.
+    """
+
+    def __init__(self, path: str, limit: int = ENTITY_CACHE_LIMIT):
+        self.path = path
+        self.limit = max(1, int(limit))
+        self._users: "OrderedDict[int, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self._dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        raw = _ensure_dict(_load(self.path, {}))
+        for key, value in _ensure_dict(raw.get("users")).items():
+            try:
+                self._users[int(key)] = int(value)
+            except (TypeError, ValueError):
+                continue
+
+    def _snapshot(self) -> Dict[str, Any]:
+        return {"users": {str(user_id): access_hash for user_id, access_hash in self._users.items()}}
+
+    def _write(self, payload: Dict[str, Any]) -> None:
+        with self._write_lock:
+            try:
+                _save(payload, self.path)
+            except OSError as exc:
+                log.warning("Не удалось сохранить кэш сущностей %s: %s", self.path, exc)
+
+    def _mark_dirty(self) -> None:
+        self._dirty = True
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(ENTITY_CACHE_FLUSH_DELAY_SECONDS)
+        if not self._dirty:
+            return
+        self._dirty = False
+        await asyncio.to_thread(self._write, self._snapshot())
+
+    def flush(self) -> None:
+        """Write pending changes now (blocking); used when the worker stops."""
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if not self._dirty:
+            return
+        self._dirty = False
+        self._write(self._snapshot())
+
+    def remember(self, entity: Any) -> None:
+        """Store the access hash of a user/input peer if it is usable."""
+
+        if entity is None or getattr(entity, "min", False):
+            return
+        if isinstance(entity, User):
+            user_id = entity.id
+        else:
+            user_id = getattr(entity, "user_id", None)
+        access_hash = getattr(entity, "access_hash", None)
+        if not isinstance(user_id, int) or not isinstance(access_hash, int):
+            return
+        if self._users.get(user_id) == access_hash:
+            self._users.move_to_end(user_id)
+            return
+        self._users[user_id] = access_hash
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.limit:
+            self._users.popitem(last=False)
+        self._mark_dirty()
+
+    def forget(self, user_id: int) -> None:
+        if self._users.pop(user_id, None) is not None:
+            self._mark_dirty()
+
+    def lookup(self, chat_id: Any) -> Optional[types.InputPeerUser]:
+        if not isinstance(chat_id, int) or isinstance(chat_id, bool):
+            return None
+        access_hash = self._users.get(chat_id)
+        if access_hash is None:
+            return None
+        self._users.move_to_end(chat_id)
+        return types.InputPeerUser(user_id=chat_id, access_hash=access_hash)
+
+    async def resolve(self, client: TelegramClient, chat_id: Any, peer: Optional[Any] = None) -> Any:
+        """Return an input peer for *chat_id*, hitting Telegram only on a miss."""
+
+        if peer is not None and not isinstance(peer, int):
+            self.remember(peer)
+            return peer
+        target = peer if peer is not None else chat_id
+        cached = self.lookup(target)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        try:
+            resolved = await client.get_input_entity(target)
+        except Exception as exc:
+            self.failures += 1
+            log.debug("Peer resolve failed for %s: %s", target, exc)
+            return target
+        self.remember(resolved)
+        return resolved
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "hit_rate": round(self.hit_rate, 3),
+        }
+
+
+class _ContactProfile:
+    __slots__ = ("name", "username", "is_bot", "stamp")
+
+    def __init__(self, name: Optional[str], username: Optional[str], is_bot: bool) -> None:
+        self.name = name
+        self.username = username
+        self.is_bot = is_bot
+        self.stamp = time.monotonic()
+
+
+class _ContactProfileCache:
+    """Per-account contact profiles (display name, username, bot flag).
+
+    Filled from the entities that arrive with updates and refreshed by
+    ``UpdateUserName``, so chatty contacts don't need ``get_sender`` and
+    display-name formatting on every message.
+    """
+
+    def __init__(self, limit: int = CONTACT_PROFILE_LIMIT, ttl: float = CONTACT_PROFILE_TTL_SECONDS) -> None:
+        self._profiles: "OrderedDict[int, _ContactProfile]" = OrderedDict()
+        self._limit = limit
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: Optional[int]) -> Optional[_ContactProfile]:
+        if user_id is None:
+            return None
+        profile = self._profiles.get(user_id)
+        if profile is None or time.monotonic() - profile.stamp > self._ttl:
+            if profile is not None:
+                self._profiles.pop(user_id, None)
+            self.misses += 1
+            return None
+        self._profiles.move_to_end(user_id)
+        self.hits += 1
+        return profile
+
+    def _store(self, user_id: int, profile: _ContactProfile) -> _ContactProfile:
+        self._profiles[user_id] = profile
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self._limit:
+            self._profiles.popitem(last=False)
+        return profile
+
+    def remember(self, entity: Any) -> Optional[_ContactProfile]:
+        if not isinstance(entity, User):
+            return None
+        name = get_display_name(entity) or None
+        return self._store(entity.id, _ContactProfile(name, entity.username, bool(entity.bot)))
+
+    def apply_name_update(self, update: Any) -> None:
+        user_id = getattr(update, "user_id", None)
+        previous = self._profiles.get(user_id) if user_id is not None else None
+        if previous is None:
+            return
+        name = " ".join(
+            part for part in (getattr(update, "first_name", None), getattr(update, "last_name", None)) if part
+        ) or None
+        usernames = getattr(update, "usernames", None) or []
+        username = getattr(update, "username", None)
+        for item in usernames:
+            if getattr(item, "active", True):
+                username = getattr(item, "username", None)
+                break
+        self._store(user_id, _ContactProfile(name, username, previous.is_bot))
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._profiles),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
 @dataclass
-class _SendQueueItem:
+class _LaneItem:
     future: asyncio.Future
     chat_id: int
-    message: str
-    peer: Optional[Any]
-    reply_to_msg_id: Optional[int]
-    mark_read_msg_id: Optional[int]
+    kind: str
+    factory: Callable[[], Any]
+    enqueued_at: float
+
+
+class _ChatLaneScheduler:
+    """Per-account scheduler with one ordered lane per chat.
+
+    Items for the same chat run strictly in submission order, while
+    different chats are served concurrently up to ``concurrency`` at a time.
+    With ``max_backlog`` set, :meth:`enqueue` waits while that many items are
+    queued and admits waiting producers strictly in arrival order. This only
+    throttles the source if the producer itself awaits ``enqueue`` — for
+    incoming updates the client is created with ``sequential_updates=True``
+    so Telethon's update loop is the one that waits. Queue depth and wait
+    times are tracked for diagnostics. Used for outgoing sends and for
+    incoming update dispatch.
+    """
+
+    def __init__(
+        self,
+        label: str,
+        concurrency: int,
+        *,
+        max_backlog: int = 0,
+        closed_message: str = "Отправка отменена: аккаунт остановлен",
+    ) -> None:
+        self._label = label
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._max_backlog = max_backlog
+        self._closed_message = closed_message
+        self._lanes: Dict[int, "deque[_LaneItem]"] = {}
+        self._lane_tasks: Dict[int, asyncio.Task] = {}
+        self._queued = 0
+        self._reserved = 0
+        self._space_waiters: "deque[asyncio.Future]" = deque()
+        self._closed = False
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.throttled = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def depth(self) -> int:
+        return self._queued
+
+    async def enqueue(self, chat_id: int, kind: str, factory: Callable[[], Any]) -> asyncio.Future:
+        """Queue ``factory()`` for ``chat_id`` and return its future without awaiting it."""
+
+        await self._reserve_space()
+        if self._closed:
+            raise RuntimeError(self._closed_message)
+        loop = asyncio.get_running_loop()
+        item = _LaneItem(
+            future=loop.create_future(),
+            chat_id=chat_id,
+            kind=kind,
+            factory=factory,
+            enqueued_at=time.monotonic(),
+        )
+        self._lanes.setdefault(chat_id, deque()).append(item)
+        self._queued += 1
+        self.submitted += 1
+        task = self._lane_tasks.get(chat_id)
+        if task is None or task.done():
+            self._lane_tasks[chat_id] = asyncio.create_task(self._run_lane(chat_id))
+        return item.future
+
+    async def submit(self, chat_id: int, kind: str, factory: Callable[[], Any]) -> Any:
+        return await (await self.enqueue(chat_id, kind, factory))
+
+    async def _reserve_space(self) -> None:
+        """Wait for a backlog slot; producers are admitted first come, first served."""
+
+        if not self._max_backlog or self._closed:
+            return
+        if not self._space_waiters and self._queued + self._reserved < self._max_backlog:
+            return
+        self.throttled += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._space_waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just before cancellation: hand it on.
+                self._reserved -= 1
+                self._admit_waiters()
+            else:
+                with contextlib.suppress(ValueError):
+                    self._space_waiters.remove(waiter)
+            raise
+        self._reserved -= 1
+
+    def _admit_waiters(self) -> None:
+        while self._space_waiters and (
+            self._closed or self._queued + self._reserved < self._max_backlog
+        ):
+            waiter = self._space_waiters.popleft()
+            if waiter.done():
+                continue
+            self._reserved += 1
+            waiter.set_result(None)
+
+    def _dequeued(self) -> None:
+        self._queued -= 1
+        if self._space_waiters:
+            self._admit_waiters()
+
+    async def _run_lane(self, chat_id: int) -> None:
+        try:
+            while not self._closed:
+                lane = self._lanes.get(chat_id)
+                if not lane:
+                    break
+                item = lane[0]
+                if item.future.cancelled():
+                    lane.popleft()
+                    self._dequeued()
+                    continue
+                async with self._slots:
+                    # close() may have drained the lane while we waited.
+                    if self._closed or not lane or lane[0] is not item:
+                        continue
+                    lane.popleft()
+                    self._dequeued()
+                    if item.future.cancelled():
+                        continue
+                    waited = time.monotonic() - item.enqueued_at
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+                    if waited > 5:
+                        log.debug(
+                            "[%s] %s for %s waited %.1fs in queue (depth=%d)",
+                            self._label,
+                            item.kind,
+                            chat_id,
+                            waited,
+                            self.depth(),
+                        )
+                    try:
+                        result = await item.factory()
+                    except asyncio.CancelledError:
+                        self.failed += 1
+                        if not item.future.done():
+                            item.future.cancel()
+                        raise
+                    except Exception as exc:
+                        self.failed += 1
+                        if not item.future.done():
+                            item.future.set_exception(exc)
+                    else:
+                        self.completed += 1
+                        if not item.future.done():
+                            item.future.set_result(result)
+        except asyncio.CancelledError:
+            # Nobody will serve the rest of this lane: don't leave callers hanging.
+            lane = self._lanes.get(chat_id)
+            while lane:
+                pending = lane.popleft()
+                self._dequeued()
+                if not pending.future.done():
+                    pending.future.cancel()
+            raise
+        finally:
+            lane = self._lanes.get(chat_id)
+            if lane is not None and not lane:
+                self._lanes.pop(chat_id, None)
+            if self._lane_tasks.get(chat_id) is asyncio.current_task():
+                self._lane_tasks.pop(chat_id, None)
+
+    async def close(self) -> None:
+        """Finish in-flight items and fail everything still waiting."""
+
+        self._closed = True
+        self._admit_waiters()
+        for lane in self._lanes.values():
+            while lane:
+                item = lane.popleft()
+                self._queued -= 1
+                if not item.future.done():
+                    item.future.set_exception(RuntimeError(self._closed_message))
+        tasks = list(self._lane_tasks.values())
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._lanes.clear()
+        self._lane_tasks.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        started = self.completed + self.failed
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "depth": self.depth(),
+            "throttled": self.throttled,
+            "active_chats": len(self._lane_tasks),
+            "avg_wait": round(self.wait_total / started, 3) if started else 0.0,
+            "max_wait": round(self.wait_max, 3),
+        }
+
+
+class FloodWaitActive(RuntimeError):
+    """Raised instead of calling a method that is still under FloodWait."""
+
+    def __init__(self, method: str, seconds: float) -> None:
+        self.method = method
+        self.seconds = max(0, int(seconds + 0.999))
+        super().__init__(
+            f"Telegram временно ограничил запросы ({method}), повторите через {self.seconds} с"
+        )
+
+
+class _FloodScheduler:
+    """Flood deadlines per ``(phone, method)`` with deferred retries.
+
+    Calls made inside an active window fail fast with :class:`FloodWaitActive`
+    instead of sleeping inline. Work queued with :meth:`defer` runs
+    automatically once the window for its key opens.
+    """
+
+    def __init__(self) -> None:
+        self._deadlines: Dict[Tuple[str, str], float] = {}
+        self._deferred: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    def remaining(self, phone: str, method: str) -> float:
+        deadline = self._deadlines.get((phone, method))
+        if deadline is None:
+            return 0.0
+        left = deadline - time.monotonic()
+        if left <= 0:
+            self._deadlines.pop((phone, method), None)
+            return 0.0
+        return left
+
+    def check(self, phone: str, method: str) -> None:
+        left = self.remaining(phone, method)
+        if left > 0:
+            raise FloodWaitActive(method, left)
+
+    def record(self, phone: str, method: str, error: Exception) -> FloodWaitActive:
+        wait = getattr(error, "seconds", getattr(error, "value", 60)) or 0
+        wait = float(wait) + FLOOD_WAIT_PADDING_SECONDS
+        self._deadlines[(phone, method)] = time.monotonic() + wait
+        log.warning("[%s] flood wait %ss on %s", phone, int(wait), method)
+        return FloodWaitActive(method, wait)
+
+    def defer(self, phone: str, method: str, factory: Callable[[], Any]) -> None:
+        """Run ``factory()`` once the flood window for ``(phone, method)`` opens."""
+
+        key = (phone, method)
+        previous = self._deferred.pop(key, None)
+        if previous is not None and not previous.done():
+            previous.cancel()
+
+        async def runner() -> None:
+            try:
+                delay = self.remaining(phone, method)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await factory()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("[%s] deferred %s failed: %s", phone, method, e)
+            finally:
+                if self._deferred.get(key) is asyncio.current_task():
+                    self._deferred.pop(key, None)
+
+        self._deferred[key] = asyncio.create_task(runner())
+
+    def cancel_account(self, phone: str) -> None:
+        for key in [k for k in self._deferred if k[0] == phone]:
+            task = self._deferred.pop(key)
+            if not task.done():
+                task.cancel()
+        for key in [k for k in self._deadlines if k[0] == phone]:
+            self._deadlines.pop(key, None)
+
+
+_flood_scheduler = _FloodScheduler()
 
 
 class AccountWorker:
     def __init__(self, owner_id: int, phone: str, api_id: int, api_hash: str, device: Dict[str,str], session_str: Optional[str]):
         self.owner_id = owner_id
-        self.phone = phone
+        # Телефон попадает во все runtime-записи аккаунта — держим одну копию
+        self.phone = sys.intern(phone)
         self.api_id = api_id
         self.api_hash = api_hash
         self.device = device
@@ -3132,14 +4084,68 @@ class AccountWorker:
         self._proxy_override_signature: Optional[str] = None
         self._proxy_forced_off: bool = False
         self._proxy_force_reason: Optional[str] = None
-        self._send_queue: asyncio.Queue = asyncio.Queue()
-        self._send_worker_task: Optional[asyncio.Task] = None
+        self._send_scheduler = _ChatLaneScheduler(phone, SEND_CHAT_CONCURRENCY)
+        self._update_dispatcher = self._make_update_dispatcher()
         self._last_code_delivery: Optional[str] = None
+        self.entity_cache = _InputPeerCache(user_entity_cache_path(owner_id, phone))
+        self.contact_profiles = _ContactProfileCache()
+        self._authorized: Optional[bool] = None
+        self._auth_checked_at: float = 0.0
+        self._background_tasks: Set[asyncio.Task] = set()
+
+    def _spawn_background(self, coro: Any, what: str) -> asyncio.Task:
+        """Run *coro* detached from the update lane; failures are logged, stop() cancels it."""
+
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+
+        def done(finished: asyncio.Task) -> None:
+            self._background_tasks.discard(finished)
+            if finished.cancelled():
+                return
+            error = finished.exception()
+            if error is not None:
+                log.warning(
+                    "[%s] %s failed: %s",
+                    self.phone,
+                    what,
+                    error,
+                    exc_info=(type(error), error, error.__traceback__),
+                )
+
+        task.add_done_callback(done)
+        return task
+
+    async def _cancel_background_tasks(self) -> None:
+        tasks = list(self._background_tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     def _reset_session_state(self) -> None:
         with contextlib.suppress(FileNotFoundError):
             os.remove(self.session_file)
         self.session = StringSession()
+        self._set_authorized(None)
+
+    def _set_authorized(self, value: Optional[bool]) -> None:
+        """Record the authorization state; ``None`` forces a re-check."""
+
+        self._authorized = value
+        self._auth_checked_at = time.monotonic() if value is not None else 0.0
+
+    async def _authorized_client(self) -> TelegramClient:
+        client = await self._ensure_client()
+        fresh = (
+            self._authorized is True
+            and time.monotonic() - self._auth_checked_at < AUTH_STATE_TTL_SECONDS
+        )
+        if not fresh:
+            self._set_authorized(bool(await client.is_user_authorized()))
+        if not self._authorized:
+            raise RuntimeError("Аккаунт не авторизован")
+        return client
 
     def _set_session_invalid_flag(self, invalid: bool) -> None:
         meta = get_account_meta(self.owner_id, self.phone)
@@ -3185,6 +4191,7 @@ class AccountWorker:
         prev_state = meta.get("state")
         prev_note = meta.get("state_note")
         self._set_account_state(state, str(error))
+        self._set_authorized(False)
         if self._keepalive_task and not self._keepalive_task.done():
             self._keepalive_task.cancel()
         self._keepalive_task = None
@@ -3218,6 +4225,7 @@ class AccountWorker:
         self.client = None
         self.started = False
         self._reset_session_state()
+        self._set_authorized(False)
         self._set_session_invalid_flag(True)
         unregister_worker(self.owner_id, self.phone)
         await safe_send_admin(
@@ -3229,11 +4237,24 @@ class AccountWorker:
             parse_mode="html",
         )
 
-    def _update_proxy_meta(self) -> None:
-        meta = ensure_account_meta(self.owner_id, self.phone)
-        changed = False
-        if meta.get("proxy_desc") != self._proxy_desc:
-            meta["proxy_desc"] = self._proxy_desc
+    async def _handle_session_unauthorized(self, error: Optional[Exception]) -> None:
+        log.warning("[%s] session is no longer authorized: %s", self.phone, error)
+        self._set_authorized(False)
+        self._set_session_invalid_flag(True)
+        await safe_send_admin(
+            (
+                f"⚠️ <b>{self.phone}</b>: сессия больше не авторизована."
+                " Добавь аккаунт заново, чтобы войти."
+            ),
+            owner_id=self.owner_id,
+            parse_mode="html",
+        )
+
+    def _update_proxy_meta(self) -> None:
+        meta = ensure_account_meta(self.owner_id, self.phone)
+        changed = False
+        if meta.get("proxy_desc") != self._proxy_desc:
+            meta["proxy_desc"] = self._proxy_desc
             changed = True
         if meta.get("proxy_dynamic") != self._proxy_dynamic:
             meta["proxy_dynamic"] = self._proxy_dynamic
@@ -3269,58 +4290,52 @@ class AccountWorker:
             await self.client.disconnect()
         self.client = None
 
-    def _ensure_send_worker(self) -> None:
-        if self._send_worker_task is None or self._send_worker_task.done():
-            self._send_worker_task = asyncio.create_task(self._send_queue_worker())
+    async def _resolve_peer(self, client: TelegramClient, chat_id: int, peer: Optional[Any]) -> Any:
+        return await self.entity_cache.resolve(client, chat_id, peer)
 
-    async def _send_queue_worker(self) -> None:
-        while True:
-            item = await self._send_queue.get()
-            if item is None:
-                self._send_queue.task_done()
-                break
-            if item.future.cancelled():
-                self._send_queue.task_done()
-                continue
-            try:
-                result = await self._send_outgoing_impl(
-                    chat_id=item.chat_id,
-                    message=item.message,
-                    peer=item.peer,
-                    reply_to_msg_id=item.reply_to_msg_id,
-                    mark_read_msg_id=item.mark_read_msg_id,
+    async def _schedule_send(self, chat_id: int, kind: str, factory: Callable[[], Any]) -> Any:
+        return await self._send_scheduler.submit(chat_id, kind, factory)
+
+    def send_queue_stats(self) -> Dict[str, Any]:
+        return self._send_scheduler.stats()
+
+    def _make_update_dispatcher(self) -> _ChatLaneScheduler:
+        return _ChatLaneScheduler(
+            f"{self.phone}/updates",
+            UPDATE_CHAT_CONCURRENCY,
+            max_backlog=UPDATE_BACKLOG_LIMIT,
+            closed_message="Обработка отменена: аккаунт остановлен",
+        )
+
+    def update_queue_stats(self) -> Dict[str, Any]:
+        return self._update_dispatcher.stats()
+
+    async def _dispatch_update(self, chat_id: int, kind: str, handler: Callable[[], Any]) -> None:
+        """Hand an update to the per-chat dispatcher; errors are logged, not raised."""
+
+        try:
+            future = await self._update_dispatcher.enqueue(chat_id, kind, handler)
+        except RuntimeError as e:
+            log.debug("[%s] update for %s dropped: %s", self.phone, chat_id, e)
+            return
+
+        def report(done: asyncio.Future) -> None:
+            if done.cancelled():
+                return
+            error = done.exception()
+            if error is not None:
+                log.warning(
+                    "[%s] %s handler failed for %s: %s", self.phone, kind, chat_id, error,
+                    exc_info=error,
                 )
-            except Exception as exc:
-                if not item.future.done():
-                    item.future.set_exception(exc)
-            else:
-                if not item.future.done():
-                    item.future.set_result(result)
-            finally:
-                self._send_queue.task_done()
+
+        future.add_done_callback(report)
 
     async def _shutdown_send_worker(self) -> None:
-        if self._send_worker_task is not None:
-            await self._send_queue.put(None)
-            try:
-                await self._send_worker_task
-            except asyncio.CancelledError:
-                pass
-            self._send_worker_task = None
-        while True:
-            try:
-                leftover = self._send_queue.get_nowait()
-            except asyncio.QueueEmpty:
-                break
-            if leftover is None:
-                self._send_queue.task_done()
-                continue
-            if not leftover.future.done():
-                leftover.future.set_exception(
-                    RuntimeError("Отправка отменена: аккаунт остановлен")
-                )
-            self._send_queue.task_done()
-        self._send_queue = asyncio.Queue()
+        scheduler = self._send_scheduler
+        self._send_scheduler = _ChatLaneScheduler(self.phone, SEND_CHAT_CONCURRENCY)
+        await scheduler.close()
+        log.info("[%s] send queue stats: %s", self.phone, scheduler.stats())
 
     async def _send_outgoing_impl(
         self,
@@ -3331,14 +4346,8 @@ class AccountWorker:
         reply_to_msg_id: Optional[int],
         mark_read_msg_id: Optional[int],
     ):
-        client = await self._ensure_client()
-        if not await client.is_user_authorized():
-            raise RuntimeError("Аккаунт не авторизован")
-        if peer is None:
-            try:
-                peer = await client.get_input_entity(chat_id)
-            except Exception:
-                peer = chat_id
+        client = await self._authorized_client()
+        peer = await self._resolve_peer(client, chat_id, peer)
         await self._simulate_typing(client, peer, message)
         try:
             sent = await client.send_message(peer, message, reply_to=reply_to_msg_id)
@@ -3359,6 +4368,9 @@ class AccountWorker:
         except UserDeactivatedError as e:
             await self._handle_account_disabled("frozen", e)
             raise RuntimeError("Аккаунт заморожен Telegram")
+        except UnauthorizedError as e:
+            self._set_authorized(None)
+            raise RuntimeError("Аккаунт не авторизован") from e
         return sent
 
     def _select_proxy(self, *, force_new: bool = False) -> Optional[Tuple]:
@@ -3465,6 +4477,9 @@ class AccountWorker:
             system_version=self.device.get("system_version"),
             app_version=self.device.get("app_version"),
             lang_code=self.device.get("lang_code"),
+            # Handlers run one at a time so awaiting the update dispatcher
+            # actually holds back Telethon when the backlog is full.
+            sequential_updates=True,
         )
     
     async def _simulate_chat_action(
@@ -3513,6 +4528,39 @@ class AccountWorker:
         duration = _video_upload_duration(file_path)
         await self._simulate_chat_action(client, peer, "upload-video", duration)
 
+    async def _upload_during_action(
+        self,
+        client: TelegramClient,
+        file_path: str,
+        action: Any,
+        **attr_kwargs: Any,
+    ) -> Tuple[Any, Optional[List[Any]], Optional[str]]:
+        """Upload ``file_path`` while the chat-action coroutine is running.
+
+        Returns ``(file, attributes, mime_type)`` ready for ``send_file``.
+        The attributes are computed from the local path, since an uploaded
+        handle no longer carries duration or dimensions. If the upload fails,
+        the original path is returned and ``send_file`` uploads it again.
+        """
+
+        upload = asyncio.create_task(client.upload_file(file_path))
+        try:
+            await action
+        except BaseException:
+            upload.cancel()
+            raise
+        try:
+            handle = await upload
+        except Exception as e:
+            log.warning("[%s] background upload of %s failed: %s", self.phone, file_path, e)
+            return file_path, None, None
+        try:
+            attributes, mime_type = get_attributes(file_path, **attr_kwargs)
+        except Exception as e:
+            log.debug("[%s] unable to read attributes of %s: %s", self.phone, file_path, e)
+            return handle, None, None
+        return handle, attributes, mime_type
+
     async def _ensure_client(self) -> TelegramClient:
         if not self.client:
             self.client = self._make_client()
@@ -3532,7 +4580,9 @@ class AccountWorker:
     async def start(self):
         try:
             self.client = await self._ensure_client()
-            if not await self.client.is_user_authorized():
+            authorized = bool(await self.client.is_user_authorized())
+            self._set_authorized(authorized)
+            if not authorized:
                 return
             
             try:
@@ -3553,19 +4603,31 @@ class AccountWorker:
             if changed:
                 persist_tenants()
 
+            @self.client.on(events.Raw(types.UpdateUserName))
+            async def on_user_name(update):
+                self.contact_profiles.apply_name_update(update)
+
             @self.client.on(events.NewMessage(incoming=True))
             async def on_new(ev):
                 # Фильтр: принимаем только личные чаты
                 if not ev.is_private:
                     return
+                await self._dispatch_update(ev.chat_id, "new_message", lambda: process_new(ev))
 
-                # Получаем информацию об отправителе для проверки на бота
-                sender_entity = None
-                with contextlib.suppress(Exception):
-                    sender_entity = await ev.get_sender()
+            async def process_new(ev):
+                notify_started = time.monotonic()
+
+                # Профиль отправителя: сначала кэш, иначе сущность из апдейта
+                profile = self.contact_profiles.get(ev.sender_id)
+                if profile is None:
+                    sender_entity = None
+                    with contextlib.suppress(Exception):
+                        sender_entity = await ev.get_sender()
+                    profile = self.contact_profiles.remember(sender_entity)
+                    self.entity_cache.remember(sender_entity)
 
                 # Фильтр: игнорируем сообщения от ботов
-                if getattr(sender_entity, "bot", False):
+                if profile is not None and profile.is_bot:
                     return
 
                 txt = (ev.raw_text or "").strip()
@@ -3587,27 +4649,15 @@ class AccountWorker:
                         peer = await ev.get_input_sender()
                     except Exception:
                         peer = None
-                # AI автоответчик (шаблоны + GPT-подсказки)
-                ai_task_id: Optional[str] = None
-                try:
-                    ai_task_id = await handle_ai_autoreply(self, ev, peer)
-                except Exception as ai_err:
-                    log.warning("[%s] ошибка AI-автоответа: %s", self.phone, ai_err)
-                ai_block: Optional[str] = None
-                ai_buttons: Optional[List[List[Button]]] = None
-                if ai_task_id:
-                    pr = pending_ai_replies.get(ai_task_id)
-                    if pr:
-                        ai_block = _format_ai_recommendations_block(pr)
-                        _, ai_buttons = _format_ai_variants_for_admin(ai_task_id, pr)
+                self.entity_cache.remember(peer)
 
                 account_meta = get_account_meta(self.owner_id, self.phone) or {}
                 account_display = self.account_name or account_meta.get("full_name")
                 if not account_display:
                     account_display = self.phone
 
-                sender_name = get_display_name(sender_entity) if sender_entity else None
-                sender_username = getattr(sender_entity, "username", None) if sender_entity else None
+                sender_name = profile.name if profile else None
+                sender_username = profile.username if profile else None
                 if not sender_name:
                     chat_entity = getattr(ev, "chat", None)
                     if chat_entity is not None:
@@ -3643,10 +4693,7 @@ class AccountWorker:
                         )
                         if reply_preview_html:
                             header_lines.append(f"📝 Цитата: {reply_preview_html}")
-                media_bytes: Optional[bytes] = None
-                media_filename: Optional[str] = None
                 media_description: Optional[str] = None
-                media_notice: Optional[str] = None
                 file_obj = getattr(ev, "file", None)
                 media_size = getattr(file_obj, "size", None)
                 has_media = bool(getattr(ev, "media", None))
@@ -3660,127 +4707,51 @@ class AccountWorker:
                     if size_display:
                         description_line += f" ({size_display})"
                     header_lines.append(description_line)
+                download_media = False
                 if has_media:
                     if media_size and media_size > MAX_MEDIA_FORWARD_SIZE:
                         formatted_limit = _format_filesize(MAX_MEDIA_FORWARD_SIZE)
                         formatted_size = _format_filesize(media_size)
-                        media_notice = (
-                            f"⚠️ Файл {html.escape(media_description or 'медиа')} "
-                            f"({formatted_size}) превышает лимит авто-перенаправления"
-                            f" ({formatted_limit})."
+                        header_lines.extend(
+                            [
+                                "",
+                                f"⚠️ Файл {html.escape(media_description or 'медиа')} "
+                                f"({formatted_size}) превышает лимит авто-перенаправления"
+                                f" ({formatted_limit}).",
+                            ]
                         )
                     else:
-                        buffer = BytesIO()
-                        try:
-                            downloaded = await ev.download_media(file=buffer)
-                            if downloaded is not None:
-                                media_bytes = buffer.getvalue()
-                        except Exception as download_error:
-                            media_notice = (
-                                "⚠️ Не удалось скачать вложение: "
-                                f"{html.escape(str(download_error))}"
-                            )
-                        finally:
-                            buffer.close()
-                        if media_bytes:
-                            media_filename = _resolve_media_filename(ev, media_code)
-                        elif media_notice is None:
-                            media_notice = "⚠️ Вложение не удалось скачать."
-                if media_notice:
-                    header_lines.extend(["", media_notice])
-
-                reply_contexts[ctx_id] = {
-                    "owner_id": self.owner_id,
-                    "phone": self.phone,
-                    "chat_id": ev.chat_id,
-                    "sender_id": ev.sender_id,
-                    "peer": peer,
-                    "msg_id": ev.id,
-                }
+                        download_media = True
+
+                store_reply_context(
+                    ctx_id,
+                    ReplyContext(
+                        self.owner_id, self.phone, ev.chat_id, ev.sender_id, peer, ev.id
+                    ),
+                )
                 reply_context_key = (self.phone, ev.chat_id)
                 thread_id = _make_thread_id(self.phone, ev.chat_id)
                 bullet_entry = _format_incoming_bullet(txt, media_description)
-                history_html = await _build_history_html(
-                    self.client, peer or ev.chat_id, limit=MAX_HISTORY_MESSAGES
-                )
-                header_snapshot = list(header_lines)
-                state_map = notification_threads.setdefault(self.owner_id, {})
-                state = state_map.get(thread_id)
+                header_snapshot = header_lines
+                state_map = notification_threads[self.owner_id]
+                state = await get_notification_thread(self.owner_id, thread_id)
                 if state:
                     state.bullets.append(bullet_entry)
                     if len(state.bullets) > MAX_NOTIFICATION_BULLETS:
                         state.bullets = state.bullets[-MAX_NOTIFICATION_BULLETS:]
                     state.ctx_id = ctx_id
                     state.header_lines = header_snapshot
-                    state.history_html = history_html
+                    state.history_stale = True
+                    state.ai_block = None
+                    state.ai_buttons = None
                     if peer is not None:
                         state.peer = peer
-                    buttons = _build_notification_buttons(
-                        ctx_id, thread_id, state.history_collapsed
-                    )
-                    if ai_buttons:
-                        buttons = [*buttons, *ai_buttons]
-                    notification_text = _build_notification_text(
-                        state.header_lines,
-                        state.bullets,
-                        state.history_html,
-                        state.history_collapsed,
-                        ai_block,
-                    )
-                    try:
-                        await bot_client.edit_message(
-                            self.owner_id,
-                            state.message_id,
-                            notification_text,
-                            buttons=buttons,
-                            parse_mode="html",
-                            link_preview=False,
-                        )
-                    except Exception as edit_error:
-                        log.warning(
-                            "[%s] не удалось обновить уведомление: %s",
-                            self.phone,
-                            edit_error,
-                        )
-                        state_map.pop(thread_id, None)
-                        await safe_send_admin(
-                            notification_text,
-                            buttons=buttons,
-                            parse_mode="html",
-                            link_preview=False,
-                            owner_id=self.owner_id,
-                            reply_context=reply_context_key,
-                        )
-                        msg_id = _admin_reply_threads[self.owner_id].get(reply_context_key)
-                        if msg_id is not None:
-                            state_map[thread_id] = _NotificationThreadState(
-                                message_id=msg_id,
-                                thread_id=thread_id,
-                                ctx_id=ctx_id,
-                                bullets=list(state.bullets),
-                                header_lines=header_snapshot,
-                                history_html=history_html,
-                                history_collapsed=state.history_collapsed,
-                                peer=peer or state.peer,
-                                ai_block=ai_block,
-                                ai_buttons=ai_buttons,
-                            )
-                    else:
-                        state.header_lines = header_snapshot
-                        state.history_html = history_html
-                        state.ai_block = ai_block
-                        state.ai_buttons = ai_buttons
+                    schedule_notification_refresh(self.owner_id, thread_id)
                 else:
                     bullets = [bullet_entry]
-                    buttons = _build_notification_buttons(ctx_id, thread_id, True)
-                    if ai_buttons:
-                        buttons = [*buttons, *ai_buttons]
-                    notification_text = _build_notification_text(
-                        header_snapshot, bullets, history_html, True, ai_block
-                    )
                     await safe_send_admin(
-                        notification_text,
-                        buttons=buttons,
+                        _build_notification_text(header_snapshot, bullets, "", True),
+                        buttons=_build_notification_buttons(ctx_id, thread_id, True),
                         parse_mode="html",
                         link_preview=False,
                         owner_id=self.owner_id,
@@ -3794,29 +4765,34 @@ class AccountWorker:
                             ctx_id=ctx_id,
                             bullets=bullets,
                             header_lines=header_snapshot,
-                            history_html=history_html,
+                            history_html="",
                             history_collapsed=True,
                             peer=peer,
-                            ai_block=ai_block,
-                            ai_buttons=ai_buttons,
                         )
-                if media_bytes and media_filename:
-                    media_caption_lines = [
-                        f"👤 Аккаунт: <b>{html.escape(account_display)}</b>",
-                        f"👥 Собеседник: <b>{html.escape(sender_name) if sender_name else '—'}</b>",
-                    ]
-                    if media_description:
-                        media_caption_lines.append(
-                            f"📎 {html.escape(media_description)}"
+                        persist_notification_thread(
+                            self.owner_id, thread_id, state_map[thread_id]
                         )
-                    await safe_send_admin_file(
-                        media_bytes,
-                        media_filename,
-                        owner_id=self.owner_id,
-                        reply_context=reply_context_key,
-                        caption="\n".join(media_caption_lines),
-                        parse_mode="html",
-                    )
+                timings = {"notify": time.monotonic() - notify_started}
+                media_caption_lines = [
+                    f"👤 Аккаунт: <b>{html.escape(account_display)}</b>",
+                    f"👥 Собеседник: <b>{html.escape(sender_name) if sender_name else '—'}</b>",
+                ]
+                if media_description:
+                    media_caption_lines.append(f"📎 {html.escape(media_description)}")
+                self._spawn_background(
+                    self._enrich_notification(
+                        ev,
+                        peer,
+                        thread_id=thread_id,
+                        ctx_id=ctx_id,
+                        download_media=download_media,
+                        media_code=media_code,
+                        media_caption="\n".join(media_caption_lines),
+                        reply_context_key=reply_context_key,
+                        timings=timings,
+                    ),
+                    "notification enrichment",
+                )
 
             await self.client.start()
         except AuthKeyDuplicatedError as e:
@@ -3845,17 +4821,195 @@ class AccountWorker:
         if self._keepalive_task is None:
             self._keepalive_task = asyncio.create_task(self._keepalive())
 
+    async def _enrich_notification(
+        self,
+        ev: Any,
+        peer: Optional[Any],
+        *,
+        thread_id: str,
+        ctx_id: str,
+        download_media: bool,
+        media_code: Optional[str],
+        media_caption: str,
+        reply_context_key: Any,
+        timings: Dict[str, float],
+    ) -> None:
+        """Background stages that fill in an already posted notification.
+
+        AI variants, dialog history and the media attachment are produced
+        concurrently; each stage edits the notification as soon as it is
+        ready. Stage durations are logged once all of them finish.
+        """
+
+        def current_state() -> Optional[_NotificationThreadState]:
+            state = notification_threads.get(self.owner_id, {}).get(thread_id)
+            if state is None or state.ctx_id != ctx_id:
+                return None
+            return state
+
+        async def timed(name: str, stage: Callable[[], Any]) -> None:
+            started = time.monotonic()
+            try:
+                await stage()
+            except Exception as e:
+                log.warning("[%s] notification stage %s failed: %s", self.phone, name, e)
+            finally:
+                timings[name] = time.monotonic() - started
+
+        async def ai_stage() -> None:
+            if not _is_ai_eligible(ev):
+                return
+            if get_ai_mode(self.owner_id, self.phone) != AI_MODE_ON_DEMAND:
+                _ai_usage[self.owner_id]["auto"] += 1
+                await self.run_ai_stage(ev, peer, thread_id=thread_id, ctx_id=ctx_id)
+                return
+            state = current_state()
+            if state is None:
+                return
+            # Генерация только по кнопке — пока оператор её не нажал, запросов к API нет
+            _ai_usage[self.owner_id]["offered"] += 1
+            state.ai_block = None
+            state.ai_buttons = [
+                [Button.inline("🤖 Сгенерировать", f"ai_gen:{thread_id}:{ev.id}".encode())]
+            ]
+            schedule_notification_refresh(self.owner_id, thread_id)
+
+        async def history_stage() -> None:
+            # Свёрнутая история не рендерится вовсе — только при раскрытии
+            state = notification_threads.get(self.owner_id, {}).get(thread_id)
+            if state is None or state.history_collapsed:
+                return
+            history_html = await _build_history_html(
+                self.client,
+                peer or ev.chat_id,
+                limit=MAX_HISTORY_MESSAGES,
+                entity_cache=self.entity_cache,
+            )
+            state.history_html = history_html
+            state.history_stale = False
+            schedule_notification_refresh(self.owner_id, thread_id)
+
+        async def media_stage() -> None:
+            if not download_media:
+                return
+            media_data: Any = None
+            media_notice: Optional[str] = None
+            spool_path: Optional[str] = None
+            filename = _resolve_media_filename(ev, media_code)
+            media_size = getattr(getattr(ev, "file", None), "size", None)
+            try:
+                if media_size is None or media_size > MEDIA_SPOOL_THRESHOLD:
+                    fd, spool_path = tempfile.mkstemp(
+                        prefix="tgmgr_", suffix=os.path.splitext(filename)[1]
+                    )
+                    os.close(fd)
+                    downloaded = await ev.download_media(file=spool_path)
+                    if downloaded is not None and os.path.getsize(spool_path) > 0:
+                        media_data = spool_path
+                else:
+                    buffer = BytesIO()
+                    downloaded = await ev.download_media(file=buffer)
+                    if downloaded is not None:
+                        media_data = buffer.getvalue()
+                if media_data:
+                    await safe_send_admin_file(
+                        media_data,
+                        filename,
+                        owner_id=self.owner_id,
+                        reply_context=reply_context_key,
+                        caption=media_caption,
+                        parse_mode="html",
+                    )
+                    return
+            except Exception as download_error:
+                media_notice = (
+                    "⚠️ Не удалось скачать вложение: "
+                    f"{html.escape(str(download_error))}"
+                )
+            finally:
+                if spool_path:
+                    with contextlib.suppress(OSError):
+                        os.remove(spool_path)
+            state = current_state()
+            if state is None:
+                return
+            state.header_lines = [
+                *state.header_lines,
+                "",
+                media_notice or "⚠️ Вложение не удалось скачать.",
+            ]
+            schedule_notification_refresh(self.owner_id, thread_id)
+
+        await asyncio.gather(
+            timed("ai", ai_stage),
+            timed("history", history_stage),
+            timed("media", media_stage),
+        )
+        log.info(
+            "[%s] notification stages for %s: %s",
+            self.phone,
+            ev.chat_id,
+            {name: round(value, 3) for name, value in timings.items()},
+        )
+
+    async def run_ai_stage(
+        self,
+        ev: Any,
+        peer: Optional[Any],
+        *,
+        thread_id: str,
+        ctx_id: str,
+    ) -> None:
+        """Generate AI variants for ``ev`` and render them into its notification.
+
+        Streamed drafts and the final variants are shown as soon as they are
+        ready; the recommendation and media suggestions arrive with the final
+        render.
+        """
+
+        def show_ai(ai_task_id: Optional[str], drafts: Sequence[str]) -> None:
+            state = notification_threads.get(self.owner_id, {}).get(thread_id)
+            if state is None or state.ctx_id != ctx_id:
+                return
+            pr = pending_ai_replies.get(ai_task_id) if ai_task_id else None
+            if pr is not None:
+                state.ai_block = _format_ai_recommendations_block(pr)
+                _, state.ai_buttons = _format_ai_variants_for_admin(ai_task_id, pr)
+            else:
+                state.ai_block = _format_ai_drafts_block(drafts)
+                state.ai_buttons = None
+            schedule_notification_refresh(self.owner_id, thread_id)
+
+        ai_task_id = await handle_ai_autoreply(self, ev, peer, on_progress=show_ai)
+        if ai_task_id and ai_task_id in pending_ai_replies:
+            show_ai(ai_task_id, ())
+            return
+        state = notification_threads.get(self.owner_id, {}).get(thread_id)
+        if state is not None and state.ctx_id == ctx_id and state.ai_block:
+            # генерация сорвалась после черновиков — убираем превью
+            show_ai(None, ())
+
     async def stop(self):
         if self._keepalive_task:
             self._keepalive_task.cancel()
             self._keepalive_task = None
         await self._shutdown_send_worker()
+        dispatcher = self._update_dispatcher
+        self._update_dispatcher = self._make_update_dispatcher()
+        await dispatcher.close()
+        log.info("[%s] update queue stats: %s", self.phone, dispatcher.stats())
+        await self._cancel_background_tasks()
+        _flood_scheduler.cancel_account(self.phone)
+        self.entity_cache.flush()
+        log.info("[%s] entity cache stats: %s", self.phone, self.entity_cache.stats())
+        log.info("[%s] contact profile stats: %s", self.phone, self.contact_profiles.stats())
         if self.client:
             try: await self.client.disconnect()
             except: pass
         self.started = False
 
     async def send_code(self):
+        _flood_scheduler.check(self.phone, "send_code")
         await self._ensure_client()
         await asyncio.sleep(_rand_delay(LOGIN_DELAY_SECONDS))
         self._last_code_delivery = None
@@ -3867,16 +5021,8 @@ class AccountWorker:
         except UserDeactivatedError as e:
             await self._handle_account_disabled("frozen", e)
             raise
-        except PhoneCodeFloodError as e:
-            wait = getattr(e, "seconds", getattr(e, "value", 60))
-            log.warning("[%s] phone code flood wait %ss", self.phone, wait)
-            await asyncio.sleep(wait + 5)
-            raise
-        except FloodWaitError as e:
-            wait = getattr(e, "seconds", getattr(e, "value", 60))
-            log.warning("[%s] flood wait %ss on send_code", self.phone, wait)
-            await asyncio.sleep(wait + 5)
-            raise
+        except (PhoneCodeFloodError, FloodWaitError) as e:
+            raise _flood_scheduler.record(self.phone, "send_code", e) from e
         if isinstance(result, types.auth.SentCode):
             code_type = getattr(result, "type", None)
             self._last_code_delivery = _describe_sent_code_type(code_type)
@@ -3892,6 +5038,7 @@ class AccountWorker:
         return self._last_code_delivery
 
     async def sign_in_code(self, code: str):
+        _flood_scheduler.check(self.phone, "sign_in")
         await asyncio.sleep(_rand_delay(LOGIN_DELAY_SECONDS))
         try:
             await self.client.sign_in(self.phone, code)
@@ -3902,16 +5049,15 @@ class AccountWorker:
             await self._handle_account_disabled("frozen", e)
             raise
         except FloodWaitError as e:
-            wait = getattr(e, "seconds", getattr(e, "value", 60))
-            log.warning("[%s] flood wait %ss on sign_in", self.phone, wait)
-            await asyncio.sleep(wait + 5)
-            raise
+            raise _flood_scheduler.record(self.phone, "sign_in", e) from e
         with open(self.session_file, "w", encoding="utf-8") as f:
             f.write(self.client.session.save())
+        self._set_authorized(True)
         self._set_session_invalid_flag(False)
         self._set_account_state(None)
 
     async def sign_in_2fa(self, password: str):
+        _flood_scheduler.check(self.phone, "sign_in")
         await asyncio.sleep(_rand_delay(LOGIN_DELAY_SECONDS))
         try:
             await self.client.sign_in(password=password)
@@ -3922,12 +5068,10 @@ class AccountWorker:
             await self._handle_account_disabled("frozen", e)
             raise
         except FloodWaitError as e:
-            wait = getattr(e, "seconds", getattr(e, "value", 60))
-            log.warning("[%s] flood wait %ss on 2FA", self.phone, wait)
-            await asyncio.sleep(wait + 5)
-            raise
+            raise _flood_scheduler.record(self.phone, "sign_in", e) from e
         with open(self.session_file, "w", encoding="utf-8") as f:
             f.write(self.client.session.save())
+        self._set_authorized(True)
         self._set_session_invalid_flag(False)
         self._set_account_state(None)
 
@@ -3946,7 +5090,9 @@ class AccountWorker:
     async def validate(self) -> bool:
         try:
             client = await self._ensure_client()
-            if not await client.is_user_authorized():
+            authorized = bool(await client.is_user_authorized())
+            self._set_authorized(authorized)
+            if not authorized:
                 return False
             await client.get_me()
             self._set_account_state(None)
@@ -3966,6 +5112,7 @@ class AccountWorker:
             client = await self._ensure_client()
             if await client.is_user_authorized():
                 await client.log_out()
+            self._set_authorized(False)
         except Exception as e:
             log.warning("[%s] logout error: %s", self.phone, e)
         finally:
@@ -3979,20 +5126,17 @@ class AccountWorker:
         reply_to_msg_id: Optional[int] = None,
         mark_read_msg_id: Optional[int] = None,
     ):
-        self._ensure_send_worker()
-        loop = asyncio.get_running_loop()
-        future: asyncio.Future = loop.create_future()
-        await self._send_queue.put(
-            _SendQueueItem(
-                future=future,
+        return await self._schedule_send(
+            chat_id,
+            "text",
+            lambda: self._send_outgoing_impl(
                 chat_id=chat_id,
                 message=message,
                 peer=peer,
                 reply_to_msg_id=reply_to_msg_id,
                 mark_read_msg_id=mark_read_msg_id,
-            )
+            ),
         )
-        return await future
 
     async def send_voice(
         self,
@@ -4002,20 +5146,37 @@ class AccountWorker:
         reply_to_msg_id: Optional[int] = None,
         mark_read_msg_id: Optional[int] = None,
     ):
-        client = await self._ensure_client()
-        if not await client.is_user_authorized():
-            raise RuntimeError("Аккаунт не авторизован")
-        if peer is None:
-            try:
-                peer = await client.get_input_entity(chat_id)
-            except Exception:
-                peer = chat_id
-        await self._simulate_voice_recording(client, peer, file_path)
+        return await self._schedule_send(
+            chat_id,
+            "voice",
+            lambda: self._send_voice_impl(
+                chat_id, file_path, peer, reply_to_msg_id, mark_read_msg_id
+            ),
+        )
+
+    async def _send_voice_impl(
+        self,
+        chat_id: int,
+        file_path: str,
+        peer: Optional[Any] = None,
+        reply_to_msg_id: Optional[int] = None,
+        mark_read_msg_id: Optional[int] = None,
+    ):
+        client = await self._authorized_client()
+        peer = await self._resolve_peer(client, chat_id, peer)
+        file, attributes, mime_type = await self._upload_during_action(
+            client,
+            file_path,
+            self._simulate_voice_recording(client, peer, file_path),
+            voice_note=True,
+        )
         try:
             sent = await client.send_file(
                 peer,
-                file_path,
+                file,
                 voice_note=True,
+                attributes=attributes,
+                mime_type=mime_type,
                 reply_to=reply_to_msg_id,
             )
             if mark_read_msg_id is not None:
@@ -4027,6 +5188,9 @@ class AccountWorker:
         except UserDeactivatedError as e:
             await self._handle_account_disabled("frozen", e)
             raise RuntimeError("Аккаунт заморожен Telegram")
+        except UnauthorizedError as e:
+            self._set_authorized(None)
+            raise RuntimeError("Аккаунт не авторизован") from e
         return sent
         
     async def send_video_note(
@@ -4037,20 +5201,37 @@ class AccountWorker:
         reply_to_msg_id: Optional[int] = None,
         mark_read_msg_id: Optional[int] = None,
     ):
-        client = await self._ensure_client()
-        if not await client.is_user_authorized():
-            raise RuntimeError("Аккаунт не авторизован")
-        if peer is None:
-            try:
-                peer = await client.get_input_entity(chat_id)
-            except Exception:
-                peer = chat_id
-        await self._simulate_round_recording(client, peer, file_path)
+        return await self._schedule_send(
+            chat_id,
+            "video_note",
+            lambda: self._send_video_note_impl(
+                chat_id, file_path, peer, reply_to_msg_id, mark_read_msg_id
+            ),
+        )
+
+    async def _send_video_note_impl(
+        self,
+        chat_id: int,
+        file_path: str,
+        peer: Optional[Any] = None,
+        reply_to_msg_id: Optional[int] = None,
+        mark_read_msg_id: Optional[int] = None,
+    ):
+        client = await self._authorized_client()
+        peer = await self._resolve_peer(client, chat_id, peer)
+        file, attributes, mime_type = await self._upload_during_action(
+            client,
+            file_path,
+            self._simulate_round_recording(client, peer, file_path),
+            video_note=True,
+        )
         try:
             sent = await client.send_file(
                 peer,
-                file_path,
+                file,
                 video_note=True,
+                attributes=attributes,
+                mime_type=mime_type,
                 reply_to=reply_to_msg_id,
             )
             if mark_read_msg_id is not None:
@@ -4062,6 +5243,9 @@ class AccountWorker:
         except UserDeactivatedError as e:
             await self._handle_account_disabled("frozen", e)
             raise RuntimeError("Аккаунт заморожен Telegram")
+        except UnauthorizedError as e:
+            self._set_authorized(None)
+            raise RuntimeError("Аккаунт не авторизован") from e
         return sent
 
     async def send_sticker(
@@ -4072,14 +5256,24 @@ class AccountWorker:
         reply_to_msg_id: Optional[int] = None,
         mark_read_msg_id: Optional[int] = None,
     ):
-        client = await self._ensure_client()
-        if not await client.is_user_authorized():
-            raise RuntimeError("Аккаунт не авторизован")
-        if peer is None:
-            try:
-                peer = await client.get_input_entity(chat_id)
-            except Exception:
-                peer = chat_id
+        return await self._schedule_send(
+            chat_id,
+            "sticker",
+            lambda: self._send_sticker_impl(
+                chat_id, file_path, peer, reply_to_msg_id, mark_read_msg_id
+            ),
+        )
+
+    async def _send_sticker_impl(
+        self,
+        chat_id: int,
+        file_path: str,
+        peer: Optional[Any] = None,
+        reply_to_msg_id: Optional[int] = None,
+        mark_read_msg_id: Optional[int] = None,
+    ):
+        client = await self._authorized_client()
+        peer = await self._resolve_peer(client, chat_id, peer)
         try:
             sent = await client.send_file(
                 peer,
@@ -4096,6 +5290,9 @@ class AccountWorker:
         except UserDeactivatedError as e:
             await self._handle_account_disabled("frozen", e)
             raise RuntimeError("Аккаунт заморожен Telegram")
+        except UnauthorizedError as e:
+            self._set_authorized(None)
+            raise RuntimeError("Аккаунт не авторизован") from e
         return sent
 
     async def send_media(
@@ -4105,16 +5302,26 @@ class AccountWorker:
         peer: Optional[Any] = None,
         reply_to_msg_id: Optional[int] = None,
         mark_read_msg_id: Optional[int] = None,
+    ):
+        return await self._schedule_send(
+            chat_id,
+            "media",
+            lambda: self._send_media_impl(
+                chat_id, file_path, peer, reply_to_msg_id, mark_read_msg_id
+            ),
+        )
+
+    async def _send_media_impl(
+        self,
+        chat_id: int,
+        file_path: str,
+        peer: Optional[Any] = None,
+        reply_to_msg_id: Optional[int] = None,
+        mark_read_msg_id: Optional[int] = None,
     ):
         import os
-        client = await self._ensure_client()
-        if not await client.is_user_authorized():
-            raise RuntimeError("Аккаунт не авторизован")
-        if peer is None:
-            try:
-                peer = await client.get_input_entity(chat_id)
-            except Exception:
-                peer = chat_id
+        client = await self._authorized_client()
+        peer = await self._resolve_peer(client, chat_id, peer)
 
         # Пытаемся загрузить метаданные о типе медиа
         media_type = _load_media_metadata(file_path)
@@ -4137,27 +5344,45 @@ class AccountWorker:
         try:
             if media_type == "photo":
                 # Отправляем как фото с анимацией загрузки
-                await self._simulate_photo_upload(client, peer, file_path)
+                file, _, _ = await self._upload_during_action(
+                    client,
+                    file_path,
+                    self._simulate_photo_upload(client, peer, file_path),
+                )
                 sent = await client.send_file(
                     peer,
-                    file_path,
+                    file,
                     reply_to=reply_to_msg_id,
                 )
             elif media_type == "video_note":
                 # Отправляем как кружок (video note) с анимацией записи
-                await self._simulate_round_recording(client, peer, file_path)
+                file, attributes, mime_type = await self._upload_during_action(
+                    client,
+                    file_path,
+                    self._simulate_round_recording(client, peer, file_path),
+                    video_note=True,
+                )
                 sent = await client.send_file(
                     peer,
-                    file_path,
+                    file,
                     video_note=True,
+                    attributes=attributes,
+                    mime_type=mime_type,
                     reply_to=reply_to_msg_id,
                 )
             else:  # media_type == "video" или по умолчанию
                 # Отправляем как обычное видео с анимацией загрузки
-                await self._simulate_video_upload(client, peer, file_path)
+                file, attributes, mime_type = await self._upload_during_action(
+                    client,
+                    file_path,
+                    self._simulate_video_upload(client, peer, file_path),
+                    supports_streaming=True,
+                )
                 sent = await client.send_file(
                     peer,
-                    file_path,
+                    file,
+                    attributes=attributes,
+                    mime_type=mime_type,
                     reply_to=reply_to_msg_id,
                     supports_streaming=True,
                 )
@@ -4171,6 +5396,9 @@ class AccountWorker:
         except UserDeactivatedError as e:
             await self._handle_account_disabled("frozen", e)
             raise RuntimeError("Аккаунт заморожен Telegram")
+        except UnauthorizedError as e:
+            self._set_authorized(None)
+            raise RuntimeError("Аккаунт не авторизован") from e
         return sent
 
     async def edit_message(
@@ -4180,14 +5408,8 @@ class AccountWorker:
         new_text: str,
         peer: Optional[Any] = None,
     ):
-        client = await self._ensure_client()
-        if not await client.is_user_authorized():
-            raise RuntimeError("Аккаунт не авторизован")
-        if peer is None:
-            try:
-                peer = await client.get_input_entity(chat_id)
-            except Exception:
-                peer = chat_id
+        client = await self._authorized_client()
+        peer = await self._resolve_peer(client, chat_id, peer)
         try:
             await client.edit_message(peer, msg_id, new_text)
         except (UserDeactivatedBanError, PhoneNumberBannedError) as e:
@@ -4196,6 +5418,9 @@ class AccountWorker:
         except UserDeactivatedError as e:
             await self._handle_account_disabled("frozen", e)
             raise RuntimeError("Аккаунт заморожен Telegram")
+        except UnauthorizedError as e:
+            self._set_authorized(None)
+            raise RuntimeError("Аккаунт не авторизован") from e
 
     async def delete_message(
         self,
@@ -4203,14 +5428,8 @@ class AccountWorker:
         msg_id: int,
         peer: Optional[Any] = None,
     ):
-        client = await self._ensure_client()
-        if not await client.is_user_authorized():
-            raise RuntimeError("Аккаунт не авторизован")
-        if peer is None:
-            try:
-                peer = await client.get_input_entity(chat_id)
-            except Exception:
-                peer = chat_id
+        client = await self._authorized_client()
+        peer = await self._resolve_peer(client, chat_id, peer)
         try:
             await client.delete_messages(peer, [msg_id], revoke=True)
         except (UserDeactivatedBanError, PhoneNumberBannedError) as e:
@@ -4219,6 +5438,9 @@ class AccountWorker:
         except UserDeactivatedError as e:
             await self._handle_account_disabled("frozen", e)
             raise RuntimeError("Аккаунт заморожен Telegram")
+        except UnauthorizedError as e:
+            self._set_authorized(None)
+            raise RuntimeError("Аккаунт не авторизован") from e
 
     async def mark_dialog_read(
         self,
@@ -4226,14 +5448,8 @@ class AccountWorker:
         peer: Optional[Any] = None,
         msg_id: Optional[int] = None,
     ) -> None:
-        client = await self._ensure_client()
-        if not await client.is_user_authorized():
-            raise RuntimeError("Аккаунт не авторизован")
-        if peer is None:
-            try:
-                peer = await client.get_input_entity(chat_id)
-            except Exception:
-                peer = chat_id
+        client = await self._authorized_client()
+        peer = await self._resolve_peer(client, chat_id, peer)
         try:
             await client.send_read_acknowledge(peer, max_id=msg_id)
         except Exception as e:
@@ -4248,14 +5464,8 @@ class AccountWorker:
     ) -> None:
         if msg_id is None:
             raise RuntimeError("Неизвестно, к какому сообщению добавить реакцию")
-        client = await self._ensure_client()
-        if not await client.is_user_authorized():
-            raise RuntimeError("Аккаунт не авторизован")
-        if peer is None:
-            try:
-                peer = await client.get_input_entity(chat_id)
-            except Exception:
-                peer = chat_id
+        client = await self._authorized_client()
+        peer = await self._resolve_peer(client, chat_id, peer)
         try:
             await client(
                 functions.messages.SendReactionRequest(
@@ -4271,24 +5481,17 @@ class AccountWorker:
         except UserDeactivatedError as e:
             await self._handle_account_disabled("frozen", e)
             raise RuntimeError("Аккаунт заморожен Telegram")
+        except UnauthorizedError as e:
+            self._set_authorized(None)
+            raise RuntimeError("Аккаунт не авторизован") from e
     
     async def block_contact(
         self,
         chat_id: int,
         peer: Optional[Any] = None,
     ) -> None:
-        client = await self._ensure_client()
-        if not await client.is_user_authorized():
-            raise RuntimeError("Аккаунт не авторизован")
-        if peer is None:
-            try:
-                peer = await client.get_input_entity(chat_id)
-            except Exception:
-                peer = chat_id
-        try:
-            input_peer = await client.get_input_entity(peer)
-        except Exception:
-            input_peer = peer
+        client = await self._authorized_client()
+        input_peer = await self._resolve_peer(client, chat_id, peer)
         try:
             await client(functions.contacts.BlockRequest(id=input_peer))
         except FloodWaitError as e:
@@ -4300,6 +5503,9 @@ class AccountWorker:
         except UserDeactivatedError as e:
             await self._handle_account_disabled("frozen", e)
             raise RuntimeError("Аккаунт заморожен Telegram") from e
+        except UnauthorizedError as e:
+            self._set_authorized(None)
+            raise RuntimeError("Аккаунт не авторизован") from e
         except Exception as e:
             log.warning("[%s] не удалось заблокировать контакт %s: %s", self.phone, chat_id, e)
         try:
@@ -4320,6 +5526,9 @@ class AccountWorker:
         except UserDeactivatedError as e:
             await self._handle_account_disabled("frozen", e)
             raise RuntimeError("Аккаунт заморожен Telegram") from e
+        except UnauthorizedError as e:
+            self._set_authorized(None)
+            raise RuntimeError("Аккаунт не авторизован") from e
         except (PeerIdInvalidError, ValueError, TypeError) as e:
             log.warning(
                 "[%s] не удалось удалить диалог %s из-за некорректного peer: %s",
@@ -4335,50 +5544,376 @@ class AccountWorker:
     async def _keepalive(self):
         """Поддержание соединения: по ошибкам — reconnect; по таймеру (если включён) — тоже."""
         while True:
-            try:
-                await self.client.get_me()
-            except AuthKeyDuplicatedError as e:
-                await self._handle_authkey_duplication(e)
+            try:
+                # get_me() глотает UnauthorizedError и возвращает None
+                if await self.client.get_me() is None:
+                    await self._handle_session_unauthorized(None)
+                    return
+                self._set_authorized(True)
+            except UnauthorizedError as e:
+                await self._handle_session_unauthorized(e)
+                return
+            except AuthKeyDuplicatedError as e:
+                await self._handle_authkey_duplication(e)
+                return
+            except (UserDeactivatedBanError, PhoneNumberBannedError) as e:
+                await self._handle_account_disabled("banned", e)
+                return
+            except UserDeactivatedError as e:
+                await self._handle_account_disabled("frozen", e)
+                return
+            except FloodWaitError as e:
+                _flood_scheduler.record(self.phone, "keepalive", e)
+            except Exception as e:
+                self._set_authorized(None)
+                log.warning("[%s] connection issue -> reconnect: %s", self.phone, e)
+                try:
+                    await self._reconnect()
+                except Exception as ex:
+                    log.error("[%s] reconnect failed: %s", self.phone, ex)
+            # периодический reconnect по таймеру (если включён); в обеих ветках
+            # ждём не меньше окна FloodWait
+            if AUTO_RECONNECT_MINUTES and AUTO_RECONNECT_MINUTES > 0:
+                await asyncio.sleep(
+                    max(
+                        AUTO_RECONNECT_MINUTES * 60,
+                        _flood_scheduler.remaining(self.phone, "keepalive"),
+                    )
+                )
+                if _flood_scheduler.remaining(self.phone, "keepalive") > 0:
+                    continue
+                try:
+                    await self._reconnect()
+                except Exception as ex:
+                    log.error("[%s] scheduled reconnect failed: %s", self.phone, ex)
+            else:
+                interval = KEEPALIVE_INTERVAL_SECONDS + _rand_delay(KEEPALIVE_JITTER)
+                await asyncio.sleep(
+                    max(interval, _flood_scheduler.remaining(self.phone, "keepalive"))
+                )
+
+# ---- runtime ----
+class ReplyContext:
+    """Read-only reply target of an admin notification.
+
+    Slotted replacement for the former per-message dict; keeps the
+    ``ctx["phone"]`` / ``ctx.get("peer")`` access the handlers use.
+    """
+
+    __slots__ = ("owner_id", "phone", "chat_id", "sender_id", "peer", "msg_id")
+
+    def __init__(
+        self,
+        owner_id: int,
+        phone: str,
+        chat_id: int,
+        sender_id: Optional[int],
+        peer: Optional[Any],
+        msg_id: Optional[int],
+    ) -> None:
+        set_attr = object.__setattr__
+        set_attr(self, "owner_id", owner_id)
+        set_attr(self, "phone", sys.intern(phone))
+        set_attr(self, "chat_id", chat_id)
+        set_attr(self, "sender_id", sender_id)
+        set_attr(self, "peer", peer)
+        set_attr(self, "msg_id", msg_id)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("ReplyContext is read-only")
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+
+class _ContextStore:
+    """Small SQLite key/value store for notification contexts with TTL.
+
+    Writes are queued and applied in one transaction from a worker thread
+    shortly after they happen (write-behind), so the event loop never waits
+    on disk for them; :meth:`flush` writes the rest at shutdown. Rows are
+    read back one key at a time on a memory miss, so restart recovery needs
+    no preload: :meth:`get` answers from queued and in-flight writes when
+    they decide the key and otherwise reads SQLite in a worker thread.
+    Storage errors are logged and treated as a miss.
+    """
+
+    def __init__(self, path: str, flush_delay: float = CONTEXT_STORE_FLUSH_DELAY_SECONDS) -> None:
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        # (action, описание для лога, SQL, параметры)
+        self._pending: List[Tuple[str, str, str, Tuple[Any, ...]]] = []
+        self._inflight: List[Tuple[str, str, str, Tuple[Any, ...]]] = []
+        self._flush_delay = flush_delay
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS contexts ("
+                " kind TEXT NOT NULL, owner_id INTEGER NOT NULL, key TEXT NOT NULL,"
+                " phone TEXT, payload TEXT NOT NULL, expires_at REAL NOT NULL,"
+                " PRIMARY KEY (kind, owner_id, key))"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _write(self, action: str, what: str, query: str, params: Tuple[Any, ...]) -> None:
+        with self._pending_lock:
+            self._pending.append((action, what, query, params))
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        # Writes queued while a batch was being applied go out in the next
+        # round; they are never left waiting for some later write.
+        while True:
+            await asyncio.sleep(self._flush_delay)
+            await asyncio.to_thread(self.flush)
+            if not self._pending:
                 return
-            except (UserDeactivatedBanError, PhoneNumberBannedError) as e:
-                await self._handle_account_disabled("banned", e)
-                return
-            except UserDeactivatedError as e:
-                await self._handle_account_disabled("frozen", e)
+
+    def flush(self) -> None:
+        """Apply all queued writes in one transaction (blocking)."""
+
+        with self._db_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+                self._inflight = batch
+            if not batch:
                 return
-            except FloodWaitError as e:
-                wait = getattr(e, "seconds", getattr(e, "value", 60))
-                log.warning("[%s] flood wait %ss on keepalive", self.phone, wait)
-                await asyncio.sleep(wait + 5)
-                continue
-            except Exception as e:
-                log.warning("[%s] connection issue -> reconnect: %s", self.phone, e)
-                try:
-                    await self._reconnect()
-                except Exception as ex:
-                    log.error("[%s] reconnect failed: %s", self.phone, ex)
-            # периодический reconnect по таймеру (если включён)
-            if AUTO_RECONNECT_MINUTES and AUTO_RECONNECT_MINUTES > 0:
-                await asyncio.sleep(AUTO_RECONNECT_MINUTES * 60)
+            try:
+                self._apply(batch)
+            finally:
+                with self._pending_lock:
+                    self._inflight = []
+
+    def _apply(self, batch: List[Tuple[str, str, str, Tuple[Any, ...]]]) -> None:
+        try:
+            db = self._db()
+            db.execute("BEGIN")
+        except sqlite3.Error as e:
+            log.warning("context store flush failed, %d writes lost: %s", len(batch), e)
+            return
+        for _, what, query, params in batch:
+            try:
+                db.execute(query, params)
+            except sqlite3.Error as e:
+                log.warning("context store %s failed: %s", what, e)
+        try:
+            db.execute("COMMIT")
+        except sqlite3.Error as e:
+            log.warning("context store commit failed, %d writes lost: %s", len(batch), e)
+            with contextlib.suppress(sqlite3.Error):
+                db.execute("ROLLBACK")
+
+    def _queued_answer(
+        self, kind: str, key: str, owner_id: Optional[int]
+    ) -> Tuple[bool, Optional[Tuple[int, Optional[str], Dict[str, Any]]]]:
+        """Answer from writes not yet on disk: ``(decided, row)``, newest write wins."""
+
+        with self._pending_lock:
+            queued = [*self._inflight, *self._pending]
+        for action, _, _, params in reversed(queued):
+            if action == "put":
+                row_kind, row_owner, row_key, phone, payload, expires_at = params
+                if row_kind != kind or row_key != key:
+                    continue
+                if owner_id is not None and row_owner != owner_id:
+                    continue
+                if expires_at <= time.time():
+                    return True, None
                 try:
-                    await self._reconnect()
-                except Exception as ex:
-                    log.error("[%s] scheduled reconnect failed: %s", self.phone, ex)
-            else:
-                interval = KEEPALIVE_INTERVAL_SECONDS + _rand_delay(KEEPALIVE_JITTER)
-                await asyncio.sleep(interval)
+                    return True, (row_owner, phone, json.loads(payload))
+                except ValueError:
+                    return True, None
+            elif action == "delete":
+                row_kind, row_key, *scope = params
+                if row_kind == kind and row_key == key and (
+                    not scope or owner_id is None or scope[0] == owner_id
+                ):
+                    return True, None
+            elif action == "delete_account":
+                # Телефон строки на диске неизвестен — считаем её удалённой.
+                if owner_id is None or params[0] == owner_id:
+                    return True, None
+        return False, None
+
+    def _read(self, query: str, params: List[Any]) -> Optional[Tuple[Any, ...]]:
+        with self._db_lock:
+            return self._db().execute(query, params).fetchone()
+
+    def put(
+        self,
+        kind: str,
+        owner_id: int,
+        key: str,
+        phone: Optional[str],
+        payload: Dict[str, Any],
+    ) -> None:
+        _, ttl_seconds = REGISTRY_LIMITS[kind]
+        self._write(
+            "put",
+            f"write ({kind}/{key})",
+            "INSERT OR REPLACE INTO contexts VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                kind,
+                owner_id,
+                key,
+                phone,
+                json.dumps(payload, ensure_ascii=False, separators=(",", ":")),
+                time.time() + (ttl_seconds or 0),
+            ),
+        )
+
+    async def get(self, kind: str, key: str, owner_id: Optional[int] = None) -> Optional[Tuple[int, Optional[str], Dict[str, Any]]]:
+        decided, queued = self._queued_answer(kind, key, owner_id)
+        if decided:
+            return queued
+        query = "SELECT owner_id, phone, payload FROM contexts WHERE kind = ? AND key = ? AND expires_at > ?"
+        params: List[Any] = [kind, key, time.time()]
+        if owner_id is not None:
+            query += " AND owner_id = ?"
+            params.append(owner_id)
+        try:
+            row = await asyncio.to_thread(self._read, query, params)
+        except sqlite3.Error as e:
+            log.warning("context store read failed (%s/%s): %s", kind, key, e)
+            return None
+        if row is None:
+            return None
+        try:
+            return row[0], row[1], json.loads(row[2])
+        except ValueError:
+            return None
+
+    def delete(self, kind: str, key: str, owner_id: Optional[int] = None) -> None:
+        query = "DELETE FROM contexts WHERE kind = ? AND key = ?"
+        params: List[Any] = [kind, key]
+        if owner_id is not None:
+            query += " AND owner_id = ?"
+            params.append(owner_id)
+        self._write("delete", f"delete ({kind}/{key})", query, tuple(params))
+
+    def delete_account(self, owner_id: int, phone: Optional[str] = None) -> None:
+        query = "DELETE FROM contexts WHERE owner_id = ?"
+        params: List[Any] = [owner_id]
+        if phone is not None:
+            query += " AND phone = ?"
+            params.append(phone)
+        self._write("delete_account", f"cleanup for {owner_id}", query, tuple(params))
+
+    def purge_expired(self) -> None:
+        self._write("purge", "purge", "DELETE FROM contexts WHERE expires_at <= ?", (time.time(),))
+
+
+_context_store = _ContextStore(CONTEXT_STORE_DB)
+
+
+def store_reply_context(ctx_id: str, ctx: ReplyContext) -> None:
+    reply_contexts[ctx_id] = ctx
+    _context_store.put(
+        "reply_contexts",
+        ctx.owner_id,
+        ctx_id,
+        ctx.phone,
+        {"chat_id": ctx.chat_id, "sender_id": ctx.sender_id, "msg_id": ctx.msg_id},
+    )
+
+
+def drop_reply_context(ctx_id: str) -> None:
+    reply_contexts.pop(ctx_id, None)
+    _context_store.delete("reply_contexts", ctx_id)
+
+
+async def get_outgoing_action(token: str) -> Optional[Dict[str, Any]]:
+    info = outgoing_actions.get(token)
+    if info is not None:
+        return info
+    stored = await _context_store.get("outgoing_actions", token)
+    if stored is None:
+        return None
+    admin_id, phone, payload = stored
+    # peer не сериализуется: воркер восстановит его из кэша сущностей по chat_id
+    info = {"admin_id": admin_id, "phone": phone, "peer": None, **payload}
+    outgoing_actions[token] = info
+    return info
+
+
+def drop_outgoing_action(token: str) -> None:
+    outgoing_actions.pop(token, None)
+    _context_store.delete("outgoing_actions", token)
+
+
+def persist_notification_thread(admin_id: int, thread_id: str, state: _NotificationThreadState) -> None:
+    phone, _ = _parse_history_thread_id(thread_id)
+    _context_store.put(
+        "notification_threads",
+        admin_id,
+        thread_id,
+        phone,
+        {
+            "message_id": state.message_id,
+            "ctx_id": state.ctx_id,
+            "bullets": state.bullets,
+            "header_lines": state.header_lines,
+            "history_collapsed": state.history_collapsed,
+        },
+    )
+
+
+async def get_notification_thread(admin_id: int, thread_id: str) -> Optional[_NotificationThreadState]:
+    state = notification_threads.get(admin_id, {}).get(thread_id)
+    if state is not None:
+        return state
+    stored = await _context_store.get("notification_threads", thread_id, owner_id=admin_id)
+    if stored is None:
+        return None
+    _, _, payload = stored
+    try:
+        state = _NotificationThreadState(
+            message_id=int(payload["message_id"]),
+            thread_id=thread_id,
+            ctx_id=str(payload["ctx_id"]),
+            bullets=list(payload.get("bullets") or []),
+            header_lines=list(payload.get("header_lines") or []),
+            history_html="",
+            history_collapsed=bool(payload.get("history_collapsed", True)),
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+    notification_threads[admin_id][thread_id] = state
+    return state
+
 
-# ---- runtime ----
 pending: Dict[int, Dict[str, Any]] = {}
 WORKERS: Dict[int, Dict[str, AccountWorker]] = {}
-reply_contexts: Dict[str, Dict[str, Any]] = {}
+reply_contexts: Dict[str, ReplyContext] = BoundedRegistry.from_budget("reply_contexts")
 reply_waiting: Dict[int, Dict[str, Any]] = {}
 edit_waiting: Dict[int, Dict[str, Any]] = {}
-outgoing_actions: Dict[str, Dict[str, Any]] = {}
+outgoing_actions: Dict[str, Dict[str, Any]] = BoundedRegistry.from_budget("outgoing_actions")
 
 # ---- AI автоответы (шаблоны + GPT-подсказки) ----
 
-@dataclass
+@dataclass(slots=True)
 class PendingAIReply:
     owner_id: int
     phone: str
@@ -4394,7 +5929,59 @@ class PendingAIReply:
     media_suggestions: Optional[List[Dict[str, Any]]] = None
 
 
-pending_ai_replies: Dict[str, PendingAIReply] = {}
+pending_ai_replies: Dict[str, PendingAIReply] = BoundedRegistry.from_budget("pending_ai_replies")
+
+
+@dataclass(slots=True)
+class _AIJob:
+    """In-flight AI generation for one chat.
+
+    A newer incoming message supersedes a job that hasn't delivered its
+    variants yet: the old job is cancelled and its messages are folded into
+    the new job's prompt. Once variants are shown to the operator the job is
+    left alone.
+    """
+
+    msg_ids: List[int]
+    texts: List[str]
+    task: Optional[asyncio.Task] = None
+    superseded: bool = False
+    delivered: bool = False
+
+
+# (owner_id, phone, chat_id) -> текущая генерация по чату
+_ai_jobs: Dict[Tuple[int, str, int], _AIJob] = {}
+# task_id генераций, запущенных кнопкой «Сгенерировать» и ещё не завершённых
+_ai_on_demand_inflight: Set[str] = set()
+# owner_id -> счётчики с момента запуска: auto — авто-генерации, offered —
+# уведомления с кнопкой вместо генерации, requested — генерации по кнопке,
+# cached — нажатия, обслуженные уже готовыми вариантами
+_ai_usage: Dict[int, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+
+def _is_ai_eligible(ev: Any) -> bool:
+    """Only incoming private text messages get AI suggestions."""
+
+    try:
+        if getattr(ev, "out", False) or not getattr(ev, "is_private", False):
+            return False
+    except Exception:
+        return False
+    return bool((getattr(ev, "raw_text", None) or "").strip())
+
+
+def format_ai_usage(owner_id: int) -> str:
+    usage = _ai_usage.get(owner_id, {})
+    offered = usage.get("offered", 0)
+    requested = usage.get("requested", 0)
+    lines = [
+        f"Авто-генераций: {usage.get('auto', 0)}",
+        f"Уведомлений с кнопкой: {offered}",
+        f"Генераций по кнопке: {requested} (из готового: {usage.get('cached', 0)})",
+    ]
+    if offered:
+        lines.append(f"Сэкономлено генераций: {max(0, offered - requested)}")
+    return "\n".join(lines)
 # admin_id -> task_id
 editing_ai_reply: Dict[int, str] = {}
 
@@ -4606,19 +6193,62 @@ def _format_ai_chosen_for_admin(task_id: str, pr: PendingAIReply):
     return text, buttons
 
 
-async def handle_ai_autoreply(worker: "AccountWorker", ev, peer) -> Optional[str]:
-    # Не отвечаем на исходящие и не-личные чаты
-    try:
-        if getattr(ev, "out", False):
-            return None
-        if not getattr(ev, "is_private", False):
-            return None
-    except Exception:
-        return None
+async def handle_ai_autoreply(
+    worker: "AccountWorker",
+    ev,
+    peer,
+    on_progress: Optional[Callable[[Optional[str], Sequence[str]], None]] = None,
+) -> Optional[str]:
+    """Generate AI reply variants for an incoming private message.
 
-    user_text = (getattr(ev, "raw_text", None) or "").strip()
-    if not user_text:
+    With on_progress, streamed drafts are reported as on_progress(None, drafts);
+    once variants are post-processed the PendingAIReply is registered early
+    and reported as on_progress(task_id, variants), before the recommendation
+    and media suggestions are ready.
+    """
+    # Не отвечаем на исходящие, не-личные чаты и сообщения без текста
+    if not _is_ai_eligible(ev):
         return None
+    # Профиль собеседника из общего кэша контактов: боты не получают
+    # подсказок, имя уходит в промпт без get_sender()
+    contact = worker.contact_profiles.get(getattr(ev, "sender_id", None))
+    if contact is not None and contact.is_bot:
+        return None
+    user_text = (getattr(ev, "raw_text", None) or "").strip()
+
+    job_key = (worker.owner_id, worker.phone, ev.chat_id)
+    job = _AIJob(msg_ids=[ev.id], texts=[user_text])
+    previous = _ai_jobs.get(job_key)
+    if previous is not None and not previous.delivered:
+        previous.superseded = True
+        if previous.task is not None:
+            previous.task.cancel()
+        job.msg_ids = [*previous.msg_ids, ev.id]
+        job.texts = [*previous.texts, user_text]
+        log.info(
+            "[%s] AI-генерация для %s заменена: объединено сообщений %s",
+            worker.phone,
+            ev.chat_id,
+            len(job.texts),
+        )
+    _ai_jobs[job_key] = job
+    try:
+        return await _run_ai_job(worker, ev, peer, job, on_progress, contact)
+    finally:
+        if _ai_jobs.get(job_key) is job:
+            del _ai_jobs[job_key]
+
+
+async def _run_ai_job(
+    worker: "AccountWorker",
+    ev,
+    peer,
+    job: _AIJob,
+    on_progress: Optional[Callable[[Optional[str], Sequence[str]], None]],
+    contact: Optional[_ContactProfile] = None,
+) -> Optional[str]:
+    # Все ещё не обработанные сообщения собеседника идут в промпт одним блоком
+    user_text = "\n".join(job.texts)
 
     # Подготовка профиля и истории для промпта
     account_meta = get_account_meta(worker.owner_id, worker.phone) or {}
@@ -4641,7 +6271,7 @@ async def handle_ai_autoreply(worker: "AccountWorker", ev, peer) -> Optional[str
     if client is not None:
         try:
             history_messages = await client.get_messages(
-                peer or ev.chat_id, limit=MAX_HISTORY_MESSAGES
+                peer or ev.chat_id, limit=AI_HISTORY_FETCH_LIMIT
             )
         except Exception as history_err:
             log.debug(
@@ -4651,7 +6281,7 @@ async def handle_ai_autoreply(worker: "AccountWorker", ev, peer) -> Optional[str
             )
         else:
             for message in reversed(history_messages):
-                if getattr(message, "id", None) == getattr(ev, "id", None):
+                if getattr(message, "id", None) in job.msg_ids:
                     continue
                 raw = (message.raw_text or "").strip()
                 if not raw:
@@ -4660,79 +6290,75 @@ async def handle_ai_autoreply(worker: "AccountWorker", ev, peer) -> Optional[str
                 history_lines.append(f"{label} {raw}")
                 history_texts.append(raw)
 
+    if job.superseded:
+        return None
+
     # 2) GPT — генерим несколько вариантов и отправляем админу на выбор
     # Получаем API ключ из переменной окружения
     api_key = os.getenv("OPENAI_API_KEY")
-    try:
-        variants, media_suggestions = await generate_dating_ai_variants(
+    task_id = f"{worker.owner_id}:{worker.phone}:{ev.chat_id}:{ev.id}"
+
+    def make_pending(variants: List[str]) -> PendingAIReply:
+        return PendingAIReply(
+            owner_id=worker.owner_id,
+            phone=worker.phone,
+            peer_id=ev.chat_id,
+            msg_id=ev.id,
+            incoming_text=user_text,
+            suggested_variants=variants,
+        )
+
+    def progress(variants: List[str], final: bool) -> None:
+        if not final:
+            on_progress(None, variants)
+            return
+        job.delivered = True
+        pending_ai_replies[task_id] = make_pending(variants)
+        on_progress(task_id, variants)
+
+    # Генерация, подбор медиа и рекомендация варианта идут одним графом стадий:
+    # медиа параллельно с генерацией, рекомендация — сразу после неё.
+    job.task = asyncio.create_task(
+        generate_dating_ai_reply(
             user_text,
             history_lines=history_lines,
-            history_texts=[*history_texts, user_text],
+            history_texts=history_texts,
+            incoming_texts=job.texts,
             profile=profile_description,
+            contact_name=contact.name if contact is not None else None,
             api_key=api_key,
             model="gpt-4o",
             temperature=0.7,
             n=3,
             include_media_suggestions=True,
             user_id=worker.owner_id,
+            recommend=True,
+            recommendation_temperature=0.4,
+            pad_variants=True,
+            on_progress=progress if on_progress is not None else None,
         )
+    )
+    try:
+        reply = await job.task
+    except asyncio.CancelledError:
+        if not job.superseded:
+            raise
+        return None
     except Exception as e:
         log.warning("[%s] ошибка GPT-подсказки: %s", worker.phone, e)
         return None
 
-    # Чистим, удаляем пустые и дубликаты
-    cleaned: List[str] = []
-    for v in variants:
-        v = (v or "").strip()
-        if not v:
-            continue
-        if v in cleaned:
-            continue
-        cleaned.append(v)
-
-    if not cleaned:
+    # Пустые и дубликаты вычищены, вариантов всегда 3 — по кнопке на каждый
+    if not reply.variants:
         return None
 
-    # Если вдруг меньше 3, дублируем последние, чтобы всегда было 3 кнопки
-    while len(cleaned) < 3:
-        cleaned.append(cleaned[-1])
-
-    recommended_index: Optional[int] = None
-    recommendation_text: Optional[str] = None
-
-    try:
-        rec_idx, rec_text = await recommend_dating_ai_variant(
-            incoming_text=user_text,
-            variants=cleaned,
-            history_lines=history_lines,
-            profile=profile_description,
-            api_key=api_key,
-            model="gpt-4o",
-            temperature=0.4,
-        )
-    except Exception as rec_err:
-        log.debug(
-            "[%s] не удалось получить рекомендацию варианта: %s",
-            worker.phone,
-            rec_err,
-        )
-    else:
-        recommended_index = rec_idx
-        recommendation_text = rec_text
-
-    task_id = f"{worker.owner_id}:{worker.phone}:{ev.chat_id}:{ev.id}"
-    pr = PendingAIReply(
-        owner_id=worker.owner_id,
-        phone=worker.phone,
-        peer_id=ev.chat_id,
-        msg_id=ev.id,
-        incoming_text=user_text,
-        suggested_variants=cleaned,
-        recommended_index=recommended_index,
-        recommendation_text=recommendation_text,
-        media_suggestions=media_suggestions,
-    )
-    pending_ai_replies[task_id] = pr
+    pr = pending_ai_replies.get(task_id)
+    if pr is None:
+        pr = make_pending(reply.variants)
+        pending_ai_replies[task_id] = pr
+    pr.recommended_index = reply.recommended_index
+    pr.recommendation_text = reply.recommendation_text
+    pr.media_suggestions = reply.media_suggestions
 
     return task_id
 
@@ -4764,6 +6390,9 @@ def register_outgoing_action(
 ) -> Optional[str]:
     if msg_id is None:
         return None
+    thread_state = notification_threads.get(admin_id, {}).get(_make_thread_id(phone, chat_id))
+    if thread_state is not None:
+        thread_state.history_stale = True
     token = secrets.token_urlsafe(8)
     outgoing_actions[token] = {
         "admin_id": admin_id,
@@ -4773,6 +6402,13 @@ def register_outgoing_action(
         "msg_id": msg_id,
         "type": message_type,
     }
+    _context_store.put(
+        "outgoing_actions",
+        admin_id,
+        token,
+        phone,
+        {"chat_id": chat_id, "msg_id": msg_id, "type": message_type},
+    )
     return token
 
 
@@ -4853,7 +6489,7 @@ def _ensure_back_button(
 
 
 InteractiveViewState = Dict[str, Any]
-interactive_views: Dict[int, Dict[str, Any]] = {}
+interactive_views: Dict[int, Dict[str, Any]] = BoundedRegistry.from_budget("interactive_views")
 
 
 async def show_interactive_message(
@@ -5069,6 +6705,10 @@ BOT_COMMANDS: List[types.BotCommand] = [
         command="files_delete",
         description="Удалить файл или шаблон из библиотеки",
     ),
+    types.BotCommand(
+        command="ai",
+        description="Режим AI-подсказок: авто или по кнопке",
+    ),
     types.BotCommand(
         command="grant",
         description="Выдать доступ пользователю (для супер-админов)",
@@ -5170,10 +6810,22 @@ async def ensure_worker_running(owner_id: int, phone: str) -> Optional[AccountWo
     return worker
 
 
-def get_reply_context_for_admin(ctx_id: str, admin_id: int) -> Optional[Dict[str, Any]]:
+async def get_reply_context_for_admin(ctx_id: str, admin_id: int) -> Optional[ReplyContext]:
     ctx = reply_contexts.get(ctx_id)
     if not ctx:
-        return None
+        stored = await _context_store.get("reply_contexts", ctx_id, owner_id=admin_id)
+        if stored is None:
+            return None
+        owner_id, phone, payload = stored
+        ctx = ReplyContext(
+            owner_id,
+            phone or "",
+            payload.get("chat_id"),
+            payload.get("sender_id"),
+            None,
+            payload.get("msg_id"),
+        )
+        reply_contexts[ctx_id] = ctx
     if ctx.get("owner_id") != admin_id:
         return None
     return ctx
@@ -5486,7 +7138,7 @@ async def on_inline_query(ev):
         if not ctx_id:
             results = [_reply_inline_help_article(mode, "Нажми кнопку в уведомлении ещё раз.")]
         else:
-            results = _build_reply_inline_results(user_id, ctx_id, mode, file_type, search_query)
+            results = await _build_reply_inline_results(user_id, ctx_id, mode, file_type, search_query)
         rendered = await _render_inline_articles(ev.builder, results)
         await ev.answer(rendered, cache_time=0)
         return
@@ -6139,6 +7791,52 @@ async def on_cb(ev):
             return
 
 
+    if data.startswith("ai_gen:"):
+        try:
+            thread_id, msg_id_raw = data.split("ai_gen:", 1)[1].rsplit(":", 1)
+            msg_id = int(msg_id_raw)
+        except (IndexError, ValueError):
+            await answer_callback(ev, "Некорректные данные", alert=True)
+            return
+        phone, chat_id = _parse_history_thread_id(thread_id)
+        state = await get_notification_thread(admin_id, thread_id)
+        worker = await ensure_worker_running(admin_id, phone) if phone else None
+        if state is None or worker is None or worker.client is None:
+            await answer_callback(ev, "Сообщение устарело", alert=True)
+            return
+        task_id = f"{admin_id}:{phone}:{chat_id}:{msg_id}"
+        pr = pending_ai_replies.get(task_id)
+        if pr is not None:
+            # варианты по этому сообщению уже есть — показываем без нового запроса
+            _ai_usage[admin_id]["cached"] += 1
+            state.ai_block = _format_ai_recommendations_block(pr)
+            _, state.ai_buttons = _format_ai_variants_for_admin(task_id, pr)
+            schedule_notification_refresh(admin_id, thread_id)
+            await answer_callback(ev)
+            return
+        if task_id in _ai_on_demand_inflight:
+            await answer_callback(ev, "⏳ Варианты уже генерируются")
+            return
+        try:
+            message = await worker.client.get_messages(state.peer or chat_id, ids=msg_id)
+        except Exception as e:
+            log.debug("[%s] не удалось получить сообщение %s: %s", phone, msg_id, e)
+            message = None
+        if message is None or not _is_ai_eligible(message):
+            await answer_callback(ev, "Сообщение недоступно", alert=True)
+            return
+        _ai_usage[admin_id]["requested"] += 1
+        _ai_on_demand_inflight.add(task_id)
+        state.ai_block = "🤖 Генерирую варианты…"
+        state.ai_buttons = None
+        schedule_notification_refresh(admin_id, thread_id)
+        await answer_callback(ev, "⏳ Генерирую варианты…")
+        generation = asyncio.create_task(
+            worker.run_ai_stage(message, state.peer, thread_id=thread_id, ctx_id=state.ctx_id)
+        )
+        generation.add_done_callback(lambda _task: _ai_on_demand_inflight.discard(task_id))
+        return
+
     if data.startswith("history_toggle:"):
         try:
             payload = data.split("history_toggle:", 1)[1]
@@ -6147,19 +7845,7 @@ async def on_cb(ev):
             await answer_callback(ev, "Некорректные данные", alert=True)
             return
         phone, chat_id = _parse_history_thread_id(thread_id)
-        state_map = notification_threads.get(admin_id)
-        if not state_map:
-            if await _send_history_from_file(admin_id, phone, chat_id):
-                await answer_callback(ev)
-                return
-            log.warning(
-                "History toggle failed: no notification state for admin_id=%s thread_id=%s.",
-                admin_id,
-                thread_id,
-            )
-            await answer_callback(ev, "История недоступна", alert=True)
-            return
-        state = state_map.get(thread_id)
+        state = await get_notification_thread(admin_id, thread_id)
         if not state:
             if await _send_history_from_file(admin_id, phone, chat_id):
                 await answer_callback(ev)
@@ -6173,39 +7859,31 @@ async def on_cb(ev):
             return
         if mode == "open":
             collapsed = False
-            if phone and chat_id:
+            if phone and chat_id and (state.history_stale or not state.history_html):
                 worker = await ensure_worker_running(admin_id, phone)
                 if worker and worker.client:
                     state.history_html = await _build_history_html(
                         worker.client,
                         state.peer or chat_id,
                         limit=MAX_HISTORY_MESSAGES,
+                        entity_cache=worker.entity_cache,
                     )
+                    state.history_stale = False
         elif mode == "close":
             collapsed = True
         else:
             await answer_callback(ev, "Некорректное состояние", alert=True)
             return
-        buttons = _build_notification_buttons(state.ctx_id, thread_id, collapsed)
-        if state.ai_block:
-            buttons = [*buttons, *state.ai_buttons]
-        text = _build_notification_text(
-            state.header_lines,
-            state.bullets,
-            state.history_html,
-            collapsed,
-            state.ai_block,
-        )
+        text, buttons = _render_notification_thread(thread_id, state, collapsed)
         try:
             await ev.edit(text, buttons=buttons, parse_mode="html", link_preview=False)
         except Exception as exc:
             log.debug("Не удалось обновить историю уведомления: %s", exc)
-            state_map.pop(thread_id, None)
-            if not state_map:
-                notification_threads.pop(admin_id, None)
+            clear_notification_thread(admin_id, thread_id)
             await answer_callback(ev, "Сообщение устарело", alert=True)
             return
         state.history_collapsed = collapsed
+        persist_notification_thread(admin_id, thread_id, state)
         await answer_callback(ev)
         return
 
@@ -6442,6 +8120,7 @@ async def on_cb(ev):
         if worker:
             await worker.logout()
             unregister_worker(admin_id, phone)
+        _context_store.delete_account(admin_id, phone)
         for ctx_key, ctx_val in list(reply_contexts.items()):
             if ctx_val.get("phone") == phone and ctx_val.get("owner_id") == admin_id:
                 reply_contexts.pop(ctx_key, None)
@@ -6462,6 +8141,8 @@ async def on_cb(ev):
         if meta and meta.get("session_file") and os.path.exists(meta["session_file"]):
             with contextlib.suppress(OSError):
                 os.remove(meta["session_file"])
+        with contextlib.suppress(OSError):
+            os.remove(user_entity_cache_path(admin_id, phone))
         await edit_or_send_message(
             ev,
             admin_id,
@@ -6641,6 +8322,7 @@ async def on_cb(ev):
         if worker:
             await worker.logout()
             unregister_worker(admin_id, phone)
+        _context_store.delete_account(admin_id, phone)
         for ctx_key, ctx_val in list(reply_contexts.items()):
             if ctx_val.get("phone") == phone and ctx_val.get("owner_id") == admin_id:
                 reply_contexts.pop(ctx_key, None)
@@ -6661,6 +8343,8 @@ async def on_cb(ev):
         if meta and meta.get("session_file") and os.path.exists(meta["session_file"]):
             with contextlib.suppress(OSError):
                 os.remove(meta["session_file"])
+        with contextlib.suppress(OSError):
+            os.remove(user_entity_cache_path(admin_id, phone))
         await edit_or_send_message(
             ev,
             admin_id,
@@ -6703,7 +8387,7 @@ async def on_cb(ev):
 
     if data.startswith("mark_read:"):
         ctx = data.split(":", 1)[1]
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await answer_callback(ev, "Контекст истёк", alert=True)
             return
@@ -6727,7 +8411,7 @@ async def on_cb(ev):
             await answer_callback(ev, "Некорректные данные", alert=True)
             return
         menu_token, ctx, mode = parts
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await answer_callback(ev, "Контекст истёк", alert=True)
             return
@@ -6751,7 +8435,7 @@ async def on_cb(ev):
             await answer_callback(ev, "Некорректные данные", alert=True)
             return
         _, ctx, mode = parts
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await answer_callback(ev, "Контекст истёк", alert=True)
             return
@@ -6775,7 +8459,7 @@ async def on_cb(ev):
         if mode not in {"normal", "reply"}:
             await answer_callback(ev, "Неизвестный режим", alert=True)
             return
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await answer_callback(ev, "Контекст истёк", alert=True)
             return
@@ -6807,7 +8491,7 @@ async def on_cb(ev):
         if emoji not in REACTION_EMOJI_SET:
             await answer_callback(ev, "Реакция не поддерживается", alert=True)
             return
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await answer_callback(ev, "Контекст истёк", alert=True)
             return
@@ -6840,7 +8524,7 @@ async def on_cb(ev):
 
     if data.startswith("reply_cancel:"):
         ctx = data.split(":", 1)[1]
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if ctx_info:
             await mark_dialog_read_for_context(ctx_info)
         reply_waiting.pop(admin_id, None)
@@ -6851,7 +8535,7 @@ async def on_cb(ev):
 
     if data.startswith("block_contact:"):
         ctx = data.split(":", 1)[1]
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await answer_callback(ev, "Контекст истёк", alert=True)
             return
@@ -6869,7 +8553,7 @@ async def on_cb(ev):
                 f"❌ Не удалось заблокировать собеседника: {e}",
             )
         else:
-            reply_contexts.pop(ctx, None)
+            drop_reply_context(ctx)
             clear_notification_thread(
                 admin_id, _make_thread_id(ctx_info["phone"], ctx_info["chat_id"])
             )
@@ -6892,7 +8576,7 @@ async def on_cb(ev):
             await answer_callback(ev, "Некорректные данные", alert=True)
             return
         _, ctx, mode = parts
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await answer_callback(ev, "Контекст истёк", alert=True)
             return
@@ -6927,7 +8611,7 @@ async def on_cb(ev):
             _, ctx, mode, idx_str = parts
             if mode not in {"normal", "reply"}:
                 mode = "normal"
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await answer_callback(ev, "Контекст истёк", alert=True)
             return
@@ -7002,7 +8686,7 @@ async def on_cb(ev):
             _, ctx, mode, idx_str = parts
             if mode not in {"normal", "reply"}:
                 mode = "normal"
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await answer_callback(ev, "Контекст истёк", alert=True)
             return
@@ -7067,7 +8751,7 @@ async def on_cb(ev):
             _, ctx, mode, idx_str = parts
             if mode not in {"normal", "reply"}:
                 mode = "normal"
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await answer_callback(ev, "Контекст истёк", alert=True)
             return
@@ -7130,7 +8814,7 @@ async def on_cb(ev):
             _, ctx, mode, idx_str = parts
             if mode not in {"normal", "reply"}:
                 mode = "normal"
-        ctx_info = get_reply_context_for_admin(ctx, admin_id)
+        ctx_info = await get_reply_context_for_admin(ctx, admin_id)
         if not ctx_info:
             await answer_callback(ev, "Контекст истёк", alert=True)
             return
@@ -7184,7 +8868,7 @@ async def on_cb(ev):
         return
     if data.startswith("out_edit:"):
         token = data.split(":", 1)[1]
-        info = outgoing_actions.get(token)
+        info = await get_outgoing_action(token)
         if not info or info.get("admin_id") != admin_id:
             await answer_callback(ev, "Контекст недоступен", alert=True)
             return
@@ -7200,7 +8884,7 @@ async def on_cb(ev):
         return
     if data.startswith("out_delete:"):
         token = data.split(":", 1)[1]
-        info = outgoing_actions.get(token)
+        info = await get_outgoing_action(token)
         if not info or info.get("admin_id") != admin_id:
             await answer_callback(ev, "Контекст недоступен", alert=True)
             return
@@ -7217,7 +8901,7 @@ async def on_cb(ev):
         except Exception as e:
             await answer_callback(ev, f"Ошибка удаления: {e}", alert=True)
             return
-        outgoing_actions.pop(token, None)
+        drop_outgoing_action(token)
         if edit_waiting.get(admin_id, {}).get("token") == token:
             edit_waiting.pop(admin_id, None)
         await answer_callback(ev, "Сообщение стерто")
@@ -7301,6 +8985,7 @@ async def on_text(ev):
             await worker.logout()
             unregister_worker(admin_id, phone)
         # Очищаем контексты
+        _context_store.delete_account(admin_id, phone)
         for ctx_key, ctx_val in list(reply_contexts.items()):
             if ctx_val.get("phone") == phone and ctx_val.get("owner_id") == admin_id:
                 reply_contexts.pop(ctx_key, None)
@@ -7557,6 +9242,35 @@ async def on_text(ev):
                 "Команда /files больше не используется. Выбери /files add или /files delete.",
                 buttons=main_menu(),
             )
+        elif cmd_base == "/ai":
+            modes = {
+                "auto": AI_MODE_AUTO,
+                "demand": AI_MODE_ON_DEMAND,
+                "ondemand": AI_MODE_ON_DEMAND,
+                "on_demand": AI_MODE_ON_DEMAND,
+                "reset": None,
+            }
+            if len(parts) >= 2:
+                choice = parts[1].lower()
+                phone = parts[2] if len(parts) >= 3 else None
+                if choice not in modes or (choice == "reset" and not phone):
+                    await ev.respond("Использование: /ai [auto|demand] [телефон] или /ai reset <телефон>")
+                    return
+                if phone and phone not in get_accounts_meta(admin_id):
+                    await ev.respond("Аккаунт не найден.")
+                    return
+                set_ai_mode(admin_id, modes[choice], phone)
+            labels = {AI_MODE_AUTO: "авто", AI_MODE_ON_DEMAND: "по кнопке"}
+            lines = [f"Режим AI-подсказок: {labels[get_ai_mode(admin_id)]}"]
+            overrides = [
+                f"• {p}: {labels[m['ai_mode']]}"
+                for p, m in sorted(get_accounts_meta(admin_id).items())
+                if m.get("ai_mode") in labels
+            ]
+            if overrides:
+                lines.extend(["", "Аккаунты с отдельным режимом:", *overrides])
+            lines.extend(["", format_ai_usage(admin_id)])
+            await ev.respond("\n".join(lines))
         elif cmd_base == "/grant":
             if not is_root_admin(admin_id):
                 await ev.respond("Команда доступна только супер-администратору.")
@@ -7610,7 +9324,7 @@ async def on_text(ev):
             return
         edit_waiting.pop(admin_id, None)
         token = edit_ctx.get("token")
-        info = outgoing_actions.get(token) if token else None
+        info = await get_outgoing_action(token) if token else None
         if not info or info.get("admin_id") != admin_id:
             await ev.reply("Контекст редактирования устарел.")
             return
@@ -7637,7 +9351,7 @@ async def on_text(ev):
             return
         reply_waiting.pop(admin_id, None)
         ctx_id = waiting.get("ctx")
-        ctx = get_reply_context_for_admin(ctx_id, admin_id)
+        ctx = await get_reply_context_for_admin(ctx_id, admin_id)
         if not ctx:
             await ev.reply("Контекст ответа устарел.")
             return
@@ -7979,6 +9693,15 @@ async def on_text(ev):
                 extra_lines: List[str] = []
                 try:
                     await w.send_code()
+                except FloodWaitActive as flood_err:
+                    pending[admin_id] = {"flow": "account", "step": "code_wait", "phone": phone, "worker": w}
+                    _flood_scheduler.defer(
+                        phone,
+                        "send_code",
+                        lambda: _retry_send_login_code(admin_id, phone, w),
+                    )
+                    await ev.reply(f"{flood_err}. Отправлю код автоматически, когда ограничение снимется.")
+                    return
                 except Exception as send_err:
                     if proxy_cfg and proxy_cfg.get("enabled", True):
                         extra_lines.append(
@@ -8003,26 +9726,7 @@ async def on_text(ev):
                 meta["proxy_desc"] = w.proxy_description
                 persist_tenants()
 
-                delivery_hint = w.code_delivery_hint
-                hint_lines: List[str] = []
-                if delivery_hint == "sms_forced":
-                    hint_lines.append(
-                        "⚠️ Если код уже пришёл в приложение Telegram — он больше не действителен."
-                        " Дождись SMS и введи код из SMS."
-                    )
-                elif delivery_hint == "sms":
-                    hint_lines.append("ℹ️ Код отправлен по SMS. Обычно он приходит в течение пары минут.")
-                elif delivery_hint == "app":
-                    hint_lines.append(
-                        "ℹ️ Код отправлен в Telegram. Если удобнее получить SMS, нажми Отмена и попробуй ещё раз."
-                    )
-                elif delivery_hint in {"call", "flash_call", "missed_call"}:
-                    hint_lines.append(
-                        "ℹ️ Код поступит звонком. Ответь и запомни названные цифры."
-                    )
-                elif delivery_hint == "email":
-                    hint_lines.append("ℹ️ Код придёт на e-mail, привязанный к аккаунту.")
-
+                hint_lines = _code_delivery_hint_lines(w.code_delivery_hint)
                 response_lines = extra_lines + [f"Код отправлен на {phone}. Пришли код."] + hint_lines
                 pending[admin_id] = {
                     "flow": "account",
@@ -8033,70 +9737,142 @@ async def on_text(ev):
                 await ev.reply("\n".join(response_lines))
                 return
 
+            if step == "code_wait":
+                phone = st.get("phone", "")
+                eta = int(_flood_scheduler.remaining(phone, "send_code"))
+                await ev.reply(f"Жду снятия ограничения Telegram (~{eta} с). Код отправлю автоматически.")
+                return
+
             if step == "code":
                 code = text
                 w: AccountWorker = st["worker"]
                 phone = st.get("phone", "")
-                try:
-                    await w.sign_in_code(code)
-                except SessionPasswordNeededError:
-                    pending[admin_id] = {
-                        "flow": "account",
-                        "step": "2fa",
-                        "phone": phone,
-                        "worker": w,
-                    }
-                    await ev.reply("Включена двухэтапная защита. Пришли пароль 2FA для аккаунта.")
-                    return
-                except Exception as e:
-                    await ev.reply(f"Ошибка входа: {e}")
-                    pending.pop(admin_id, None)
-                    return
-                register_worker(admin_id, phone, w)
-                try:
-                    await w.start()
-                except AuthKeyDuplicatedError:
-                    pending.pop(admin_id, None)
-                    await ev.reply(
-                        "Сессия была аннулирована Telegram из-за одновременного входа с разных IP."
-                        " Попробуй ещё раз через несколько минут."
-                    )
-                    return
-                pending.pop(admin_id, None)
-                await ev.reply(f"✅ {phone} добавлен. Слушаю входящие.")
+                await _run_login_step(
+                    admin_id, phone, w, lambda: w.sign_in_code(code), "code", ev.reply
+                )
                 return
 
             if step == "2fa":
                 pwd = text
                 w: AccountWorker = st["worker"]
                 phone = st.get("phone", "")
-                try:
-                    await w.sign_in_2fa(pwd)
-                except Exception as e:
-                    await ev.reply(f"2FA ошибка: {e}")
-                    pending.pop(admin_id, None)
-                    return
-                register_worker(admin_id, phone, w)
-                try:
-                    await w.start()
-                except AuthKeyDuplicatedError:
-                    pending.pop(admin_id, None)
-                    await ev.reply(
-                        "Сессия была аннулирована Telegram из-за одновременного входа с разных IP."
-                        " Попробуй ещё раз через несколько минут."
-                    )
-                    return
-                pending.pop(admin_id, None)
-                await ev.reply(f"✅ {phone} добавлен (2FA). Слушаю входящие.")
+                await _run_login_step(
+                    admin_id, phone, w, lambda: w.sign_in_2fa(pwd), "2fa", ev.reply
+                )
                 return
 
             await ev.reply("Неизвестный шаг добавления аккаунта. Операция отменена.")
             pending.pop(admin_id, None)
             return
 
+def _code_delivery_hint_lines(delivery_hint: Optional[str]) -> List[str]:
+    hint_lines: List[str] = []
+    if delivery_hint == "sms_forced":
+        hint_lines.append(
+            "⚠️ Если код уже пришёл в приложение Telegram — он больше не действителен."
+            " Дождись SMS и введи код из SMS."
+        )
+    elif delivery_hint == "sms":
+        hint_lines.append("ℹ️ Код отправлен по SMS. Обычно он приходит в течение пары минут.")
+    elif delivery_hint == "app":
+        hint_lines.append(
+            "ℹ️ Код отправлен в Telegram. Если удобнее получить SMS, нажми Отмена и попробуй ещё раз."
+        )
+    elif delivery_hint in {"call", "flash_call", "missed_call"}:
+        hint_lines.append(
+            "ℹ️ Код поступит звонком. Ответь и запомни названные цифры."
+        )
+    elif delivery_hint == "email":
+        hint_lines.append("ℹ️ Код придёт на e-mail, привязанный к аккаунту.")
+    return hint_lines
+
+
+def _login_still_pending(admin_id: int, w: AccountWorker) -> bool:
+    st = pending.get(admin_id)
+    return bool(st and st.get("flow") == "account" and st.get("worker") is w)
+
+
+async def _retry_send_login_code(admin_id: int, phone: str, w: AccountWorker) -> None:
+    """Deferred ``send_code`` retry once the FloodWait window has passed."""
+
+    if not _login_still_pending(admin_id, w):
+        return
+    try:
+        await w.send_code()
+    except FloodWaitActive as e:
+        _flood_scheduler.defer(phone, "send_code", lambda: _retry_send_login_code(admin_id, phone, w))
+        await bot_client.send_message(admin_id, f"{e}. Повторю ещё раз автоматически.")
+        return
+    except Exception as e:
+        pending.pop(admin_id, None)
+        await bot_client.send_message(admin_id, f"Не удалось отправить код: {e}")
+        return
+    if not _login_still_pending(admin_id, w):
+        return
+    pending[admin_id] = {"flow": "account", "step": "code", "phone": phone, "worker": w}
+    lines = [f"Код отправлен на {phone}. Пришли код."] + _code_delivery_hint_lines(w.code_delivery_hint)
+    await bot_client.send_message(admin_id, "\n".join(lines))
+
+
+async def _run_login_step(
+    admin_id: int,
+    phone: str,
+    w: AccountWorker,
+    factory: Callable[[], Any],
+    step: str,
+    reply: Callable[[str], Any],
+) -> None:
+    """Run a sign-in step; under FloodWait it is re-run when the window opens."""
+
+    try:
+        await factory()
+    except SessionPasswordNeededError:
+        pending[admin_id] = {
+            "flow": "account",
+            "step": "2fa",
+            "phone": phone,
+            "worker": w,
+        }
+        await reply("Включена двухэтапная защита. Пришли пароль 2FA для аккаунта.")
+        return
+    except FloodWaitActive as e:
+        async def retry() -> None:
+            if _login_still_pending(admin_id, w):
+                await _run_login_step(
+                    admin_id,
+                    phone,
+                    w,
+                    factory,
+                    step,
+                    lambda text: bot_client.send_message(admin_id, text),
+                )
+
+        _flood_scheduler.defer(phone, "sign_in", retry)
+        await reply(f"{e}. Повторю вход автоматически, когда ограничение снимется.")
+        return
+    except Exception as e:
+        await reply(f"2FA ошибка: {e}" if step == "2fa" else f"Ошибка входа: {e}")
+        pending.pop(admin_id, None)
+        return
+    register_worker(admin_id, phone, w)
+    try:
+        await w.start()
+    except AuthKeyDuplicatedError:
+        pending.pop(admin_id, None)
+        await reply(
+            "Сессия была аннулирована Telegram из-за одновременного входа с разных IP."
+            " Попробуй ещё раз через несколько минут."
+        )
+        return
+    pending.pop(admin_id, None)
+    suffix = " (2FA)" if step == "2fa" else ""
+    await reply(f"✅ {phone} добавлен{suffix}. Слушаю входящие.")
+
+
 # ---- startup ----
 async def startup():
     await bot_client.start(bot_token=BOT_TOKEN)
+    _context_store.purge_expired()
     global BOT_USERNAME
     try:
         me = await bot_client.get_me()
@@ -8176,6 +9952,12 @@ def main():
                     loop.run_until_complete(w.stop())
                 except Exception:
                     pass
+        _context_store.flush()
+        log.info("runtime registry stats: %s", registry_stats())
+        log.info("openai response cache stats: %s", response_cache_stats())
+        log.info("openai scheduler stats: %s", openai_scheduler_stats())
+        try: loop.run_until_complete(close_openai_clients())
+        except: pass
         try: loop.run_until_complete(bot_client.disconnect())
         except: pass
 